@@ -1,11 +1,12 @@
-from flask import Flask
-from .config import Config
+# __init__.py
+# Package entry point, e.g. `flask --app FlaskApp run` from the repository root.
+# The modules import each other by flat name, as when run from this directory.
 
-def create_app():
-    app = Flask(__name__)
-    app.config.from_object(Config)
-    
-    from .app import main as main_blueprint
-    app.register_blueprint(main_blueprint)
-    
-    return app 
\ No newline at end of file
+import os
+import sys
+
+_app_dir = os.path.dirname(os.path.abspath(__file__))
+if _app_dir not in sys.path:
+    sys.path.insert(0, _app_dir)
+
+from app import create_app  # noqa: E402
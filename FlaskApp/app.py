@@ -1,139 +1,325 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash
-import os
-import requests
+from flask import (
+    Blueprint, Flask, Response, current_app, get_template_attribute, render_template, request, redirect, url_for,
+    session, flash, jsonify, stream_with_context
+)
+import time
+import csv
+import io
 import urllib.parse
-import json
-from functools import wraps
+import contextvars
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import click
+from flask.cli import with_appcontext
 from config import (
-    QB_CLIENT_ID, QB_CLIENT_SECRET, QB_REDIRECT_URI, QB_BASE_URL,
-    QB_OAUTH_URL, QB_GRAPHQL_URL, QB_AUTH_URL, get_headers
+    QB_CLIENT_ID, QB_REDIRECT_URI, QB_AUTH_URL, INVOICE_PARAMS,
+    CUSTOM_FIELD_MUTATION_BATCH_SIZE, CUSTOM_FIELD_MUTATION_CONCURRENCY,
+    BULK_INVOICE_BATCH_SIZE, get_secret_keys,
+    LOG_LEVEL, LOG_FORMAT, LOG_QUEUE_SIZE, LOG_BODY_LIMIT,
+    QB_WEBHOOK_VERIFIER_TOKEN, QB_REFERENCE_DEADLINE, PROVISION_REALM_CONCURRENCY, Config
+)
+from qb_client import QuickBooksAPI
+from circuit_breaker import CircuitOpenError
+from rate_limiter import BACKGROUND, BULK, INTERACTIVE, RateLimitError
+from reference_sync import verify_webhook, webhook_changes
+from custom_field_index import CustomFieldIndex
+from custom_field_mutations import update_definitions
+from custom_field_provisioning import (
+    REPORT_COLUMNS as PROVISION_COLUMNS, ManifestError, apply_changes, load_manifest, manifest_format,
+    plan_changes, provision_realms, report_row
 )
+from bulk_invoices import REPORT_COLUMNS, build_invoice, create_invoices, iter_rows
+from invoice_export import FORMATS as EXPORT_FORMATS, ExportCursor, export_invoices, parse_date
+from token_manager import token_from_response
+from qb_logging import Body, configure_logging, get_logger
+from services import init_app as init_services, services
+from page_cache import data_version, not_modified
+import instrumentation
+import page_cache
+
+logger = get_logger('app')
+
+# Pages and form posts
+main = Blueprint('main', __name__)
+
+# JSON endpoints and webhooks
+json_api = Blueprint('api', __name__)
+
+
+def create_app(config=None):
+    """Build an app instance; `config` overrides settings from config.Config.
+
+    Nothing here reads the network or builds caches: thread pools, the token
+    store, caches and GraphQL operations are built by the first request
+    that needs them (see services.py), unless APP_LAZY_INIT is off.
+    """
+    configure_logging(LOG_LEVEL, LOG_FORMAT, LOG_QUEUE_SIZE, LOG_BODY_LIMIT)
+    app = Flask(__name__,
+        static_folder='static',
+        static_url_path='/static',
+        template_folder='templates')
+    app.config.from_object(Config)
+    if config:
+        app.config.update(config)
+    if not app.config['SECRET_KEY']:
+        app.secret_key = get_secret_keys()  # Oldest first; itsdangerous signs with the last key
+
+    # Keep session data server-side; the cookie only carries the signed session id
+    from flask_session import Session
+    from session_store import FileSessionInterface
+    Session(app)
+    # Page views that change nothing do not rewrite the session file
+    app.session_interface = FileSessionInterface.from_app(app, app.config['SESSION_REFRESH_INTERVAL'])
+
+    # Route and upstream call timings, Server-Timing headers and /metrics
+    instrumentation.init_app(app, app.config['SLOW_REQUEST_MS'], app.config['PROFILE_SAMPLE_RATE'],
+                             app.config['PROFILE_DIR'])
 
-app = Flask(__name__, 
-    static_folder='static',
-    static_url_path='/static',
-    template_folder='templates')
+    # Gzip for pages and JSON; streamed downloads are left as they are
+    page_cache.init_app(app, app.config['RESPONSE_GZIP_MIN_BYTES'], app.config['RESPONSE_GZIP_LEVEL'],
+                        app.config['RENDER_CACHE_MAX_ENTRIES'])
 
-# Configure session
-app.secret_key = os.urandom(24)
-app.config['SESSION_TYPE'] = 'filesystem'
-app.config['PERMANENT_SESSION_LIFETIME'] = 3600  # 1 hour
-app.config['SESSION_COOKIE_SECURE'] = False  # Set to False for development
-app.config['SESSION_COOKIE_HTTPONLY'] = True
-app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
+    init_services(app)
+    app.register_blueprint(main)
+    app.register_blueprint(json_api)
+    app.cli.add_command(provision_custom_fields_command)
+    return app
 
 # Clear session on startup
-@app.before_request
+@main.before_request
 def clear_session():
-    if request.endpoint == 'index':
+    if request.endpoint == 'main.index':
         # Clear all flash messages
         if '_flashes' in session:
             del session['_flashes']
 
 
 
-@app.route('/')
-def index():
+def get_session_token():
+    """The session's OAuth token, refreshed first if it is close to expiry"""
     token = session.get("oauth_token")
     realm_id = session.get("realm_id")
+    if not token or not realm_id:
+        return token
+    try:
+        fresh_token = services().token_manager.get_valid_token(token, realm_id)
+    except Exception as e:
+        logger.warning("Token refresh failed for realm %s: %s", realm_id, e)
+        if token.get('expires_at', 0) > time.time():
+            return token
+        # The access token is already dead; the user has to reconnect
+        session.pop('oauth_token', None)
+        flash("Your QuickBooks session expired. Please connect again.", "danger")
+        return None
+    if fresh_token is not token:
+        session['oauth_token'] = fresh_token
+    return fresh_token
+
+# Session lists the dashboard renders as cached fragments (macros of the same name in fragments.html)
+DASHBOARD_FRAGMENTS = ('customers', 'items', 'invoice_custom_fields')
+
+# Other session values the dashboard shows; any change to them changes its ETag
+DASHBOARD_SESSION_KEYS = ('realm_id', 'custom_field_name', 'error_code', 'invoice_id', 'invoice_deep_link')
+
+DASHBOARD_TEMPLATES = ('index.html', 'fragments.html')
+
+def store_session_data(name, value):
+    """Keep a list the dashboard renders in the session, with the data version its caches are keyed by"""
+    session[name] = value
+    session['data_versions'] = dict(session.get('data_versions') or {}, **{name: data_version(value)})
+
+def session_data_version(name):
+    """Version of a session list; sessions from before versions were stored are hashed on use"""
+    version = (session.get('data_versions') or {}).get(name)
+    return version if version is not None else data_version(session.get(name) or [])
+
+def dashboard_template_version():
+    """Digest of the dashboard templates: read once, or on every use while templates auto-reload"""
+    def read():
+        env = current_app.jinja_env
+        return data_version([env.loader.get_source(env, name)[0] for name in DASHBOARD_TEMPLATES])
+    if current_app.jinja_env.auto_reload:
+        return read()
+    return services().render_cache.get_or_render(('templates',), read)
+
+@main.app_context_processor
+def dashboard_context():
+    def dashboard_fragment(name):
+        """Markup of the session's `name` list, rendered once per realm and data version"""
+        key = (session.get('realm_id'), name, session_data_version(name), dashboard_template_version())
+        return services().render_cache.get_or_render(
+            key, lambda: get_template_attribute('fragments.html', name)(session.get(name) or []))
+    return {'dashboard_fragment': dashboard_fragment}
+
+def render_dashboard(**context):
+    """index.html for this session, or 304 Not Modified if the browser's copy is still current.
+
+    The weak ETag covers everything the page shows: the templates, the
+    session values and the versions of the session lists. Pages carrying
+    flashed messages are shown once and get no ETag.
+    """
+    if session.get('_flashes'):
+        return render_template('index.html', **context)
+    etag = data_version([
+        dashboard_template_version(), request.script_root,
+        {name: bool(value) if name == 'token' else value for name, value in context.items()},
+        [session.get(key) for key in DASHBOARD_SESSION_KEYS],
+        [session_data_version(name) for name in DASHBOARD_FRAGMENTS],
+    ])
+    if not_modified(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = current_app.make_response(render_template('index.html', **context))
+    response.set_etag(etag, weak=True)
+    # Per-session page: browsers keep it but revalidate on every view
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Cookie')
+    return response
+
+@main.route('/')
+def index():
+    token = get_session_token()
+    realm_id = session.get("realm_id")
     
     if not token or not realm_id:
-        return render_template('index.html', token=None)
+        return render_dashboard(token=None)
     
-    return render_template('index.html', token=token)
+    return render_dashboard(token=token)
+
 
 def fetch_customers(token, realm_id):
-    customers = []
-    if token and realm_id:
-        headers = get_headers(token['access_token'])
-        import urllib.parse
-        customer_url = f"{QB_BASE_URL}/{realm_id}/query"
-        query_str = urllib.parse.urlencode({"query": "SELECT * FROM Customer WHERE Active = true MAXRESULTS 10"})
-        full_url = f"{customer_url}?{query_str}"
-        try:
-            resp = requests.get(full_url, headers=headers)
-            resp_json = resp.json()
-            if resp.status_code == 200 and 'QueryResponse' in resp_json:
-                customers = resp_json['QueryResponse'].get('Customer', [])[:10]
-                # Store customers in session
-                session['customers'] = customers
-        except Exception as e:
-            flash(f"Error fetching customers: {str(e)}", "danger")
-    return customers
+    """Index all active customers and return the first few; raises on transport errors"""
+    return services().reference_sync.load(token, realm_id, 'customers')
 
 def fetch_items(token, realm_id):
-    items = []
-    if token and realm_id:
-        headers = get_headers(token['access_token'])
-        import urllib.parse
-        item_url = f"{QB_BASE_URL}/{realm_id}/query"
-        query_str = urllib.parse.urlencode({"query": "SELECT * FROM Item WHERE Active = true MAXRESULTS 10"})
-        full_url = f"{item_url}?{query_str}"
+    """Index all active items and return the first few; raises on transport errors"""
+    return services().reference_sync.load(token, realm_id, 'items')
+
+def load_custom_field_definitions(svc, token, realm_id, priority=INTERACTIVE, strict=False,
+                                  operation='query_custom_field'):
+    """Fetch a realm's definition nodes and cache them in `svc`; raises on transport errors.
+
+    GraphQL errors yield an empty list, or raise RuntimeError with `strict`.
+    """
+    logger.debug("Sending GraphQL request for custom fields")
+    query = svc.graphql_operations.get(operation)
+    resp = QuickBooksAPI(svc.transport, token, realm_id, priority, deadline=QB_REFERENCE_DEADLINE).graphql(query)
+    logger.debug("Custom fields response %s: %s", resp.status_code, Body(resp))
+    
+    resp_json = resp.json()
+    if resp.status_code == 200 and resp_json.get('data'):
+        edges = resp_json['data']['appFoundationsCustomFieldDefinitions']['edges']
+        logger.debug("Found %d custom field edges", len(edges))
+        nodes = [edge['node'] for edge in edges]
+        svc.definition_cache.put(realm_id, nodes)
+        return nodes
+    logger.warning("Error in custom fields response: %s", Body(resp_json.get('errors', [])))
+    if strict:
+        raise RuntimeError(f"Could not read custom fields (HTTP {resp.status_code}): {resp_json.get('errors')}")
+    return []
+
+def revalidate_custom_field_definitions(svc, token, realm_id):
+    """Refresh a realm's definitions in the background, once at a time"""
+    if not svc.definition_cache.start_refresh(realm_id):
+        return
+
+    def refresh():
         try:
-            resp = requests.get(full_url, headers=headers)
-            resp_json = resp.json()
-            if resp.status_code == 200 and 'QueryResponse' in resp_json:
-                items = resp_json['QueryResponse'].get('Item', [])[:10]
-                # Store items in session
-                session['items'] = items
-        except Exception as e:
-            flash(f"Error fetching items: {str(e)}", "danger")
-    return items
+            load_custom_field_definitions(svc, token, realm_id, BACKGROUND)
+        except Exception:
+            logger.warning("Background refresh of custom fields failed for realm %s", realm_id, exc_info=True)
+        finally:
+            svc.definition_cache.finish_refresh(realm_id)
+    svc.background_executor.submit(refresh)
+
+def get_custom_field_definitions(token, realm_id):
+    """All definition nodes for a realm.
+
+    Fresh cached nodes are returned as is. Nodes past their TTL are returned
+    while a background refresh runs. Nodes another worker has written over
+    are reloaded now, but still served if QuickBooks fails.
+    """
+    svc = services()
+    nodes = svc.definition_cache.get(realm_id)
+    if nodes is not None:
+        return nodes
+    stale = svc.definition_cache.get_stale(realm_id)
+    if stale is None:
+        return load_custom_field_definitions(svc, token, realm_id)
+    nodes, outdated = stale
+    if not outdated:
+        revalidate_custom_field_definitions(svc, token, realm_id)
+        return nodes
+    try:
+        return load_custom_field_definitions(svc, token, realm_id)
+    except Exception:
+        logger.warning("Serving stale custom fields for realm %s", realm_id, exc_info=True)
+        return nodes
+
+def get_custom_field_index(token, realm_id):
+    """CustomFieldIndex over a realm's definitions, shared until they next change"""
+    nodes = get_custom_field_definitions(token, realm_id)
+    index = services().definition_cache.index(realm_id)
+    return index if index is not None else CustomFieldIndex(nodes)
 
 def fetch_custom_fields(token, realm_id):
-    custom_fields = []
-    if token and realm_id:
-        headers = get_headers(token['access_token'])
-        
-        # Read GraphQL query from file
-        try:
-            with open(os.path.join(app.static_folder, 'graphql', 'query_custom_field.graphql'), 'r') as file:
-                query = file.read()
-        except Exception as e:
-            error_msg = f"Failed to read GraphQL query file: {str(e)}"
-            print(error_msg)
-            flash(error_msg, "danger")
-            return custom_fields
-        
-        payload = {"query": query}
+    """Index a realm's custom field definitions; raises on transport or decode errors"""
+    return get_custom_field_index(token, realm_id)
+
+# Definitions the invoice form offers: build_invoice only sends string values
+INVOICE_CUSTOM_FIELDS = {'sub_association': 'SALE_INVOICE', 'data_type': 'STRING', 'active': True}
+
+def field_options(records):
+    """The legacyIDV2 and label of each definition summary: all the session and the invoice form need"""
+    return [{'legacyIDV2': record['legacyIDV2'], 'label': record['label']} for record in records]
+
+def store_custom_fields(index):
+    """Keep the active definitions, and those the invoice form offers, in the session; returns the former"""
+    store_session_data('custom_fields', field_options(index.find(active=True)))
+    store_session_data('invoice_custom_fields', field_options(index.find(**INVOICE_CUSTOM_FIELDS)))
+    return session['custom_fields']
+
+# Seconds the login fan-out waits past QB_REFERENCE_DEADLINE, so reads that hit the deadline can
+# still fall back to their last good copy
+FETCH_DEADLINE_GRACE = 1.0
+
+# Reference data loaded after login, keyed by the session key it is stored under
+REFERENCE_SOURCES = (
+    ('customers', fetch_customers),
+    ('items', fetch_items),
+    ('custom_fields', fetch_custom_fields),
+)
+
+def fetch_reference_data(token, realm_id):
+    """Fetch every reference source concurrently.
+
+    Each source fails independently: its error is flashed and it falls back to
+    an empty list. Flashing happens on the request thread once all fetches finish.
+    The whole fan-out, including any wait for a free pool thread, is bounded by
+    QB_REFERENCE_DEADLINE plus FETCH_DEADLINE_GRACE for stale fallbacks.
+    """
+    deadline = time.monotonic() + QB_REFERENCE_DEADLINE + FETCH_DEADLINE_GRACE
+    # Run each fetch in a copy of this request's context so its upstream calls join the request trace
+    # (the copy also carries the app context the fetchers look their services up in)
+    futures = [
+        (name, services().fetch_executor.submit(contextvars.copy_context().run, fetcher, token, realm_id))
+        for name, fetcher in REFERENCE_SOURCES
+    ]
+    results = {}
+    for name, future in futures:
         try:
-            print("Sending GraphQL request for custom fields...")
-            resp = requests.post(QB_GRAPHQL_URL, json=payload, headers=headers)
-            print(f"Custom fields response status: {resp.status_code}")
-            print(f"Custom fields response: {resp.text}")
-            
-            resp_json = resp.json()
-            if resp.status_code == 200 and resp_json.get('data'):
-                edges = resp_json['data']['appFoundationsCustomFieldDefinitions']['edges']
-                print(f"Found {len(edges)} custom field edges")
-                
-                for edge in edges:
-                    node = edge['node']
-                    if node.get('active', False):
-                        transaction_types = []
-                        for assoc in node.get('associations', []):
-                            if assoc.get('associatedEntity') == '/transactions/Transaction':
-                                for sub_assoc in assoc.get('subAssociations', []):
-                                    transaction_types.append(sub_assoc.get('associatedEntity', ''))
-                        
-                        custom_field = {
-                            'id': node['id'],
-                            'legacyIDV2': node['legacyIDV2'],
-                            'label': node['label'],
-                            'active': node['active'],
-                            'transaction_types': transaction_types,
-                            'selected': True
-                        }
-                        custom_fields.append(custom_field)
-                        print(f"Added custom field: {custom_field}")
-            else:
-                print(f"Error in custom fields response: {resp_json.get('errors', [])}")
+            results[name] = future.result(timeout=max(0.0, deadline - time.monotonic()))
+        except FutureTimeoutError:
+            future.cancel()
+            logger.warning("Timed out fetching %s", name.replace('_', ' '))
+            flash(f"Timed out fetching {name.replace('_', ' ')}; try again shortly.", "danger")
+            results[name] = []
         except Exception as e:
-            print(f"Exception fetching custom fields: {str(e)}")
-            flash(f"Error fetching custom fields: {str(e)}", "danger")
-    return custom_fields
+            logger.warning("Exception fetching %s", name.replace('_', ' '), exc_info=True)
+            flash(f"Error fetching {name.replace('_', ' ')}: {str(e)}", "danger")
+            results[name] = []
+    return results
 
-@app.route("/login")
+@main.route("/login")
 def login():
     scopes = [
         "com.intuit.quickbooks.accounting",
@@ -151,19 +337,19 @@ def login():
     auth_url = f"{QB_AUTH_URL}?{encoded_params}"
     return redirect(auth_url)
 
-@app.route("/callback")
+@main.route("/callback")
 def callback():
     session.pop('_flashes', None)
     
     # Log all callback parameters for debugging
-    print(f"Callback parameters: {dict(request.args)}")
+    logger.debug("Callback parameters: %s", Body(request.args.to_dict()))
     
     # Check for OAuth errors
     error = request.args.get('error')
     error_description = request.args.get('error_description')
     if error:
         error_msg = f"OAuth Error: {error} - {error_description}"
-        print(f"OAuth Error in callback: {error_msg}")
+        logger.warning("OAuth error in callback: %s", error_msg)
         flash(error_msg, "danger")
         return render_template('index.html', token=None, custom_fields=[])
     
@@ -172,15 +358,10 @@ def callback():
     
     if not auth_code or not realm_id:
         error_msg = "Missing code or realmId in callback"
-        print(f"Missing parameters: {error_msg}")
+        logger.warning("Missing parameters: %s", error_msg)
         flash(error_msg, "danger")
         return render_template('index.html', token=None, custom_fields=[])
     
-    headers = {
-        "Accept": "application/json",
-        "Content-Type": "application/x-www-form-urlencoded"
-    }
-    auth = (QB_CLIENT_ID, QB_CLIENT_SECRET)
     data = {
         "grant_type": "authorization_code",
         "code": auth_code,
@@ -188,38 +369,29 @@ def callback():
     }
     
     try:
-        print(f"Token request data: {data}")
-        resp = requests.post(QB_OAUTH_URL, headers=headers, data=data, auth=auth)
-        print(f"Token response status: {resp.status_code}")
-        print(f"Token response: {resp.text}")
+        logger.debug("Token request data: %s", Body(data))
+        resp = services().transport.request_token(data)
+        logger.debug("Token response %s: %s", resp.status_code, Body(resp))
         
         if resp.status_code == 200:
             token_json = resp.json()
             # Store token data in session
-            session['oauth_token'] = {
-                'access_token': token_json.get('access_token'),
-                'refresh_token': token_json.get('refresh_token'),
-                'id_token': token_json.get('id_token'),
-                'expires_in': token_json.get('expires_in'),
-            }
+            session['oauth_token'] = token_from_response(token_json)
             session['realm_id'] = realm_id
+            services().token_manager.save(session['oauth_token'], realm_id)
             
             # Initialize all session data after successful authentication
-            print("Fetching customers...")
-            customers = fetch_customers(session['oauth_token'], realm_id)
-            session['customers'] = customers
-            print(f"Fetched {len(customers)} customers")
-            
-            print("Fetching items...")
-            items = fetch_items(session['oauth_token'], realm_id)
-            session['items'] = items
-            print(f"Fetched {len(items)} items")
-            
-            print("Fetching custom fields...")
-            custom_fields = fetch_custom_fields(session['oauth_token'], realm_id)
-            session['custom_fields'] = custom_fields
-            print(f"Fetched {len(custom_fields)} custom fields")
-            print("Custom fields:", custom_fields)
+            logger.debug("Fetching customers, items and custom fields")
+            reference_data = fetch_reference_data(session['oauth_token'], realm_id)
+            customers = reference_data['customers']
+            items = reference_data['items']
+            store_session_data('customers', customers)
+            store_session_data('items', items)
+            custom_fields = store_custom_fields(reference_data['custom_fields'] or CustomFieldIndex([]))
+            logger.info("Fetched reference data", extra={
+                'realm_id': realm_id, 'customers': len(customers),
+                'items': len(items), 'custom_fields': len(custom_fields),
+            })
             
             flash("Successfully authenticated with QuickBooks!", "success")
             return render_template('index.html', 
@@ -229,53 +401,42 @@ def callback():
                                 items=items)
         else:
             error_msg = f"Failed to get tokens. Status: {resp.status_code}, Response: {resp.text}"
-            print(f"Token request failed: {error_msg}")
+            logger.warning("Token request failed with status %s: %s", resp.status_code, Body(resp))
             flash(error_msg, "danger")
             return render_template('index.html', token=None, custom_fields=[])
     except Exception as e:
         error_msg = f"Exception during OAuth token exchange: {str(e)}"
-        print(f"Exception in callback: {error_msg}")
+        logger.exception("Exception during OAuth token exchange")
         flash(error_msg, "danger")
         return render_template('index.html', token=None, custom_fields=[])
 
-@app.route("/create_custom_field", methods=["POST"])
+@main.route("/create_custom_field", methods=["POST"])
 def create_custom_field():
     session.pop('_flashes', None)
     session.pop('error_code', None)  # Clear any previous error code
     
     custom_field_name = request.form.get("custom_field_name")
-    token = session.get("oauth_token")
+    token = get_session_token()
     realm_id = session.get("realm_id")
+    if not token or not realm_id:
+        flash("Please connect to QuickBooks first.", "danger")
+        return redirect(url_for('main.index'))
     
-    # Read GraphQL mutation from file
-    try:
-        with open(os.path.join(app.static_folder, 'graphql', 'custom_field.graphql'), 'r') as file:
-            mutation = file.read()
-    except Exception as e:
-        error_msg = f"Failed to read GraphQL mutation file: {str(e)}"
-        print(error_msg)
-        flash(error_msg, "danger")
-        return redirect(url_for('index'))
-    
-    # Read variables template from file
+    # Operation and variables template were loaded at startup (or just reloaded in development)
     try:
-        with open(os.path.join(app.static_folder, 'graphql', 'custom_field_variables.json'), 'r') as file:
-            variables_template = json.load(file)
-            # Replace the placeholder with actual value
-            variables_template['input']['label'] = custom_field_name
+        mutation = services().graphql_operations.get('custom_field')
+        variables_template = services().graphql_operations.variables('custom_field_variables')
+        # Replace the placeholder with actual value
+        variables_template['input']['label'] = custom_field_name
     except Exception as e:
-        error_msg = f"Failed to read variables template file: {str(e)}"
-        print(error_msg)
+        error_msg = f"Failed to load GraphQL mutation: {str(e)}"
+        logger.error(error_msg)
         flash(error_msg, "danger")
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     
-    payload = {
-        "query": mutation,
-        "variables": variables_template
-    }
     try:
-        print(f"Creating new custom field with name: {custom_field_name}")
-        resp = requests.post(QB_GRAPHQL_URL, json=payload, headers=get_headers(token['access_token']))
+        logger.info("Creating custom field %r", custom_field_name)
+        resp = QuickBooksAPI(services().transport, token, realm_id).graphql(mutation, variables_template)
         resp_json = resp.json()
         
         if resp_json.get('errors'):
@@ -292,29 +453,36 @@ def create_custom_field():
                     flash("Custom field already exists", "danger")
                 else:
                     flash("Unknown error", "danger")
-                return redirect(url_for('index'))
+                return redirect(url_for('main.index'))
         
-        # After successful custom field creation, refresh custom fields
-        custom_fields = fetch_custom_fields(token, realm_id)
-        session['custom_fields'] = custom_fields
+        # Merge the created definition into the cache rather than refetching the list
+        created = (resp_json.get('data') or {}).get('appFoundationsCreateCustomFieldDefinition')
+        if created:
+            services().definition_cache.upsert(realm_id, created)
+        try:
+            store_custom_fields(fetch_custom_fields(token, realm_id))
+        except Exception as e:
+            logger.warning("Exception fetching custom fields", exc_info=True)
+            flash(f"Error fetching custom fields: {str(e)}", "danger")
         session['custom_field_name'] = custom_field_name  # Store the created custom field name
         
         flash("Custom field created successfully.", "success")
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     except Exception as e:
         error_msg = f"Failed to create custom field: {str(e)}"
-        print(error_msg)
+        logger.error(error_msg)
         flash(error_msg, "danger")
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
 
-@app.route("/create_invoice", methods=["POST"])
+@main.route("/create_invoice", methods=["POST"])
 def create_invoice():
+    from requests.exceptions import ContentDecodingError
 
     session.pop('invoice_id', None)
     session.pop('invoice_deep_link', None)
     
     amount = request.form.get("amount")
-    token = session.get("oauth_token")
+    token = get_session_token()
     realm_id = session.get("realm_id")
     custom_field_id = request.form.get("custom_field_id")
     custom_field_value = request.form.get("custom_field_value")
@@ -324,39 +492,17 @@ def create_invoice():
     
     if not token or not realm_id or not custom_field_id or not customer_id or not item_id:
         flash("Connect to QuickBooks and select all required fields.", "danger")
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     
-    headers = get_headers(token['access_token'])
-    headers["Accept-Encoding"] = "gzip, deflate"
-    
-    url = f"{QB_BASE_URL}/{realm_id}/invoice?minorversion=75&include=enhancedAllCustomFields"
-    data = {
-        "Line": [
-            {
-                "Amount": float(amount),
-                "DetailType": "SalesItemLineDetail",
-                "SalesItemLineDetail": {
-                    "ItemRef": {"value": item_id, "name": item_name}
-                }
-            }
-        ],
-        "CustomerRef": {"value": customer_id},
-        "CustomField": [
-            {
-                "DefinitionId": custom_field_id,
-                "Type": "StringType",
-                "StringValue": custom_field_value
-            }
-        ]
-    }
+    api = QuickBooksAPI(services().transport, token, realm_id)
+    url = api.url(f"invoice{INVOICE_PARAMS}")
+    data = build_invoice(customer_id, item_id, item_name, amount, custom_field_id, custom_field_value)
     
     try:
-        print(f"Sending invoice creation request to: {url}")
-        print(f"Request data: {json.dumps(data, indent=2)}")
+        logger.debug("Sending invoice creation request to %s: %s", url, Body(data))
         
-        resp = requests.post(url, json=data, headers=headers)
-        print(f"Invoice creation response status: {resp.status_code}")
-        print(f"Invoice creation response: {resp.text}")
+        resp = api.make_request("POST", url, data=data, headers={"Accept-Encoding": "gzip, deflate"})
+        logger.debug("Invoice creation response %s: %s", resp.status_code, Body(resp))
         
         if resp.status_code == 200:
             resp_json = resp.json()
@@ -371,145 +517,352 @@ def create_invoice():
                 flash(f"Success! Invoice created with ID: {inv_id}", "success")
             else:
                 error_msg = "Invoice created but ID not found in response"
-                print(error_msg)
-                print(f"Response JSON: {json.dumps(resp_json, indent=2)}")
+                logger.warning("%s: %s", error_msg, Body(resp_json))
                 flash(error_msg, "warning")
         else:
             error_msg = f"Failed to create invoice. Status: {resp.status_code}, Response: {resp.text}"
-            print(error_msg)
+            logger.warning("Failed to create invoice. Status: %s, Response: %s", resp.status_code, Body(resp))
             flash(error_msg, "danger")
-    except requests.exceptions.ContentDecodingError as e:
+    except ContentDecodingError as e:
         error_msg = f"Error creating invoice: Content decoding error - {str(e)}"
-        print(error_msg)
+        logger.error(error_msg)
         flash(error_msg, "danger")
     except Exception as e:
         error_msg = f"Error creating invoice: {str(e)}"
-        print(error_msg)
+        logger.error(error_msg)
         flash(error_msg, "danger")
     
-    return redirect(url_for('index'))
+    return redirect(url_for('main.index'))
+
+@main.route("/bulk_invoices", methods=["POST"])
+def bulk_invoices():
+    """Create invoices from an uploaded CSV/NDJSON file and stream back a per-row report"""
+    token = get_session_token()
+    realm_id = session.get("realm_id")
+    upload = request.files.get("invoices_file")
+    if not token or not realm_id:
+        flash("Please connect to QuickBooks first.", "danger")
+        return redirect(url_for('main.index'))
+    if not upload or not upload.filename:
+        flash("Choose a CSV or NDJSON file of invoices to upload.", "danger")
+        return redirect(url_for('main.index'))
+    
+    fmt = request.form.get("format") or ('ndjson' if upload.filename.endswith(('.ndjson', '.jsonl')) else 'csv')
+    api = QuickBooksAPI(services().transport, token, realm_id, priority=BULK)
+    realm_slots = services().bulk_slots
+    rows = iter_rows(upload.stream, fmt)
+    
+    def generate_report():
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=REPORT_COLUMNS)
+        writer.writeheader()
+        last_row = 0
+        try:
+            for result in create_invoices(api, rows, BULK_INVOICE_BATCH_SIZE, realm_slots):
+                last_row = max(last_row, result['row'])
+                writer.writerow(result)
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        except Exception as e:
+            # Every row read so far has been reported above; note where the upload could not be read further
+            logger.exception("Bulk invoice upload aborted")
+            writer.writerow({'row': '', 'status': 'aborted', 'invoice_id': '',
+                             'error': f"Upload unreadable after row {last_row}: {e}"})
+            yield buffer.getvalue()
+    
+    return Response(stream_with_context(generate_report()), mimetype='text/csv',
+                    headers={"Content-Disposition": "attachment; filename=invoice_results.csv"})
+
+@main.route("/export_invoices")
+def export_invoices_view():
+    """Stream invoices dated in a range, with custom field values, as CSV or NDJSON"""
+    token = get_session_token()
+    realm_id = session.get("realm_id")
+    if not token or not realm_id:
+        flash("Please connect to QuickBooks first.", "danger")
+        return redirect(url_for('main.index'))
+
+    fmt = request.args.get("format", "csv")
+    try:
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError(f"format must be one of: {', '.join(EXPORT_FORMATS)}")
+        start_date = parse_date(request.args.get("start_date"), "start_date")
+        end_date = parse_date(request.args.get("end_date"), "end_date")
+        cursor = request.args.get("cursor")
+        cursor = ExportCursor.parse(cursor) if cursor else None
+    except ValueError as e:
+        flash(str(e), "danger")
+        return redirect(url_for('main.index'))
+
+    # Column headers need every definition label before the first row is written
+    try:
+        definitions = get_custom_field_definitions(token, realm_id)
+    except Exception as e:
+        flash(f"Error fetching custom fields: {str(e)}", "danger")
+        return redirect(url_for('main.index'))
+    api = QuickBooksAPI(services().transport, token, realm_id, priority=BULK)
+    chunks = export_invoices(api, definitions, start_date, end_date, fmt, services().background_executor, cursor)
 
-@app.route('/read_custom_fields')
+    def generate_export():
+        try:
+            yield from chunks
+        except Exception:
+            # The response is already under way; the client resumes from the last row's cursor
+            logger.exception("Invoice export aborted for realm %s", realm_id)
+
+    filename = f"invoices_{start_date}_{end_date}.{fmt}"
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    return Response(stream_with_context(generate_export()), mimetype=mimetype,
+                    headers={"Content-Disposition": f"attachment; filename={filename}"})
+
+@main.route('/read_custom_fields')
 def read_custom_fields():
-    token = session.get("oauth_token")
+    token = get_session_token()
     realm_id = session.get("realm_id")
     if not token or not realm_id:
         flash("Please connect to QuickBooks first.", "danger")
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     
     custom_fields = session.get('custom_fields', [])
     if not custom_fields:
         flash("You do not have any active custom fields", "info")
-        return render_template("index.html", 
-                             show_custom_field_selection=False,
-                             token=token)
+        return render_dashboard(show_custom_field_selection=False, token=token)
     
-    return render_template("index.html", 
-                         show_custom_field_selection=True,
-                         token=token)
+    return render_dashboard(show_custom_field_selection=True, token=token)
 
-@app.route('/deactivate_custom_fields', methods=['POST'])
+@main.route('/deactivate_custom_fields', methods=['POST'])
 def deactivate_custom_fields():
-    token = session.get("oauth_token")
+    token = get_session_token()
     realm_id = session.get("realm_id")
     if not token or not realm_id:
         flash("Please connect to QuickBooks first.", "danger")
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     
-    headers = get_headers(token['access_token'])
+    # Batched updates yield to page loads for the same realm
+    api = QuickBooksAPI(services().transport, token, realm_id, priority=BULK)
     selected_ids = request.form.getlist('selected_custom_fields')
-    query = '''
-    query {
-      appFoundationsCustomFieldDefinitions {
-        edges {
-          node {
-            id
-            legacyIDV2
-            label
-            active
-          }
-        }
-      }
-    }
-    '''
-    payload = {"query": query}
-    resp = requests.post(QB_GRAPHQL_URL, json=payload, headers=headers)
-    resp_json = resp.json()
-    if resp.status_code == 200 and resp_json.get('data'):
-        edges = resp_json['data']['appFoundationsCustomFieldDefinitions']['edges']
-        for edge in edges:
-            node = edge['node']
-            if node['id'] not in selected_ids and node['active']:
-                legacy_id = node.get('legacyIDV2', '')
-                mutation = '''
-                mutation {
-                  appFoundationsUpdateCustomFieldDefinition(
-                    input: {
-                      id: "%s"
-                      legacyIDV2: "%s"
-                      label: "%s"
-                      active: false
-                    }
-                  ) {
-                    id
-                    active
-                  }
-                }
-                ''' % (node['id'], legacy_id, node['label'].replace('"', '\\"').replace('\\', '\\\\'))
-                payload_mut = {"query": mutation}
-                resp_mut = requests.post(QB_GRAPHQL_URL, json=payload_mut, headers=headers)
-                resp_json_mut = resp_mut.json()
-                if "errors" in resp_json_mut:
-                    flash(f"Failed to deactivate {node['label']}: {resp_json_mut['errors']}", "danger")
-            elif node['id'] in selected_ids and not node['active']:
-                legacy_id = node.get('legacyIDV2', '')
-                mutation = '''
-                mutation {
-                  appFoundationsUpdateCustomFieldDefinition(
-                    input: {
-                      id: "%s"
-                      legacyIDV2: "%s"
-                      label: "%s"
-                      active: true
-                    }
-                  ) {
-                    id
-                    active
-                  }
-                }
-                ''' % (node['id'], legacy_id, node['label'].replace('"', '\\"').replace('\\', '\\\\'))
-                payload_mut = {"query": mutation}
-                resp_mut = requests.post(QB_GRAPHQL_URL, json=payload_mut, headers=headers)
-                resp_json_mut = resp_mut.json()
-                if "errors" in resp_json_mut:
-                    flash(f"Failed to activate {node['label']}: {resp_json_mut['errors']}", "danger")
+    try:
+        nodes = get_custom_field_definitions(token, realm_id)
+    except Exception as e:
+        flash(f"Error fetching custom fields: {str(e)}", "danger")
+        return redirect(url_for('main.index'))
+    if nodes:
+        # Only fields whose state changes are sent, batched into aliased mutations
+        updates = [
+            {
+                'id': node['id'],
+                'legacyIDV2': node.get('legacyIDV2', ''),
+                'label': node['label'],
+                'active': node['id'] in selected_ids,
+            }
+            for node in nodes
+            if (node['id'] in selected_ids) != bool(node['active'])
+        ]
+        results = update_definitions(api, updates, CUSTOM_FIELD_MUTATION_BATCH_SIZE,
+                                     CUSTOM_FIELD_MUTATION_CONCURRENCY)
+        for update, updated_node, errors in results:
+            if errors:
+                action = "activate" if update['active'] else "deactivate"
+                flash(f"Failed to {action} {update['label']}: {errors}", "danger")
+            elif updated_node:
+                services().definition_cache.upsert(realm_id, updated_node)
+        store_custom_fields(services().definition_cache.index(realm_id) or CustomFieldIndex(nodes))
     flash("Custom fields updated successfully.", "success")
-    return redirect(url_for('index'))
+    return redirect(url_for('main.index'))
 
-def get_api_headers(token):
-    return {
-        "Authorization": f"Bearer {token}",
-        "Accept": "application/json",
-        "Content-Type": "application/json"
-    }
+def provision_realm(svc, manifest, realm_id, token, dry_run=False):
+    """Diff one realm's definitions against `manifest` and apply the difference; returns report rows"""
+    if not token:
+        raise RuntimeError("No stored QuickBooks token for this realm; connect it first")
+    # One fresh read: the diff must not be based on a cached copy, and needs the dropdown options
+    nodes = load_custom_field_definitions(svc, token, realm_id, BULK, strict=True,
+                                          operation='query_custom_field_provisioning')
+    changes = plan_changes(manifest, nodes)
+    pending = [change for change in changes if change.input is not None]
+    outcomes = {}
+    if pending and not dry_run:
+        api = QuickBooksAPI(svc.transport, token, realm_id, priority=BULK)
+        for change, node, errors in apply_changes(api, pending, CUSTOM_FIELD_MUTATION_BATCH_SIZE,
+                                                  CUSTOM_FIELD_MUTATION_CONCURRENCY):
+            outcomes[id(change)] = (node, errors)
 
-def validate_quickbooks_session():
-    token = session.get("oauth_token")
+    rows = []
+    for change in changes:
+        if change.input is None:
+            rows.append(report_row(realm_id, change, 'conflict' if change.action == 'conflict' else 'unchanged'))
+        elif dry_run:
+            rows.append(report_row(realm_id, change, 'planned'))
+        else:
+            node, errors = outcomes[id(change)]
+            if errors:
+                rows.append(report_row(realm_id, change, 'failed', "; ".join(e.get('message', '') for e in errors)))
+                continue
+            svc.definition_cache.upsert(realm_id, node)
+            change.id = change.id or node.get('id', '')
+            rows.append(report_row(realm_id, change, 'applied'))
+    return rows
+
+def write_report(rows, columns):
+    """Yield CSV text for `rows`, one chunk per row after the header"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.getvalue():
+        yield buffer.getvalue()
+
+@main.route('/provision_custom_fields', methods=['POST'])
+def provision_custom_fields():
+    """Bring this realm's definitions in line with an uploaded manifest and return a CSV report"""
+    token = get_session_token()
     realm_id = session.get("realm_id")
+    upload = request.files.get("manifest_file")
     if not token or not realm_id:
         flash("Please connect to QuickBooks first.", "danger")
-        return None, None
-    return token, realm_id
-
-class QuickBooksAPI:
-    def __init__(self, token, realm_id):
-        self.token = token
-        self.realm_id = realm_id
-        self.headers = get_api_headers(token)
-        
-    def make_request(self, method, endpoint, data=None):
-        # Common request handling logic
-        pass
+        return redirect(url_for('main.index'))
+    if not upload or not upload.filename:
+        flash("Choose a JSON or YAML manifest of custom fields to upload.", "danger")
+        return redirect(url_for('main.index'))
+    try:
+        manifest = load_manifest(upload.read().decode('utf-8-sig'), manifest_format(upload.filename))
+    except (ManifestError, UnicodeDecodeError) as e:
+        flash(f"Invalid manifest: {e}", "danger")
+        return redirect(url_for('main.index'))
+
+    # Only the connected realm: other realms' stored tokens are for the provision-custom-fields command
+    svc = services()
+    dry_run = request.form.get("dry_run") == "on"
+    # Applied before the report streams, so the response can still carry the refreshed session lists
+    rows = list(provision_realms([realm_id], lambda realm: provision_realm(svc, manifest, realm, token, dry_run), 1))
+    index = svc.definition_cache.index(realm_id)
+    if index is not None:
+        store_custom_fields(index)
+    return Response(stream_with_context(write_report(rows, PROVISION_COLUMNS)), mimetype='text/csv',
+                    headers={"Content-Disposition": "attachment; filename=custom_field_provisioning.csv"})
+
+@click.command('provision-custom-fields')
+@click.argument('manifest_file', type=click.File('r', encoding='utf-8-sig'))
+@click.argument('realm_ids', nargs=-1)
+@click.option('--all', 'all_realms', is_flag=True, help="Every realm with a stored token.")
+@click.option('--dry-run', is_flag=True, help="Report the changes without applying them.")
+@click.option('--concurrency', type=int, default=PROVISION_REALM_CONCURRENCY, show_default=True,
+              help="Realms provisioned at the same time.")
+@with_appcontext
+def provision_custom_fields_command(manifest_file, realm_ids, all_realms, dry_run, concurrency):
+    """Apply a custom field manifest to realms connected to this app, writing a CSV report to stdout."""
+    try:
+        manifest = load_manifest(manifest_file.read(), manifest_format(manifest_file.name))
+    except ManifestError as e:
+        raise click.UsageError(f"Invalid manifest: {e}")
+    svc = services()
+    realm_ids = list(realm_ids) or (svc.token_manager.realm_ids() if all_realms else [])
+    if not realm_ids:
+        raise click.UsageError("Name the realms to provision, or pass --all")
+
+    def provision(realm_id):
+        return provision_realm(svc, manifest, realm_id, svc.token_manager.stored_token(realm_id), dry_run)
+
+    failed = []
+
+    def tracked(rows):
+        for row in rows:
+            if row['status'] in ('failed', 'conflict'):
+                failed.append(row)
+            yield row
+
+    for text in write_report(tracked(provision_realms(realm_ids, provision, concurrency)), PROVISION_COLUMNS):
+        click.echo(text, nl=False)
+    if failed:
+        raise SystemExit(1)
+
+@json_api.route('/search/<source>')
+def search_reference_data(source):
+    """Typeahead over the realm's indexed customers or items"""
+    reference_sync = services().reference_sync
+    if source not in reference_sync.sources:
+        return jsonify({"error": f"Unknown source: {source}"}), 404
+    token = get_session_token()
+    realm_id = session.get("realm_id")
+    if not token or not realm_id:
+        return jsonify({"error": "Please connect to QuickBooks first."}), 401
+    
+    index = reference_sync.index(token, realm_id, source)
+    
+    limit = min(request.args.get('limit', 20, type=int), 100)
+    results = index.search(request.args.get('q', ''), limit=limit)
+    return jsonify({"results": [record._asdict() for record in results], "complete": index.complete})
+
+def parse_flag(value, name):
+    """True, False or None (no filter) from a 'true'/'false' query argument"""
+    if value is None or value == '':
+        return None
+    if value.lower() in ('true', '1'):
+        return True
+    if value.lower() in ('false', '0'):
+        return False
+    raise ValueError(f"{name} must be true or false")
+
+@json_api.route('/custom_fields/index')
+def custom_field_index():
+    """Definitions matching the given filters, looked up in the realm's prebuilt index"""
+    token = get_session_token()
+    realm_id = session.get("realm_id")
+    if not token or not realm_id:
+        return jsonify({"error": "Please connect to QuickBooks first."}), 401
+    try:
+        filters = {
+            'associated_entity': request.args.get('associated_entity') or None,
+            'sub_association': request.args.get('sub_association') or None,
+            'data_type': request.args.get('data_type') or None,
+            'active': parse_flag(request.args.get('active'), 'active'),
+            'required': parse_flag(request.args.get('required'), 'required'),
+        }
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    index = get_custom_field_index(token, realm_id)
+    return jsonify({"results": index.find(**filters), "facets": index.facets()})
+
+@main.errorhandler(RateLimitError)
+def rate_limited(error):
+    """Calls that could not get a QuickBooks slot in time"""
+    retry_after = max(1, int(round(error.retry_after)))
+    flash(f"QuickBooks is busy for this company; try again in {retry_after} seconds.", "warning")
+    return redirect(url_for('main.index'))
+
+@main.errorhandler(CircuitOpenError)
+def upstream_unavailable(error):
+    """Calls short-circuited while a QuickBooks endpoint is failing"""
+    retry_after = max(1, int(round(error.retry_after)))
+    flash(f"QuickBooks is not responding; try again in {retry_after} seconds.", "warning")
+    return redirect(url_for('main.index'))
+
+@json_api.errorhandler(RateLimitError)
+def api_rate_limited(error):
+    return jsonify({"error": str(error)}), 429, {'Retry-After': str(max(1, int(round(error.retry_after))))}
+
+@json_api.errorhandler(CircuitOpenError)
+def api_upstream_unavailable(error):
+    return jsonify({"error": str(error)}), 503, {'Retry-After': str(max(1, int(round(error.retry_after))))}
+
+@json_api.route('/webhooks/quickbooks', methods=['POST'])
+def quickbooks_webhook():
+    """Intuit change notifications: schedule a delta sync for each realm whose customers or items changed"""
+    if not verify_webhook(request.get_data(), request.headers.get('intuit-signature'), QB_WEBHOOK_VERIFIER_TOKEN):
+        logger.warning("Rejected webhook with a missing or invalid signature")
+        return jsonify({"error": "Invalid signature"}), 401
+
+    reference_sync = services().reference_sync
+    synced_entities = {spec.entity for spec in reference_sync.sources.values()}
+    for realm_id, entities in webhook_changes(request.get_json(silent=True) or {}).items():
+        if entities & synced_entities:
+            reference_sync.request_sync(realm_id, force=True)
+    return jsonify({"status": "accepted"})
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5002, debug=True)
\ No newline at end of file
+    create_app().run(host="0.0.0.0", port=5002, debug=True)
\ No newline at end of file
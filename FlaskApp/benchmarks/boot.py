@@ -0,0 +1,70 @@
+# boot.py
+# Worker boot time: importing the app, building it with create_app and serving its first request.
+#
+# Run from the FlaskApp directory:
+#     python -m benchmarks.boot --runs 10
+#     python -m benchmarks.boot --eager     # APP_LAZY_INIT=0: build every subsystem in create_app
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from benchmarks.run import percentile
+
+# Runs in a fresh interpreter per sample so nothing is already imported
+_PROBE = r"""
+import json, sys, time
+preloaded = set(sys.modules)
+started = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+app = create_app()
+created = time.perf_counter()
+loaded = sorted(name for name in ('requests', 'prometheus_client', 'intuitlib')
+                if name in sys.modules and name not in preloaded)
+app.test_client().get('/')
+served = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - started) * 1000,
+    'create_app_ms': (created - imported) * 1000,
+    'first_request_ms': (served - created) * 1000,
+    'modules': len(set(sys.modules) - preloaded),
+    'heavy_modules_at_boot': loaded,
+}))
+"""
+
+
+def sample(env):
+    app_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    out = subprocess.run([sys.executable, '-c', _PROBE], cwd=app_dir, env=env, check=True,
+                         capture_output=True, text=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure app import, create_app and first request time")
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--eager', action='store_true', help="build every subsystem in create_app")
+    args = parser.parse_args(argv)
+
+    env = dict(os.environ)
+    env.setdefault('STATE_DIR', tempfile.mkdtemp(prefix='qbo-boot-'))
+    env.setdefault('LOG_LEVEL', 'ERROR')
+    env.setdefault('SECRET_KEY', 'boot-benchmark')
+    env['APP_LAZY_INIT'] = '0' if args.eager else '1'
+    samples = [sample(env) for _ in range(args.runs)]
+
+    for metric in ('import_ms', 'create_app_ms', 'first_request_ms'):
+        values = [s[metric] for s in samples]
+        print(f"{metric:<18} p50 {percentile(values, 50):8.1f}   p95 {percentile(values, 95):8.1f}")
+    boot = [s['import_ms'] + s['create_app_ms'] for s in samples]
+    print(f"{'boot_ms':<18} p50 {percentile(boot, 50):8.1f}   p95 {percentile(boot, 95):8.1f}")
+    print(f"modules imported by the app: {samples[-1]['modules']}; heavy modules at boot: "
+          f"{', '.join(samples[-1]['heavy_modules_at_boot']) or 'none'}")
+
+
+if __name__ == '__main__':
+    main()
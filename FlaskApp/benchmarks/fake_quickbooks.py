@@ -0,0 +1,366 @@
+# fake_quickbooks.py
+# Local stand-in for the QuickBooks OAuth, v3 REST and App Foundations GraphQL endpoints
+
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+_QUERY_RE = re.compile(r"SELECT\s+(?P<fields>.+?)\s+FROM\s+(?P<entity>\w+)", re.IGNORECASE | re.DOTALL)
+_START_RE = re.compile(r"STARTPOSITION\s+(\d+)", re.IGNORECASE)
+_MAX_RE = re.compile(r"MAXRESULTS\s+(\d+)", re.IGNORECASE)
+_DATE_BOUND_RE = re.compile(r"TxnDate\s*(?P<op>>=|<=)\s*'(?P<date>[\d-]+)'", re.IGNORECASE)
+_REALM_PATH_RE = re.compile(r"^/v3/company/(?P<realm>[^/]+)/(?P<resource>\w+)")
+
+
+class FakeQuickBooks:
+    """In-memory QuickBooks company with tunable latency, error rate and size.
+
+    Every handled request is counted by upstream operation name in `calls`.
+    With `persisted_queries`, GraphQL requests may carry a document hash in
+    place of the document, as in Apollo automatic persisted queries.
+    """
+
+    def __init__(self, customers=10000, items=1000, definitions=500,
+                 latency_ms=50.0, jitter_ms=10.0, error_rate=0.0, error_status=503, seed=1,
+                 persisted_queries=False):
+        self.persisted_queries = persisted_queries
+        self._persisted = {}  # sha256 -> document
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._next_invoice_id = 1000
+        self._changes = []  # (epoch seconds, entity, row) reported by /cdc
+        self._server = None
+        self.entities = {
+            'Customer': [self._customer(i) for i in range(1, customers + 1)],
+            'Item': [self._item(i) for i in range(1, items + 1)],
+            'Invoice': [],  # filled by /invoice and /batch
+        }
+        self.definitions = {}
+        for i in range(1, definitions + 1):
+            self._add_definition(f"Field {i}", active=i % 5 != 0)
+
+    # Dataset
+
+    @staticmethod
+    def _customer(i):
+        return {
+            'Id': str(i), 'DisplayName': f"Customer {i:05d}", 'CompanyName': f"Company {i}",
+            'Active': True, 'Balance': round(i * 1.37, 2), 'SyncToken': '0',
+            'BillAddr': {'Line1': f"{i} Main St", 'City': 'Mountain View', 'CountrySubDivisionCode': 'CA'},
+            'PrimaryEmailAddr': {'Address': f"customer{i}@example.com"},
+            'MetaData': {'CreateTime': '2024-01-01T00:00:00-08:00', 'LastUpdatedTime': '2024-01-01T00:00:00-08:00'},
+        }
+
+    @staticmethod
+    def _item(i):
+        return {
+            'Id': str(i), 'Name': f"Item {i:05d}", 'Active': True, 'Type': 'Service',
+            'UnitPrice': 10 + i % 90, 'IncomeAccountRef': {'value': '1', 'name': 'Services'},
+            'SyncToken': '0', 'MetaData': {'CreateTime': '2024-01-01T00:00:00-08:00'},
+        }
+
+    def _add_definition(self, label, active=True, data_type='STRING', associations=None, options=None):
+        index = len(self.definitions) + 1
+        node = {
+            'id': f"djQuMTo{index:06d}",
+            'legacyIDV2': str(index),
+            'label': label,
+            'active': active,
+            'dataType': data_type,
+            'dropDownOptions': options or [],
+            'associations': associations or [{
+                'associatedEntity': '/transactions/Transaction',
+                'active': True,
+                'validationOptions': {'required': False},
+                'allowedOperations': [],
+                'associationCondition': 'INCLUDED',
+                'subAssociations': [{'associatedEntity': 'SALE_INVOICE', 'active': True, 'allowedOperations': []}],
+            }],
+        }
+        self.definitions[node['id']] = node
+        return node
+
+    # Server lifecycle
+
+    def start(self, host='127.0.0.1', port=0):
+        fake = self
+
+        class Handler(_Handler):
+            pass
+        Handler.fake = fake
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True, name='fake-qbo').start()
+        return self.url
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def urls(self):
+        """Endpoint URLs in the shape config.py expects"""
+        return {
+            'QB_BASE_URL': f"{self.url}/v3/company",
+            'QB_OAUTH_URL': f"{self.url}/oauth2/v1/tokens/bearer",
+            'QB_GRAPHQL_URL': f"{self.url}/graphql",
+        }
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls.clear()
+
+    def snapshot_calls(self):
+        with self._lock:
+            return dict(self.calls)
+
+    def count(self, operation):
+        with self._lock:
+            self.calls[operation] += 1
+
+    def delay(self):
+        if self.latency_ms > 0:
+            jitter = self._random.uniform(-self.jitter_ms, self.jitter_ms)
+            time.sleep(max(0.0, self.latency_ms + jitter) / 1000.0)
+
+    def should_fail(self):
+        return self.error_rate > 0 and self._random.random() < self.error_rate
+
+    # Endpoint behaviour
+
+    def token(self, form):
+        return 200, {
+            'access_token': f"fake-access-{self._random.getrandbits(32):08x}",
+            'refresh_token': 'fake-refresh',
+            'id_token': 'fake-id',
+            'token_type': 'bearer',
+            'expires_in': 3600,
+            'x_refresh_token_expires_in': 8726400,
+        }
+
+    def query(self, query):
+        match = _QUERY_RE.search(query)
+        if not match:
+            return 400, {'Fault': {'Error': [{'Message': 'QueryParserError'}]}}
+        entity = match.group('entity')
+        records = self.entities.get(entity, [])
+        start_match = _START_RE.search(query)
+        max_match = _MAX_RE.search(query)
+        start = int(start_match.group(1)) if start_match else 1
+        max_results = min(int(max_match.group(1)) if max_match else 100, 1000)
+        for bound in _DATE_BOUND_RE.finditer(query):
+            if bound.group('op') == '>=':
+                records = [r for r in records if r.get('TxnDate', '') >= bound.group('date')]
+            else:
+                records = [r for r in records if r.get('TxnDate', '') <= bound.group('date')]
+        page = records[start - 1:start - 1 + max_results]
+        fields = [f.strip() for f in match.group('fields').split(',')]
+        if fields != ['*']:
+            page = [{f: r[f] for f in fields if f in r} for r in page]
+        return 200, {'QueryResponse': {entity: page, 'startPosition': start, 'maxResults': len(page)}}
+
+    def change(self, entity, record_id, **fields):
+        """Update (or with status='Deleted', delete) a record so /cdc reports it"""
+        with self._lock:
+            records = self.entities[entity]
+            row = next((r for r in records if r['Id'] == str(record_id)), None)
+            if fields.get('status') == 'Deleted':
+                if row is not None:
+                    records.remove(row)
+                row = {'Id': str(record_id), 'status': 'Deleted'}
+            elif row is None:
+                row = dict(fields, Id=str(record_id))
+                records.append(row)
+            else:
+                row.update(fields)
+            self._changes.append((time.time(), entity, dict(row)))
+
+    def cdc(self, params):
+        entities = params.get('entities', [''])[0].split(',')
+        since = datetime.fromisoformat(params.get('changedSince', ['1970-01-01T00:00:00+00:00'])[0]).timestamp()
+        with self._lock:
+            changed = [(entity, row) for at, entity, row in self._changes if at >= since and entity in entities]
+        responses = [{entity: [row for e, row in changed if e == entity]} for entity in entities]
+        return 200, {'CDCResponse': [{'QueryResponse': responses}]}
+
+    def invoice(self, body):
+        with self._lock:
+            self._next_invoice_id += 1
+            invoice = dict(body, Id=str(self._next_invoice_id), SyncToken='0')
+            invoice.setdefault('TxnDate', datetime.now().date().isoformat())
+            invoice['TotalAmt'] = invoice['Balance'] = sum(line.get('Amount', 0) for line in body.get('Line', []))
+            self.entities['Invoice'].append(invoice)
+        return 200, {'Invoice': invoice}
+
+    def batch(self, body):
+        responses = []
+        for item in body.get('BatchItemRequest', []):
+            _, invoice = self.invoice(item.get('Invoice', {}))
+            responses.append({'bId': item.get('bId'), 'Invoice': invoice['Invoice']})
+        return 200, {'BatchItemResponse': responses}
+
+    def graphql(self, body):
+        document = body.get('query', '')
+        variables = body.get('variables') or {}
+        persisted = (body.get('extensions') or {}).get('persistedQuery')
+        if persisted:
+            if not self.persisted_queries:
+                return 200, {'errors': [{'message': 'PersistedQueryNotSupported',
+                                         'extensions': {'code': 'PERSISTED_QUERY_NOT_SUPPORTED'}}]}
+            with self._lock:
+                if document:
+                    self._persisted[persisted.get('sha256Hash')] = document
+                else:
+                    document = self._persisted.get(persisted.get('sha256Hash'), '')
+            if not document:
+                self.count('graphql:persisted_query_miss')
+                return 200, {'errors': [{'message': 'PersistedQueryNotFound',
+                                         'extensions': {'code': 'PERSISTED_QUERY_NOT_FOUND'}}]}
+        if 'appFoundationsCreateCustomFieldDefinition' in document:
+            self.count('graphql:create_definition')
+            if 'input' in variables:
+                return self._create_definition(variables['input'])
+            return self._create_definitions(variables)
+        if 'appFoundationsUpdateCustomFieldDefinition' in document:
+            self.count('graphql:update_definitions')
+            return self._update_definitions(variables)
+        self.count('graphql:list_definitions')
+        with self._lock:
+            edges = [{'node': dict(node)} for node in self.definitions.values()]
+        return 200, {'data': {'appFoundationsCustomFieldDefinitions': {'edges': edges}}}
+
+    def _create_definition(self, definition):
+        with self._lock:
+            node, error = self._create_locked(definition)
+        if error:
+            return 200, {'data': None, 'errors': [error]}
+        return 200, {'data': {'appFoundationsCreateCustomFieldDefinition': node}}
+
+    def _create_definitions(self, variables):
+        data = {}
+        errors = []
+        with self._lock:
+            for name, definition in variables.items():
+                alias = 'c' + name[len('input'):]
+                data[alias], error = self._create_locked(definition)
+                if error:
+                    errors.append(dict(error, path=[alias]))
+        result = {'data': data}
+        if errors:
+            result['errors'] = errors
+        return 200, result
+
+    def _create_locked(self, definition):
+        """(node, None) or (None, error) for one create; the caller holds the lock"""
+        if any(d['label'].casefold() == definition.get('label', '').casefold() for d in self.definitions.values()):
+            return None, {'message': 'Label already exists',
+                          'extensions': {'errorCode': {'errorCode': 'LABEL_ALREADY_EXISTS'}}}
+        node = self._add_definition(definition.get('label', ''), definition.get('active', True),
+                                    definition.get('dataType', 'STRING'), definition.get('associations'),
+                                    definition.get('dropDownOptions'))
+        return dict(node), None
+
+    def _update_definitions(self, variables):
+        data = {}
+        errors = []
+        with self._lock:
+            for name, update in variables.items():
+                alias = 'u' + name[len('input'):]
+                node = self.definitions.get(update.get('id'))
+                if node is None:
+                    data[alias] = None
+                    errors.append({'message': 'Definition not found', 'path': [alias]})
+                    continue
+                node.update({k: v for k, v in update.items() if k != 'id'})
+                data[alias] = {'id': node['id'], 'active': node['active']}
+        result = {'data': data}
+        if errors:
+            result['errors'] = errors
+        return 200, result
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    fake = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _send(self, status, payload, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, method):
+        fake = self.fake
+        url = urlsplit(self.path)
+        raw = self._read_body()
+        fake.delay()
+
+        realm_match = _REALM_PATH_RE.match(url.path)
+        if url.path.endswith('/tokens/bearer'):
+            operation = 'oauth:token'
+        elif url.path == '/graphql':
+            operation = None  # counted per GraphQL operation
+        elif realm_match:
+            operation = f"v3:{realm_match.group('resource')}"
+        else:
+            return self._send(404, {'error': f"No fake for {method} {url.path}"})
+
+        if operation:
+            fake.count(operation)
+        if fake.should_fail():
+            fake.count('injected_error')
+            return self._send(fake.error_status, {'Fault': {'Error': [{'Message': 'Injected failure'}]}},
+                              {'Retry-After': '0'} if fake.error_status == 429 else None)
+
+        if operation == 'oauth:token':
+            status, payload = fake.token(parse_qs(raw.decode('utf-8')))
+        elif operation is None:
+            status, payload = fake.graphql(json.loads(raw or b'{}'))
+        else:
+            resource = realm_match.group('resource')
+            if resource == 'query':
+                query = parse_qs(url.query).get('query', [''])[0]
+                status, payload = fake.query(query)
+            elif resource == 'invoice':
+                status, payload = fake.invoice(json.loads(raw or b'{}'))
+            elif resource == 'batch':
+                status, payload = fake.batch(json.loads(raw or b'{}'))
+            elif resource == 'cdc':
+                status, payload = fake.cdc(parse_qs(url.query))
+            else:
+                status, payload = 404, {'error': f"No fake for {resource}"}
+        self._send(status, payload)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
@@ -0,0 +1,326 @@
+# run.py
+# Load benchmark for the app's routes against the local QuickBooks stand-in.
+#
+# Run from the FlaskApp directory:
+#     python -m benchmarks.run --customers 10000 --definitions 500 --concurrency 16
+#     python -m benchmarks.run --output baseline.json
+#     python -m benchmarks.run --baseline baseline.json --tolerance 0.2
+#     python -m benchmarks.run --server gthread --output sync.json
+#     python -m benchmarks.run --server gevent --baseline sync.json
+
+import argparse
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from benchmarks.fake_quickbooks import FakeQuickBooks
+
+ROUTES = ('callback', 'dashboard', 'create_invoice', 'create_custom_field', 'deactivate_custom_fields',
+          'provision_custom_fields')
+REALM_ID = '9130000000000001'
+SERVERS = ('werkzeug', 'gthread', 'gevent')
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[rank]
+
+
+def bench_env(env, fake):
+    """Point the app at the fake; client-side rate budgets are lifted unless set explicitly"""
+    env.update(fake.urls())
+    env.setdefault('STATE_DIR', tempfile.mkdtemp(prefix='qbo-bench-'))
+    env.setdefault('LOG_LEVEL', 'WARNING')
+    env.setdefault('QB_RATE_V3_PER_MINUTE', '1000000')
+    env.setdefault('QB_RATE_GRAPHQL_PER_MINUTE', '1000000')
+    return env
+
+
+def start_app(fake, host='127.0.0.1'):
+    """Import the app pointed at the fake and serve it on a threaded WSGI server"""
+    bench_env(os.environ, fake)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    from werkzeug.serving import make_server
+    from app import create_app
+
+    app = create_app()
+
+    server = make_server(host, 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True, name='bench-app').start()
+    return server, f"http://{host}:{server.server_port}"
+
+
+class GunicornServer:
+    """The app under gunicorn.conf.py in a child process, pointed at the fake"""
+
+    def __init__(self, fake, worker_class, workers, host='127.0.0.1'):
+        with socket.socket() as sock:
+            sock.bind((host, 0))
+            port = sock.getsockname()[1]
+        self.base_url = f"http://{host}:{port}"
+        env = bench_env(dict(os.environ), fake)
+        env.setdefault('SECRET_KEY', os.urandom(24).hex())
+        env.update({
+            'APP_ENV': 'benchmark',  # not production, so session cookies work over plain http
+            'GUNICORN_BIND': f"{host}:{port}",
+            'GUNICORN_WORKERS': str(workers),
+            'GUNICORN_WORKER_CLASS': worker_class,
+        })
+        app_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--log-level', 'warning', 'wsgi:application'],
+            cwd=app_dir, env=env, stdout=subprocess.DEVNULL)
+        self._wait_ready()
+
+    def _wait_ready(self, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"gunicorn exited with status {self.process.returncode}")
+            try:
+                requests.get(self.base_url, timeout=1)
+                return
+            except requests.RequestException:
+                time.sleep(0.2)
+        self.shutdown()
+        raise RuntimeError("gunicorn did not start")
+
+    def shutdown(self):
+        self.process.terminate()
+        self.process.wait(timeout=30)
+
+
+def start_server(fake, server, workers):
+    """(server handle, base URL) for one of SERVERS"""
+    if server == 'werkzeug':
+        return start_app(fake)
+    gunicorn = GunicornServer(fake, server, workers)
+    return gunicorn, gunicorn.base_url
+
+
+def login(base_url):
+    """A client session that has completed /callback"""
+    client = requests.Session()
+    resp = client.get(f"{base_url}/callback", params={'code': 'bench', 'realmId': REALM_ID})
+    resp.raise_for_status()
+    return client
+
+
+class Scenario:
+    """Issues one request of a route for a logged-in client"""
+
+    def __init__(self, base_url, fake):
+        self.base_url = base_url
+        self.fake = fake
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def _next(self):
+        with self._lock:
+            self._counter += 1
+            return self._counter
+
+    def callback(self, client):
+        return client.get(f"{self.base_url}/callback", params={'code': 'bench', 'realmId': REALM_ID})
+
+    def dashboard(self, client):
+        # Revalidate with the ETag of this client's last view, as a browser does
+        headers = {'If-None-Match': client.dashboard_etag} if getattr(client, 'dashboard_etag', None) else {}
+        resp = client.get(f"{self.base_url}/", headers=headers)
+        client.dashboard_etag = resp.headers.get('ETag')
+        return resp
+
+    def create_invoice(self, client):
+        definition = next(iter(self.fake.definitions.values()))
+        n = self._next()
+        return client.post(f"{self.base_url}/create_invoice", allow_redirects=False, data={
+            'customer_id': str(1 + n % len(self.fake.entities['Customer'])),
+            'item_id': '1',
+            'item_name': 'Item 00001',
+            'amount': '12.34',
+            'custom_field_id': definition['legacyIDV2'],
+            'custom_field_value': f"bench-{n}",
+        })
+
+    def create_custom_field(self, client):
+        return client.post(f"{self.base_url}/create_custom_field", allow_redirects=False,
+                           data={'custom_field_name': f"Bench field {time.time_ns()}-{self._next()}"})
+
+    def deactivate_custom_fields(self, client):
+        # Alternate between two selections so each submit flips a tenth of the fields
+        ids = sorted(self.fake.definitions)
+        offset = self._next() % 2
+        selected = [i for n, i in enumerate(ids) if n % 10 != offset]
+        return client.post(f"{self.base_url}/deactivate_custom_fields", allow_redirects=False,
+                           data={'selected_custom_fields': selected})
+
+    def provision_custom_fields(self, client):
+        # 50 dropdown fields whose options alternate per submit: created once, then 50 updates each time
+        options = ['East', 'West'] if self._next() % 2 else ['North', 'South']
+        manifest = [{'label': f"Bench region {i}", 'dataType': 'DROPDOWN', 'dropDownOptions': options}
+                    for i in range(50)]
+        return client.post(f"{self.base_url}/provision_custom_fields",
+                           files={'manifest_file': ('manifest.json', json.dumps(manifest))})
+
+
+def settle(fake, quiet_for=0.5, timeout=60):
+    """Wait for background upstream work (e.g. index streaming) from the previous phase to finish"""
+    deadline = time.monotonic() + timeout
+    last = None
+    while time.monotonic() < deadline:
+        current = sum(fake.snapshot_calls().values())
+        if current == last:
+            return
+        last = current
+        time.sleep(quiet_for)
+
+
+def run_route(route, scenario, clients, requests_per_route, concurrency):
+    settle(scenario.fake)
+    scenario.fake.reset_calls()
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    send = getattr(scenario, route)
+
+    def one(n):
+        nonlocal errors
+        client = clients[n % len(clients)]
+        started = time.perf_counter()
+        try:
+            resp = send(client)
+            ok = resp.status_code < 400
+        except requests.RequestException:
+            ok = False
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            if not ok:
+                errors += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(requests_per_route)))
+    wall = time.perf_counter() - started
+    calls = scenario.fake.snapshot_calls()
+    return {
+        'requests': requests_per_route,
+        'errors': errors,
+        'throughput_rps': round(requests_per_route / wall, 2) if wall else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'upstream_calls': calls,
+        'upstream_calls_per_request': round(sum(calls.values()) / requests_per_route, 2),
+    }
+
+
+def print_report(results):
+    header = f"{'route':<26}{'req':>6}{'err':>5}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'up/req':>8}"
+    print(header)
+    print('-' * len(header))
+    for route, r in results.items():
+        print(f"{route:<26}{r['requests']:>6}{r['errors']:>5}{r['throughput_rps']:>9}"
+              f"{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}{r['upstream_calls_per_request']:>8}")
+    for route, r in results.items():
+        calls = ", ".join(f"{k}={v}" for k, v in sorted(r['upstream_calls'].items()))
+        print(f"  {route}: {calls}")
+
+
+def compare(results, baseline, tolerance):
+    """Regressions beyond `tolerance` (a fraction) against a saved run"""
+    regressions = []
+    for route, r in results.items():
+        base = baseline.get('routes', {}).get(route)
+        if not base:
+            continue
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms', 'upstream_calls_per_request'):
+            if base[metric] and r[metric] > base[metric] * (1 + tolerance):
+                regressions.append(f"{route} {metric}: {base[metric]} -> {r[metric]}")
+        if base['throughput_rps'] and r['throughput_rps'] < base['throughput_rps'] * (1 - tolerance):
+            regressions.append(f"{route} throughput_rps: {base['throughput_rps']} -> {r['throughput_rps']}")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark app routes against a local QuickBooks stand-in")
+    parser.add_argument('--customers', type=int, default=10000)
+    parser.add_argument('--items', type=int, default=1000)
+    parser.add_argument('--definitions', type=int, default=500)
+    parser.add_argument('--latency-ms', type=float, default=50.0, help="mean upstream latency")
+    parser.add_argument('--jitter-ms', type=float, default=10.0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of upstream calls that fail")
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--persisted-queries', action='store_true',
+                        help="send GraphQL persisted-query hashes to a stand-in that accepts them")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=50, help="requests per route")
+    parser.add_argument('--clients', type=int, default=8, help="logged-in sessions shared by the load")
+    parser.add_argument('--routes', default=','.join(ROUTES))
+    parser.add_argument('--server', choices=SERVERS, default='werkzeug',
+                        help="in-process threaded server, or gunicorn with sync (gthread) or async (gevent) workers")
+    parser.add_argument('--workers', type=int, default=2, help="gunicorn worker processes")
+    parser.add_argument('--output', help="write results as JSON")
+    parser.add_argument('--baseline', help="compare against a previous --output file")
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    routes = [r for r in args.routes.split(',') if r]
+    unknown = set(routes) - set(ROUTES)
+    if unknown:
+        sys.exit(f"Unknown routes: {', '.join(sorted(unknown))}")
+
+    fake = FakeQuickBooks(customers=args.customers, items=args.items, definitions=args.definitions,
+                          latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                          error_rate=args.error_rate, error_status=args.error_status,
+                          persisted_queries=args.persisted_queries)
+    fake.start()
+    if args.persisted_queries:
+        os.environ['QB_GRAPHQL_PERSISTED_QUERIES'] = '1'
+
+    server, base_url = start_server(fake, args.server, args.workers)
+    try:
+        clients = [login(base_url) for _ in range(args.clients)]
+        scenario = Scenario(base_url, fake)
+        results = {route: run_route(route, scenario, clients, args.requests, args.concurrency)
+                   for route in routes}
+    finally:
+        server.shutdown()
+        if args.server == 'werkzeug':
+            # The app ran in this process; gunicorn workers close theirs in worker_exit
+            from services import close_app
+            close_app(server.app)
+        fake.stop()
+
+    print_report(results)
+    report = {'config': vars(args), 'routes': results}
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    if args.baseline:
+        with open(args.baseline, 'r') as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        if regressions:
+            print("\nRegressions:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+# bulk_invoices.py
+# Streamed bulk invoice creation through the QBO batch endpoint
+
+import codecs
+import csv
+import json
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Columns accepted in a bulk upload, matching the single invoice form
+INVOICE_COLUMNS = ('customer_id', 'item_id', 'item_name', 'amount', 'custom_field_id', 'custom_field_value')
+REPORT_COLUMNS = ('row', 'status', 'invoice_id', 'error')
+
+# QBO caps a batch request at 30 operations
+MAX_BATCH_SIZE = 30
+
+
+class RealmSlots:
+    """Bounds the batch requests in flight per realm, across every bulk job that shares this instance"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._slots = {}
+        self._lock = threading.Lock()
+
+    def get(self, realm_id):
+        """The realm's semaphore, created on first use"""
+        with self._lock:
+            slot = self._slots.get(realm_id)
+            if slot is None:
+                slot = self._slots[realm_id] = threading.BoundedSemaphore(self.limit)
+            return slot
+
+
+def build_invoice(customer_id, item_id, item_name, amount, custom_field_id, custom_field_value):
+    """Invoice body with one sales line and one string custom field"""
+    return {
+        "Line": [
+            {
+                "Amount": float(amount),
+                "DetailType": "SalesItemLineDetail",
+                "SalesItemLineDetail": {
+                    "ItemRef": {"value": item_id, "name": item_name}
+                }
+            }
+        ],
+        "CustomerRef": {"value": customer_id},
+        "CustomField": [
+            {
+                "DefinitionId": custom_field_id,
+                "Type": "StringType",
+                "StringValue": custom_field_value
+            }
+        ]
+    }
+
+
+def iter_rows(stream, fmt):
+    """Yield (row number, row) from a binary CSV or NDJSON upload, one line at a time.
+
+    CSV rows are dicts; NDJSON rows are the line's text, parsed by
+    `parse_row` so that one bad line is reported against its row alone.
+    Raises UnicodeDecodeError (or csv.Error) if the upload cannot be read further.
+    """
+    lines = codecs.iterdecode(stream, 'utf-8-sig')
+    if fmt == 'ndjson':
+        for number, line in enumerate(lines, start=1):
+            if line.strip():
+                yield number, line
+    else:
+        for number, row in enumerate(csv.DictReader(lines), start=1):
+            yield number, row
+
+
+def parse_row(row):
+    """The column dict of a row from `iter_rows`; raises ValueError for a line that is not a JSON object"""
+    if isinstance(row, str):
+        row = json.loads(row)
+    if not isinstance(row, dict):
+        raise ValueError(f"expected a JSON object, got {type(row).__name__}")
+    return row
+
+
+def _result(number, status, invoice_id='', error=''):
+    return {'row': number, 'status': status, 'invoice_id': invoice_id, 'error': error}
+
+
+def _send_batch(api, batch, slot):
+    """POST one batch of (row number, invoice) pairs and map results back per row"""
+    payload = {
+        "BatchItemRequest": [
+            {"bId": str(number), "operation": "create", "Invoice": invoice}
+            for number, invoice in batch
+        ]
+    }
+    try:
+        with slot:
+            resp = api.make_request("POST", "batch?minorversion=75", data=payload)
+        if resp.status_code != 200:
+            return [_result(number, 'error', error=f"HTTP {resp.status_code}: {resp.text[:200]}")
+                    for number, _ in batch]
+        responses = {item.get('bId'): item for item in resp.json().get('BatchItemResponse', [])}
+    except Exception as e:
+        return [_result(number, 'error', error=str(e)) for number, _ in batch]
+
+    results = []
+    for number, _ in batch:
+        item = responses.get(str(number), {})
+        if 'Invoice' in item:
+            results.append(_result(number, 'created', invoice_id=item['Invoice'].get('Id', '')))
+        else:
+            errors = item.get('Fault', {}).get('Error', []) or [{"Message": "No result returned"}]
+            message = "; ".join(f"{e.get('Message', '')} {e.get('Detail', '')}".strip() for e in errors)
+            results.append(_result(number, 'error', error=message))
+    return results
+
+
+def create_invoices(api, rows, batch_size, realm_slots):
+    """Create invoices for streamed rows, yielding one result per row.
+
+    Results are tagged with their row number; invalid rows are reported as
+    soon as they are read, ahead of the batch they would have joined. If
+    `rows` raises, the rows read so far are still sent and every one of
+    them is reported before the exception propagates.
+
+    Rows are grouped into batches of up to 30 operations. At most
+    `realm_slots.limit` batches are in flight for the realm at any time,
+    across every job sharing the RealmSlots, and only a small window of
+    pending batches is buffered, so memory stays flat no matter how large
+    the upload is.
+    """
+    batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+    concurrency = realm_slots.limit
+    slot = realm_slots.get(api.realm_id)
+    pending = deque()  # futures or ready result lists, in row order
+
+    def drain(limit):
+        while len(pending) > limit:
+            head = pending.popleft()
+            yield from head if isinstance(head, list) else head.result()
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='qb-bulk') as executor:
+        batch = []
+        try:
+            for number, row in rows:
+                try:
+                    row = parse_row(row)
+                    invoice = build_invoice(*(row.get(column) for column in INVOICE_COLUMNS))
+                    if not row.get('customer_id') or not row.get('item_id') or not row.get('custom_field_id'):
+                        raise ValueError("customer_id, item_id and custom_field_id are required")
+                except (TypeError, ValueError) as e:
+                    pending.append([_result(number, 'invalid', error=str(e))])
+                else:
+                    batch.append((number, invoice))
+                    if len(batch) == batch_size:
+                        pending.append(executor.submit(_send_batch, api, batch, slot))
+                        batch = []
+                yield from drain(concurrency * 2)
+        except Exception:
+            # The upload cannot be read further; invoices already sent must still be reported
+            if batch:
+                pending.append(executor.submit(_send_batch, api, batch, slot))
+            yield from drain(0)
+            raise
+        if batch:
+            pending.append(executor.submit(_send_batch, api, batch, slot))
+        yield from drain(0)
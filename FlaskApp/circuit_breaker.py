@@ -0,0 +1,89 @@
+# circuit_breaker.py
+# Per-endpoint circuit breakers so a degraded QuickBooks API fails fast instead of tying up requests
+
+import threading
+import time
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    """Calls to an endpoint are short-circuited after repeated failures"""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"QuickBooks {name} is unavailable; retrying in {retry_after:.0f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` consecutive failures.
+
+    While open, calls fail immediately with CircuitOpenError. After
+    `reset_timeout` seconds one trial call is let through (half-open): its
+    success closes the breaker, its failure opens it again.
+    """
+
+    def __init__(self, name, failure_threshold, reset_timeout, on_open=None):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.on_open = on_open
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """Raise CircuitOpenError unless a call may go ahead"""
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            now = time.monotonic()
+            elapsed = now - self.opened_at
+            if elapsed >= self.reset_timeout:
+                # Let one trial through; if it never reports back, another goes after the next timeout
+                self.state = HALF_OPEN
+                self.opened_at = now
+                return
+            raise CircuitOpenError(self.name, max(0.0, self.reset_timeout - elapsed))
+
+    def record_success(self):
+        with self._lock:
+            self.state = CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+                opened = True
+            else:
+                opened = False
+        if opened and self.on_open is not None:
+            self.on_open(self.name)
+
+
+class CircuitBreakers:
+    """One breaker per endpoint name, created on first use"""
+
+    def __init__(self, failure_threshold, reset_timeout, on_open=None):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.on_open = on_open
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        breaker = self._breakers.get(name)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.get(name)
+                if breaker is None:
+                    breaker = self._breakers[name] = CircuitBreaker(
+                        name, self.failure_threshold, self.reset_timeout, self.on_open)
+        return breaker
@@ -1,28 +1,50 @@
 # config.py
 # Configuration for QuickBooks API URLs and scopes
 
+import logging
 import os
 from urllib.parse import urlencode
-from intuitlib.enums import Scopes
 
 # QuickBooks OAuth2 Configuration
 QB_CLIENT_ID = os.getenv('QB_CLIENT_ID', '')
 QB_CLIENT_SECRET = os.getenv('QB_CLIENT_SECRET', '')
 QB_REDIRECT_URI = os.getenv('QB_REDIRECT_URI', '')
 QB_ENVIRONMENT = os.getenv('QB_ENVIRONMENT', 'production')
+
+# Deployment mode: 'development' (single process, debug) or 'production' (multi-worker)
+APP_ENV = os.getenv('APP_ENV', 'development')
+
+# Session signing keys. SECRET_KEY signs new sessions; SECRET_KEY_FALLBACKS
+# (comma-separated, oldest first) are still accepted while a rotation rolls out.
+SECRET_KEY = os.getenv('SECRET_KEY', '')
+SECRET_KEY_FALLBACKS = [key.strip() for key in os.getenv('SECRET_KEY_FALLBACKS', '').split(',') if key.strip()]
+
+# Local state shared by every worker on the host (sessions, tokens, cache versions)
+STATE_DIR = os.getenv('STATE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'state'))
     
 # API Endpoints
-QB_BASE_URL = f"https://{'sandbox-quickbooks.api.intuit.com' if QB_ENVIRONMENT == 'sandbox' else 'quickbooks.api.intuit.com'}/v3/company"
-QB_OAUTH_URL = "https://oauth.platform.intuit.com/oauth2/v1/tokens/bearer"
-QB_GRAPHQL_URL = "https://qb.api.intuit.com/graphql"
+# (QB_BASE_URL, QB_OAUTH_URL and QB_GRAPHQL_URL can be overridden, e.g. to point at benchmarks/fake_quickbooks.py)
+QB_BASE_URL = os.getenv('QB_BASE_URL', f"https://{'sandbox-quickbooks.api.intuit.com' if QB_ENVIRONMENT == 'sandbox' else 'quickbooks.api.intuit.com'}/v3/company")
+QB_OAUTH_URL = os.getenv('QB_OAUTH_URL', "https://oauth.platform.intuit.com/oauth2/v1/tokens/bearer")
+QB_GRAPHQL_URL = os.getenv('QB_GRAPHQL_URL', "https://qb.api.intuit.com/graphql")
 QB_AUTH_URL = f"https://appcenter.intuit.com/connect/oauth2"
     
-# OAuth2 Scopes
+# OAuth2 Scopes (the values of intuitlib's Scopes.ACCOUNTING and Scopes.CUSTOM_FIELDS)
 QB_SCOPES = [
-   Scopes.ACCOUNTING,
-   Scopes.CUSTOM_FIELDS
+   "com.intuit.quickbooks.accounting",
+   "app-foundations.custom-field-definitions"
 ]
     
+# Session signing
+def get_secret_keys():
+    """Signing keys, oldest first; the last one signs new sessions"""
+    if SECRET_KEY:
+        return SECRET_KEY_FALLBACKS + [SECRET_KEY]
+    if APP_ENV == 'production':
+        raise RuntimeError("SECRET_KEY must be set when APP_ENV=production")
+    logging.getLogger('qbo.config').warning("SECRET_KEY is not set; using a per-process key (development only)")
+    return [os.urandom(24)]
+
 # API Headers
 def get_headers(token):
     """Generate standard headers for QuickBooks API requests"""
@@ -58,3 +80,157 @@ QB_DEEP_LINK_BASE = "https://app.qbo.intuit.com/app/invoice"
 def get_deep_link(invoice_id, realm_id):
     """Generate a deep link to an invoice in QuickBooks"""
     return f"{QB_DEEP_LINK_BASE}?txnId={invoice_id}&companyId={realm_id}"
+
+# HTTP transport tuning (connection pooling, timeouts and retries)
+QB_HTTP_POOL_CONNECTIONS = int(os.getenv('QB_HTTP_POOL_CONNECTIONS', '4'))
+QB_HTTP_POOL_MAXSIZE = int(os.getenv('QB_HTTP_POOL_MAXSIZE', '20'))
+QB_HTTP_CONNECT_TIMEOUT = float(os.getenv('QB_HTTP_CONNECT_TIMEOUT', '3.05'))
+QB_HTTP_READ_TIMEOUT = float(os.getenv('QB_HTTP_READ_TIMEOUT', '30'))
+QB_HTTP_MAX_RETRIES = int(os.getenv('QB_HTTP_MAX_RETRIES', '3'))
+QB_HTTP_BACKOFF_FACTOR = float(os.getenv('QB_HTTP_BACKOFF_FACTOR', '0.5'))
+QB_HTTP_BACKOFF_MAX = float(os.getenv('QB_HTTP_BACKOFF_MAX', '20'))
+
+# Page size for paginated QBO queries (the API maximum is 1000)
+QB_QUERY_PAGE_SIZE = int(os.getenv('QB_QUERY_PAGE_SIZE', '1000'))
+
+# Worker threads for concurrent reference-data reads (customers, items, custom fields) during a
+# page load, and separately for background work: index streams, syncs, refreshes and export prefetch
+QB_FETCH_WORKERS = int(os.getenv('QB_FETCH_WORKERS', '8'))
+QB_BACKGROUND_WORKERS = int(os.getenv('QB_BACKGROUND_WORKERS', '4'))
+
+# Server-side session store shared by all workers on the host
+SESSION_FILE_DIR = os.getenv('SESSION_FILE_DIR', os.path.join(STATE_DIR, 'sessions'))
+SESSION_FILE_THRESHOLD = int(os.getenv('SESSION_FILE_THRESHOLD', '10000'))
+# Seconds after which an unchanged session is written again to extend its expiry
+SESSION_REFRESH_INTERVAL = float(os.getenv('SESSION_REFRESH_INTERVAL', '300'))
+
+# Custom field definition cache
+CUSTOM_FIELD_CACHE_TTL = float(os.getenv('CUSTOM_FIELD_CACHE_TTL', '300'))
+CUSTOM_FIELD_CACHE_MAX_REALMS = int(os.getenv('CUSTOM_FIELD_CACHE_MAX_REALMS', '1000'))
+CUSTOM_FIELD_CACHE_VERSION_DIR = os.getenv('CUSTOM_FIELD_CACHE_VERSION_DIR', os.path.join(STATE_DIR, 'cache_versions'))
+
+# Batched custom field definition updates: aliases per mutation and concurrent mutations
+CUSTOM_FIELD_MUTATION_BATCH_SIZE = int(os.getenv('CUSTOM_FIELD_MUTATION_BATCH_SIZE', '25'))
+CUSTOM_FIELD_MUTATION_CONCURRENCY = int(os.getenv('CUSTOM_FIELD_MUTATION_CONCURRENCY', '4'))
+
+# Custom field manifest provisioning: realms provisioned at the same time by `flask provision-custom-fields`
+PROVISION_REALM_CONCURRENCY = int(os.getenv('PROVISION_REALM_CONCURRENCY', '4'))
+
+# Bulk invoice creation: operations per /batch request (max 30) and concurrent requests per realm
+BULK_INVOICE_BATCH_SIZE = int(os.getenv('BULK_INVOICE_BATCH_SIZE', '30'))
+QB_REALM_MAX_CONCURRENCY = int(os.getenv('QB_REALM_MAX_CONCURRENCY', '8'))
+
+# OAuth token refresh: shared per-realm token files, how early to refresh and how long
+# to wait after a failed refresh before trying again (seconds)
+TOKEN_STORE_DIR = os.getenv('TOKEN_STORE_DIR', os.path.join(STATE_DIR, 'tokens'))
+TOKEN_REFRESH_MARGIN = int(os.getenv('TOKEN_REFRESH_MARGIN', '300'))
+TOKEN_REFRESH_RETRY_INTERVAL = int(os.getenv('TOKEN_REFRESH_RETRY_INTERVAL', '60'))
+
+# Reference data snapshots kept current with Change Data Capture: snapshot files, minimum seconds
+# between login-triggered delta syncs of a realm, and the webhook verifier token from the Intuit app
+REFERENCE_SNAPSHOT_DIR = os.getenv('REFERENCE_SNAPSHOT_DIR', os.path.join(STATE_DIR, 'reference_snapshots'))
+REFERENCE_SYNC_MIN_INTERVAL = float(os.getenv('REFERENCE_SYNC_MIN_INTERVAL', '60'))
+# In-memory typeahead indexes per worker: at most this many (realm, source) indexes, each dropped
+# after REFERENCE_INDEX_TTL seconds without a read (rebuilt from the snapshot on next use)
+REFERENCE_INDEX_MAX_ENTRIES = int(os.getenv('REFERENCE_INDEX_MAX_ENTRIES', '2000'))
+REFERENCE_INDEX_TTL = float(os.getenv('REFERENCE_INDEX_TTL', '3600'))
+QB_WEBHOOK_VERIFIER_TOKEN = os.getenv('QB_WEBHOOK_VERIFIER_TOKEN')
+
+# Logging: level, 'json' or 'text' output, background queue capacity and max logged body size
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+LOG_BODY_LIMIT = int(os.getenv('LOG_BODY_LIMIT', '2048'))
+
+# Instrumentation: requests slower than this are logged at INFO (and profiled when sampled);
+# PROFILE_SAMPLE_RATE is the fraction of requests run under cProfile (0 disables profiling)
+SLOW_REQUEST_MS = float(os.getenv('SLOW_REQUEST_MS', '1000'))
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(STATE_DIR, 'profiles'))
+
+# Client-side QuickBooks throttling per realm: requests per minute and burst for the v3 REST and
+# GraphQL budgets, calls allowed to queue per budget, and longest wait (seconds). The budgets are
+# QuickBooks' per-realm limits; each of QB_RATE_PROCESSES worker processes spends an equal share
+QB_RATE_V3_PER_MINUTE = float(os.getenv('QB_RATE_V3_PER_MINUTE', '450'))
+QB_RATE_V3_BURST = int(os.getenv('QB_RATE_V3_BURST', '40'))
+QB_RATE_GRAPHQL_PER_MINUTE = float(os.getenv('QB_RATE_GRAPHQL_PER_MINUTE', '300'))
+QB_RATE_GRAPHQL_BURST = int(os.getenv('QB_RATE_GRAPHQL_BURST', '20'))
+QB_RATE_MAX_WAITERS = int(os.getenv('QB_RATE_MAX_WAITERS', '200'))
+QB_RATE_MAX_WAIT = float(os.getenv('QB_RATE_MAX_WAIT', '30'))
+QB_RATE_PROCESSES = max(1, int(os.getenv('QB_RATE_PROCESSES', '1')))
+
+# Circuit breakers per upstream operation: consecutive failures before opening and seconds before
+# a trial call; reference reads made during a page load give up after QB_REFERENCE_DEADLINE seconds
+QB_BREAKER_FAILURE_THRESHOLD = int(os.getenv('QB_BREAKER_FAILURE_THRESHOLD', '5'))
+QB_BREAKER_RESET_TIMEOUT = float(os.getenv('QB_BREAKER_RESET_TIMEOUT', '30'))
+QB_REFERENCE_DEADLINE = float(os.getenv('QB_REFERENCE_DEADLINE', '5'))
+
+# GraphQL operations: re-read changed .graphql/.json files on use (on by default in development),
+# and send persisted-query hashes instead of full documents to servers that accept them
+GRAPHQL_HOT_RELOAD = os.getenv('GRAPHQL_HOT_RELOAD', '1' if APP_ENV == 'development' else '0') == '1'
+QB_GRAPHQL_PERSISTED_QUERIES = os.getenv('QB_GRAPHQL_PERSISTED_QUERIES', '0') == '1'
+GRAPHQL_DIR = os.getenv('GRAPHQL_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'graphql'))
+
+# Dashboard rendering: rendered fragments kept per process, and gzip for responses of at least
+# RESPONSE_GZIP_MIN_BYTES when the client accepts it
+RENDER_CACHE_MAX_ENTRIES = int(os.getenv('RENDER_CACHE_MAX_ENTRIES', '2000'))
+RESPONSE_GZIP_MIN_BYTES = int(os.getenv('RESPONSE_GZIP_MIN_BYTES', '1024'))
+RESPONSE_GZIP_LEVEL = int(os.getenv('RESPONSE_GZIP_LEVEL', '6'))
+
+# Subsystems (thread pools, caches, token store, GraphQL operations) are built on first use so
+# workers boot quickly; APP_LAZY_INIT=0 builds them all in create_app to surface errors at startup
+APP_LAZY_INIT = os.getenv('APP_LAZY_INIT', '1') == '1'
+
+
+class Config:
+    """Settings create_app loads into app.config; tests override them per app instance"""
+
+    # Server-side sessions shared by every worker on the host
+    SESSION_TYPE = 'filesystem'
+    SESSION_FILE_DIR = SESSION_FILE_DIR
+    SESSION_FILE_THRESHOLD = SESSION_FILE_THRESHOLD
+    SESSION_USE_SIGNER = True
+    PERMANENT_SESSION_LIFETIME = 3600  # 1 hour
+    SESSION_REFRESH_INTERVAL = SESSION_REFRESH_INTERVAL
+    SESSION_COOKIE_SECURE = APP_ENV == 'production'
+    SESSION_COOKIE_HTTPONLY = True
+    SESSION_COOKIE_SAMESITE = 'Lax'
+
+    # Subsystems built by services.Services
+    QB_FETCH_WORKERS = QB_FETCH_WORKERS
+    QB_BACKGROUND_WORKERS = QB_BACKGROUND_WORKERS
+    TOKEN_STORE_DIR = TOKEN_STORE_DIR
+    TOKEN_REFRESH_MARGIN = TOKEN_REFRESH_MARGIN
+    TOKEN_REFRESH_RETRY_INTERVAL = TOKEN_REFRESH_RETRY_INTERVAL
+    CUSTOM_FIELD_CACHE_TTL = CUSTOM_FIELD_CACHE_TTL
+    CUSTOM_FIELD_CACHE_MAX_REALMS = CUSTOM_FIELD_CACHE_MAX_REALMS
+    CUSTOM_FIELD_CACHE_VERSION_DIR = CUSTOM_FIELD_CACHE_VERSION_DIR
+    REFERENCE_SNAPSHOT_DIR = REFERENCE_SNAPSHOT_DIR
+    REFERENCE_SYNC_MIN_INTERVAL = REFERENCE_SYNC_MIN_INTERVAL
+    REFERENCE_INDEX_MAX_ENTRIES = REFERENCE_INDEX_MAX_ENTRIES
+    REFERENCE_INDEX_TTL = REFERENCE_INDEX_TTL
+    QB_REFERENCE_DEADLINE = QB_REFERENCE_DEADLINE
+    QB_RATE_V3_PER_MINUTE = QB_RATE_V3_PER_MINUTE
+    QB_RATE_V3_BURST = QB_RATE_V3_BURST
+    QB_RATE_GRAPHQL_PER_MINUTE = QB_RATE_GRAPHQL_PER_MINUTE
+    QB_RATE_GRAPHQL_BURST = QB_RATE_GRAPHQL_BURST
+    QB_RATE_MAX_WAITERS = QB_RATE_MAX_WAITERS
+    QB_RATE_MAX_WAIT = QB_RATE_MAX_WAIT
+    QB_RATE_PROCESSES = QB_RATE_PROCESSES
+    QB_BREAKER_FAILURE_THRESHOLD = QB_BREAKER_FAILURE_THRESHOLD
+    QB_BREAKER_RESET_TIMEOUT = QB_BREAKER_RESET_TIMEOUT
+    QB_GRAPHQL_PERSISTED_QUERIES = QB_GRAPHQL_PERSISTED_QUERIES
+    QB_REALM_MAX_CONCURRENCY = QB_REALM_MAX_CONCURRENCY
+    GRAPHQL_DIR = GRAPHQL_DIR
+    GRAPHQL_HOT_RELOAD = GRAPHQL_HOT_RELOAD
+    APP_LAZY_INIT = APP_LAZY_INIT
+    RENDER_CACHE_MAX_ENTRIES = RENDER_CACHE_MAX_ENTRIES
+
+    # Response compression
+    RESPONSE_GZIP_MIN_BYTES = RESPONSE_GZIP_MIN_BYTES
+    RESPONSE_GZIP_LEVEL = RESPONSE_GZIP_LEVEL
+
+    # Instrumentation
+    SLOW_REQUEST_MS = SLOW_REQUEST_MS
+    PROFILE_SAMPLE_RATE = PROFILE_SAMPLE_RATE
+    PROFILE_DIR = PROFILE_DIR
@@ -0,0 +1,138 @@
+# custom_field_cache.py
+# Per-realm TTL cache of custom field definitions with LRU eviction across realms
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from custom_field_index import CustomFieldIndex
+from instrumentation import record_cache
+
+
+class SharedVersions:
+    """Per-realm version stamps kept as file mtimes in a directory shared by all workers.
+
+    Bumping a realm's version after a write makes every other worker treat
+    its cached copy as stale.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, realm_id):
+        return os.path.join(self.directory, str(realm_id))
+
+    def get(self, realm_id):
+        try:
+            return os.stat(self._path(realm_id)).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+    def bump(self, realm_id):
+        path = self._path(realm_id)
+        with open(path, 'a'):
+            pass
+        now = time.time_ns()
+        os.utime(path, ns=(now, now))
+        return self.get(realm_id)
+
+
+class CustomFieldDefinitionCache:
+    """Definition nodes per realm, keyed by definition id.
+
+    Entries expire `ttl` seconds after they were last loaded in full; at most
+    `max_realms` realms are kept, evicting the least recently used one.
+    Mutation responses are merged in place with `upsert` instead of
+    refetching the whole list. With `versions`, a write in any worker
+    invalidates the realm in every other worker.
+
+    Expired and invalidated entries stay until evicted so `get_stale` can
+    serve them while a refresh runs or QuickBooks is unavailable.
+
+    Each entry's CustomFieldIndex is built on first use and dropped
+    whenever the entry's definitions change.
+    """
+
+    def __init__(self, ttl, max_realms, versions=None):
+        self.ttl = ttl
+        self.max_realms = max_realms
+        self.versions = versions
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # realm_id -> (expires_at, version, {id: node}, index or None)
+        self._refreshing = set()
+
+    def get(self, realm_id):
+        """Cached definition nodes for a realm, or None on a miss"""
+        with self._lock:
+            entry = self._entries.get(realm_id)
+            if entry is None or entry[0] <= time.monotonic() or entry[1] != self._version(realm_id):
+                record_cache('custom_field_definitions', 'miss')
+                return None
+            self._entries.move_to_end(realm_id)
+            record_cache('custom_field_definitions', 'hit')
+            return list(entry[2].values())
+
+    def get_stale(self, realm_id):
+        """(nodes, outdated) for a realm's last loaded definitions, however old, or None.
+
+        `outdated` is True when a write in some worker has superseded the copy,
+        as opposed to it merely having outlived its TTL.
+        """
+        with self._lock:
+            entry = self._entries.get(realm_id)
+            if entry is None:
+                return None
+            return list(entry[2].values()), entry[1] != self._version(realm_id)
+
+    def start_refresh(self, realm_id):
+        """True if the caller should refresh the realm; False if a refresh is already running"""
+        with self._lock:
+            if realm_id in self._refreshing:
+                return False
+            self._refreshing.add(realm_id)
+            return True
+
+    def finish_refresh(self, realm_id):
+        with self._lock:
+            self._refreshing.discard(realm_id)
+
+    def put(self, realm_id, nodes):
+        """Replace a realm's definitions with a freshly loaded list"""
+        with self._lock:
+            definitions = {node['id']: node for node in nodes}
+            self._entries[realm_id] = (time.monotonic() + self.ttl, self._version(realm_id), definitions, None)
+            self._entries.move_to_end(realm_id)
+            while len(self._entries) > self.max_realms:
+                self._entries.popitem(last=False)
+                record_cache('custom_field_definitions', 'eviction')
+
+    def upsert(self, realm_id, node):
+        """Merge one definition from a mutation response into a cached realm"""
+        if not node.get('id'):
+            return
+        with self._lock:
+            entry = self._entries.get(realm_id)
+            outdated = entry is not None and entry[1] != self._version(realm_id)
+            # Other workers must drop their copy even if this one has none cached
+            version = self.versions.bump(realm_id) if self.versions is not None else 0
+            if entry is None:
+                return
+            expires_at, old_version, definitions, _ = entry
+            definitions[node['id']] = dict(definitions.get(node['id'], {}), **node)
+            # A copy that missed another worker's write stays outdated after this one
+            self._entries[realm_id] = (expires_at, old_version if outdated else version, definitions, None)
+
+    def index(self, realm_id):
+        """CustomFieldIndex of a realm's cached definitions, however old, or None if none are cached"""
+        with self._lock:
+            entry = self._entries.get(realm_id)
+            if entry is None:
+                return None
+            if entry[3] is None:
+                entry = self._entries[realm_id] = entry[:3] + (CustomFieldIndex(entry[2].values()),)
+            return entry[3]
+
+    def _version(self, realm_id):
+        return self.versions.get(realm_id) if self.versions is not None else 0
@@ -0,0 +1,86 @@
+# custom_field_index.py
+# Custom field definitions of one realm, pre-grouped for constant-time lookups by association and type
+
+from itertools import product
+
+TRANSACTION_ENTITY = '/transactions/Transaction'
+
+
+def summarize(node):
+    """Template/JSON record for one definition node, keeping every association"""
+    associations = []
+    for assoc in node.get('associations') or []:
+        if assoc.get('active') is False:
+            continue
+        associations.append({
+            'entity': assoc.get('associatedEntity', ''),
+            'sub_associations': [sub.get('associatedEntity', '') for sub in assoc.get('subAssociations') or []
+                                 if sub.get('active') is not False],
+            'required': bool((assoc.get('validationOptions') or {}).get('required')),
+        })
+    return {
+        'id': node['id'],
+        'legacyIDV2': node.get('legacyIDV2', ''),
+        'label': node['label'],
+        'active': bool(node.get('active')),
+        'data_type': node.get('dataType', ''),
+        'required': any(assoc['required'] for assoc in associations),
+        'associations': associations,
+        'transaction_types': [sub for assoc in associations if assoc['entity'] == TRANSACTION_ENTITY
+                              for sub in assoc['sub_associations']],
+        'selected': True,
+    }
+
+
+class CustomFieldIndex:
+    """Definition summaries grouped by every combination of filters, built once per definition refresh.
+
+    A lookup key is (active, associated entity, sub-association, data type,
+    required), where None in any position matches everything. Each
+    definition is filed under every key it satisfies, so `find` is one dict
+    lookup however many definitions the realm has. Results are in label
+    order.
+    """
+
+    def __init__(self, nodes):
+        self._by_key = {}
+        self.entities = set()
+        self.sub_associations = set()
+        self.data_types = set()
+        self._count = 0
+        for node in sorted(nodes, key=lambda node: node.get('label', '').lower()):
+            self._add(summarize(node))
+
+    def _add(self, summary):
+        self._count += 1
+        self.data_types.add(summary['data_type'])
+        targets = []
+        for assoc in summary['associations']:
+            self.entities.add(assoc['entity'])
+            targets.append((assoc['entity'], None, assoc['required']))
+            for sub in assoc['sub_associations']:
+                self.sub_associations.add(sub)
+                targets.append((assoc['entity'], sub, assoc['required']))
+        if not targets:
+            targets.append((None, None, False))
+        keys = set()
+        for entity, sub, required in targets:
+            keys.update(product((summary['active'], None), (entity, None), (sub, None),
+                                (summary['data_type'], None), (required, None)))
+        for key in keys:
+            self._by_key.setdefault(key, []).append(summary)
+
+    def __len__(self):
+        return self._count
+
+    def find(self, associated_entity=None, sub_association=None, data_type=None, active=None, required=None):
+        """Summaries matching every filter given; e.g. find(sub_association='SALE_INVOICE', data_type='STRING', active=True)"""
+        return list(self._by_key.get((active, associated_entity, sub_association, data_type, required), ()))
+
+    def facets(self):
+        """Filter values present in this realm's definitions"""
+        return {
+            'associated_entities': sorted(self.entities),
+            'sub_associations': sorted(self.sub_associations),
+            'data_types': sorted(self.data_types),
+        }
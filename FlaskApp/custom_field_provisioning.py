@@ -0,0 +1,273 @@
+# custom_field_provisioning.py
+# Manifest-driven custom field provisioning: diff a realm's definitions against a manifest, apply the difference
+
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from custom_field_mutations import apply_definitions
+
+REPORT_COLUMNS = ('realm_id', 'action', 'label', 'status', 'id', 'error')
+
+DATA_TYPES = ('STRING', 'NUMBER', 'DATE', 'DROPDOWN', 'BOOLEAN')
+
+# Where a definition is shown when its manifest entry lists no associations: on invoices
+DEFAULT_ASSOCIATIONS = ({'associatedEntity': '/transactions/Transaction', 'subAssociations': ['SALE_INVOICE'],
+                         'required': False},)
+
+
+class ManifestError(ValueError):
+    """A manifest that cannot be read or describes an invalid definition"""
+
+
+class Manifest:
+    """Desired custom field definitions, by case-insensitive label.
+
+    With `deactivate_unlisted`, active definitions the manifest does not
+    list are deactivated; otherwise they are left alone.
+    """
+
+    def __init__(self, definitions, deactivate_unlisted=False):
+        self.definitions = definitions
+        self.deactivate_unlisted = deactivate_unlisted
+
+    def __len__(self):
+        return len(self.definitions)
+
+
+def load_manifest(text, fmt='json'):
+    """Parse a JSON or YAML manifest; raises ManifestError.
+
+    A manifest is either a list of definitions or a mapping with a
+    `definitions` list and an optional `deactivate_unlisted` flag. Each
+    definition has a `label` and optionally `dataType` (default STRING),
+    `active` (default true), `dropDownOptions` (values, in display order)
+    and `associations` (`associatedEntity`, `subAssociations`, `required`).
+    """
+    if fmt in ('yaml', 'yml'):
+        try:
+            import yaml
+        except ImportError:
+            raise ManifestError("YAML manifests need PyYAML (pip install pyyaml); use JSON instead") from None
+        try:
+            document = yaml.safe_load(text)
+        except yaml.YAMLError as e:
+            raise ManifestError(f"Invalid YAML: {e}") from None
+    else:
+        try:
+            document = json.loads(text)
+        except ValueError as e:
+            raise ManifestError(f"Invalid JSON: {e}") from None
+
+    if isinstance(document, list):
+        document = {'definitions': document}
+    if not isinstance(document, dict) or not isinstance(document.get('definitions'), list):
+        raise ManifestError("Expected a list of definitions or a mapping with a 'definitions' list")
+
+    definitions = {}
+    for number, entry in enumerate(document['definitions'], start=1):
+        definition = _desired(entry, number)
+        key = definition['label'].casefold()
+        if key in definitions:
+            raise ManifestError(f"Definition {number}: label {definition['label']!r} is listed twice")
+        definitions[key] = definition
+    return Manifest(definitions, bool(document.get('deactivate_unlisted', False)))
+
+
+def manifest_format(filename):
+    """Manifest format implied by a file name: 'yaml' for .yaml/.yml, otherwise 'json'"""
+    return 'yaml' if filename.lower().endswith(('.yaml', '.yml')) else 'json'
+
+
+def _desired(entry, number):
+    """Normalized definition from one manifest entry"""
+    if not isinstance(entry, dict) or not isinstance(entry.get('label'), str) or not entry['label'].strip():
+        raise ManifestError(f"Definition {number}: expected a mapping with a non-empty 'label'")
+    label = entry['label'].strip()
+    data_type = str(entry.get('dataType', 'STRING')).upper()
+    if data_type not in DATA_TYPES:
+        raise ManifestError(f"{label}: dataType must be one of {', '.join(DATA_TYPES)}")
+    options = [str(value) for value in entry.get('dropDownOptions') or []]
+    if options and data_type != 'DROPDOWN':
+        raise ManifestError(f"{label}: dropDownOptions need dataType DROPDOWN")
+    if data_type == 'DROPDOWN' and not options:
+        raise ManifestError(f"{label}: a DROPDOWN definition needs dropDownOptions")
+    if len(set(options)) != len(options):
+        raise ManifestError(f"{label}: dropDownOptions are not unique")
+
+    associations = {}
+    for assoc in entry.get('associations') or DEFAULT_ASSOCIATIONS:
+        if not isinstance(assoc, dict) or not assoc.get('associatedEntity'):
+            raise ManifestError(f"{label}: each association needs an 'associatedEntity'")
+        associations[assoc['associatedEntity']] = (bool(assoc.get('required', False)),
+                                                   frozenset(assoc.get('subAssociations') or ()))
+    return {
+        'label': label,
+        'dataType': data_type,
+        'active': bool(entry.get('active', True)),
+        'dropDownOptions': tuple(options),
+        'associations': associations,
+    }
+
+
+def _current(node):
+    """A definition node in the same normalized shape as a manifest entry"""
+    associations = {}
+    for assoc in node.get('associations') or []:
+        if assoc.get('active') is False:
+            continue
+        associations[assoc.get('associatedEntity', '')] = (
+            bool((assoc.get('validationOptions') or {}).get('required')),
+            frozenset(sub.get('associatedEntity', '') for sub in assoc.get('subAssociations') or []
+                      if sub.get('active') is not False),
+        )
+    options = sorted((option for option in node.get('dropDownOptions') or [] if option.get('active') is not False),
+                     key=lambda option: option.get('order') or 0)
+    return {
+        'active': bool(node.get('active')),
+        'dropDownOptions': tuple(option.get('value', '') for option in options),
+        'associations': associations,
+    }
+
+
+def _association_input(entity, required, subs, active=True):
+    return {
+        'associatedEntity': entity,
+        'active': active,
+        'validationOptions': {'required': required},
+        'allowedOperations': [],
+        'associationCondition': 'INCLUDED',
+        'subAssociations': [{'associatedEntity': sub, 'active': active, 'allowedOperations': []}
+                            for sub in sorted(subs)],
+    }
+
+
+def _associations_input(desired, current=None):
+    """Association inputs for `desired`, ending the current ones it no longer lists"""
+    inputs = [_association_input(entity, required, subs) for entity, (required, subs) in desired.items()]
+    for entity, (required, subs) in (current or {}).items():
+        if entity not in desired:
+            inputs.append(_association_input(entity, required, subs, active=False))
+    return inputs
+
+
+def _options_input(desired, current=()):
+    """Dropdown option inputs in display order, ending the current ones no longer listed"""
+    inputs = [{'value': value, 'active': True, 'order': order} for order, value in enumerate(desired, start=1)]
+    inputs += [{'value': value, 'active': False, 'order': len(inputs) + order}
+               for order, value in enumerate((v for v in current if v not in desired), start=1)]
+    return inputs
+
+
+class Change:
+    """One row of a provisioning plan: `action` is create, update, reactivate, deactivate, unchanged or conflict"""
+
+    __slots__ = ('action', 'label', 'input', 'id', 'error')
+
+    def __init__(self, action, label, input=None, id='', error=''):
+        self.action = action
+        self.label = label
+        self.input = input
+        self.id = id
+        self.error = error
+
+
+def plan_changes(manifest, nodes):
+    """Changes that bring a realm's definition `nodes` in line with `manifest`, in label order"""
+    existing = {}
+    for node in nodes:
+        existing.setdefault(node.get('label', '').casefold(), node)
+
+    changes = []
+    for key, desired in manifest.definitions.items():
+        node = existing.get(key)
+        label = desired['label']
+        if node is None:
+            if not desired['active']:
+                changes.append(Change('unchanged', label))
+                continue
+            create = {
+                'label': label,
+                'dataType': desired['dataType'],
+                'active': True,
+                'associations': _associations_input(desired['associations']),
+            }
+            if desired['dropDownOptions']:
+                create['dropDownOptions'] = _options_input(desired['dropDownOptions'])
+            changes.append(Change('create', label, create))
+            continue
+
+        if (node.get('dataType') or 'STRING') != desired['dataType']:
+            changes.append(Change('conflict', node['label'], id=node['id'],
+                                  error=f"dataType is {node.get('dataType')}; QuickBooks cannot change it"))
+            continue
+        current = _current(node)
+        update = {'id': node['id'], 'legacyIDV2': node.get('legacyIDV2', ''), 'label': label,
+                  'active': desired['active']}
+        if not desired['active']:
+            action = 'deactivate' if current['active'] else 'unchanged'
+        else:
+            if desired['associations'] != current['associations']:
+                update['associations'] = _associations_input(desired['associations'], current['associations'])
+            if desired['dropDownOptions'] != current['dropDownOptions']:
+                update['dropDownOptions'] = _options_input(desired['dropDownOptions'], current['dropDownOptions'])
+            if not current['active']:
+                action = 'reactivate'
+            elif 'associations' in update or 'dropDownOptions' in update or label != node['label']:
+                action = 'update'
+            else:
+                action = 'unchanged'
+        changes.append(Change(action, label, update if action != 'unchanged' else None, node['id']))
+
+    if manifest.deactivate_unlisted:
+        for key, node in existing.items():
+            if key not in manifest.definitions and node.get('active'):
+                changes.append(Change('deactivate', node['label'], {
+                    'id': node['id'], 'legacyIDV2': node.get('legacyIDV2', ''), 'label': node['label'],
+                    'active': False,
+                }, node['id']))
+    changes.sort(key=lambda change: change.label.casefold())
+    return changes
+
+
+def apply_changes(api, changes, batch_size, concurrency):
+    """Send a plan's creates and updates as batched mutations.
+
+    Returns (change, node or None, errors) for every change with an input;
+    the node is the definition as it now stands, to merge into the cache.
+    """
+    creates = [change for change in changes if change.action == 'create']
+    updates = [change for change in changes if change.input is not None and change.action != 'create']
+    created, updated = apply_definitions(api, [change.input for change in creates],
+                                         [change.input for change in updates], batch_size, concurrency)
+    results = []
+    for change, (_, node, errors) in zip(creates, created):
+        results.append((change, node, errors))
+    for change, (update, node, errors) in zip(updates, updated):
+        # Updates return only id and active; the rest of the node is what was sent
+        results.append((change, dict(update, **node) if node else None, errors))
+    return results
+
+
+def report_row(realm_id, change, status, error=''):
+    return {'realm_id': realm_id, 'action': change.action, 'label': change.label, 'status': status,
+            'id': change.id, 'error': error or change.error}
+
+
+def provision_realms(realm_ids, provision_realm, concurrency):
+    """Yield report rows from `provision_realm(realm_id)` for each realm, realms running in parallel.
+
+    Rows of a realm are yielded together, in the order realms finish. A
+    realm whose provisioning raises gets one failed row.
+    """
+    if not realm_ids:
+        return
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(realm_ids)),
+                            thread_name_prefix='qb-provision') as executor:
+        futures = {executor.submit(provision_realm, realm_id): realm_id for realm_id in realm_ids}
+        for future in as_completed(futures):
+            try:
+                rows = future.result()
+            except Exception as e:
+                rows = [{'realm_id': futures[future], 'action': '', 'label': '', 'status': 'failed', 'id': '',
+                         'error': str(e)}]
+            yield from rows
@@ -0,0 +1,156 @@
+# graphql_operations.py
+# GraphQL documents and variable templates loaded, validated and pre-serialized once per process
+
+import copy
+import hashlib
+import json
+import os
+import re
+import threading
+
+from qb_logging import get_logger
+
+logger = get_logger('graphql_operations')
+
+_OPERATION_RE = re.compile(r"^\s*(?:(query|mutation)\b[^{]*)?\{", re.DOTALL)
+_ROOT_FIELD_RE = re.compile(r"\b(appFoundations\w+)")
+_COMMENT_RE = re.compile(r"#[^\n]*")
+
+
+class GraphQLOperationError(ValueError):
+    """A GraphQL document or variables template that cannot be used"""
+
+
+class Operation:
+    """One GraphQL document with its persisted-query hash and pre-encoded payload prefixes.
+
+    `payload` renders a request body without re-encoding the document, and
+    `persisted_payload` renders one that carries only the document's hash.
+    """
+
+    __slots__ = ('name', 'document', 'kind', 'root_field', 'sha256', '_full_prefix', '_persisted_prefix',
+                 '_extensions')
+
+    def __init__(self, name, document):
+        document = document.strip()
+        self.name = name
+        self.document = document
+        self.kind, self.root_field = _validate(name, document)
+        self.sha256 = hashlib.sha256(document.encode('utf-8')).hexdigest()
+        self._extensions = json.dumps(
+            {'persistedQuery': {'version': 1, 'sha256Hash': self.sha256}}, separators=(',', ':')).encode('utf-8')
+        self._full_prefix = b'{"query":' + json.dumps(document).encode('utf-8')
+        self._persisted_prefix = b'{"extensions":' + self._extensions
+
+    @property
+    def is_mutation(self):
+        return self.kind == 'mutation'
+
+    def payload(self, variables=None, persisted=False):
+        """JSON request body with the full document; with `persisted`, its hash is sent alongside"""
+        body = self._full_prefix
+        if persisted:
+            body += b',"extensions":' + self._extensions
+        return _with_variables(body, variables)
+
+    def persisted_payload(self, variables=None):
+        """JSON request body carrying only the document's hash"""
+        return _with_variables(self._persisted_prefix, variables)
+
+
+def _with_variables(prefix, variables):
+    if variables is None:
+        return prefix + b'}'
+    return prefix + b',"variables":' + json.dumps(variables, separators=(',', ':')).encode('utf-8') + b'}'
+
+
+def _validate(name, document):
+    """(operation kind, root field) of a single-operation document; raises GraphQLOperationError"""
+    text = _COMMENT_RE.sub('', document)
+    match = _OPERATION_RE.match(text)
+    if not match:
+        raise GraphQLOperationError(f"{name}: expected a query or mutation")
+    depth = 0
+    closed_at = None
+    for position, char in enumerate(text):
+        if char == '{':
+            depth += 1
+        elif char == '}':
+            depth -= 1
+            if depth < 0:
+                raise GraphQLOperationError(f"{name}: unbalanced braces")
+            if depth == 0 and closed_at is None:
+                closed_at = position
+    if depth != 0 or closed_at is None:
+        raise GraphQLOperationError(f"{name}: unbalanced braces")
+    if text[closed_at + 1:].strip():
+        raise GraphQLOperationError(f"{name}: expected exactly one operation")
+    root_field = _ROOT_FIELD_RE.search(text)
+    return match.group(1) or 'query', root_field.group(1) if root_field else None
+
+
+class OperationRegistry:
+    """Every `.graphql` document and `.json` variables template in a directory, by file stem.
+
+    Files are read and validated when the registry is built, so a broken
+    document fails at startup rather than on a request. With `hot_reload`
+    (development), a file whose mtime changed is read again on its next use.
+    """
+
+    def __init__(self, directory, hot_reload=False):
+        self.directory = directory
+        self.hot_reload = hot_reload
+        self._lock = threading.Lock()
+        self._operations = {}  # name -> (mtime_ns, Operation)
+        self._templates = {}   # name -> (mtime_ns, variables)
+        for filename in sorted(os.listdir(directory)):
+            stem, extension = os.path.splitext(filename)
+            if extension == '.graphql':
+                self._load_operation(stem)
+            elif extension == '.json':
+                self._load_template(stem)
+        logger.info("Loaded %d GraphQL operations and %d variable templates from %s",
+                    len(self._operations), len(self._templates), directory)
+
+    def _path(self, name, extension):
+        return os.path.join(self.directory, f"{name}{extension}")
+
+    def _load_operation(self, name):
+        path = self._path(name, '.graphql')
+        mtime = os.stat(path).st_mtime_ns
+        with open(path, 'r') as file:
+            operation = Operation(name, file.read())
+        self._operations[name] = (mtime, operation)
+        return operation
+
+    def _load_template(self, name):
+        path = self._path(name, '.json')
+        mtime = os.stat(path).st_mtime_ns
+        with open(path, 'r') as file:
+            try:
+                variables = json.load(file)
+            except ValueError as e:
+                raise GraphQLOperationError(f"{name}: {e}") from None
+        self._templates[name] = (mtime, variables)
+        return variables
+
+    def _current(self, entries, name, extension, load):
+        entry = entries.get(name)
+        if entry is None:
+            raise KeyError(f"No GraphQL {extension} file named {name!r} in {self.directory}")
+        if self.hot_reload and os.stat(self._path(name, extension)).st_mtime_ns != entry[0]:
+            with self._lock:
+                logger.info("Reloading %s%s", name, extension)
+                return load(name)
+        return entry[1]
+
+    def get(self, name):
+        """The Operation loaded from `<name>.graphql`"""
+        return self._current(self._operations, name, '.graphql', self._load_operation)
+
+    def variables(self, name):
+        """A fresh copy of the variables template loaded from `<name>.json`, safe to modify"""
+        return copy.deepcopy(self._current(self._templates, name, '.json', self._load_template))
+
+    def names(self):
+        return sorted(self._operations)
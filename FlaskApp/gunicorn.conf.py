@@ -0,0 +1,53 @@
+# gunicorn.conf.py
+# Multi-worker production settings; every value can be overridden from the environment
+
+import multiprocessing
+import os
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:5002')
+workers = int(os.getenv('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+# Routes spend most of their time waiting on QuickBooks, so each worker also runs threads.
+# GUNICORN_WORKER_CLASS=gevent is the async mode: sockets are patched to be non-blocking,
+# so a worker multiplexes up to `worker_connections` requests and their upstream calls.
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.getenv('GUNICORN_THREADS', '8'))
+if worker_class == 'gevent':
+    worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '1000'))
+    # Pool threads are greenlets in this mode, so fan-out and upstream keep-alive
+    # connections are no longer bounded by OS threads
+    os.environ.setdefault('QB_FETCH_WORKERS', '100')
+    os.environ.setdefault('QB_BACKGROUND_WORKERS', '20')
+    os.environ.setdefault('QB_HTTP_POOL_MAXSIZE', '100')
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '120'))
+# Each worker throttles itself to its share of QuickBooks' per-realm limits. Set QB_RATE_PROCESSES
+# to the total across hosts when several hosts serve the same realms.
+os.environ.setdefault('QB_RATE_PROCESSES', str(workers))
+keepalive = 5
+
+# Sessions, tokens and cache versions live under STATE_DIR, shared by all workers
+raw_env = [f"APP_ENV={os.getenv('APP_ENV', 'production')}"]
+
+# Prometheus metrics are aggregated across workers through files in this directory;
+# it must be set before any worker imports prometheus_client
+_state_dir = os.getenv('STATE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'state'))
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(_state_dir, 'prometheus'))
+
+
+def on_starting(server):
+    # Counters from a previous run must not leak into this one
+    metrics_dir = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    os.makedirs(metrics_dir, exist_ok=True)
+    for name in os.listdir(metrics_dir):
+        if name.endswith('.db'):
+            os.remove(os.path.join(metrics_dir, name))
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def worker_exit(server, worker):
+    # Close pooled upstream connections instead of leaving them to the OS
+    from services import close_app
+    close_app(worker.wsgi)
@@ -0,0 +1,181 @@
+# instrumentation.py
+# Per-request tracing of routes and upstream QuickBooks calls, Prometheus metrics and slow-request profiling
+
+import contextvars
+import cProfile
+import os
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+from flask import Response, g, request
+
+from qb_logging import get_logger
+
+logger = get_logger('instrumentation')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def metrics():
+    """Prometheus metrics, created (and prometheus_client imported) on first use"""
+    global _metrics
+    if _metrics is not None:
+        return _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            from prometheus_client import Counter, Histogram
+            _metrics = SimpleNamespace(
+                route_latency=Histogram(
+                    'qbo_route_duration_seconds', 'Time spent handling a route',
+                    ['route', 'method', 'status'], buckets=LATENCY_BUCKETS),
+                upstream_latency=Histogram(
+                    'qbo_upstream_duration_seconds', 'Time spent on an upstream QuickBooks call, including retries',
+                    ['operation', 'status'], buckets=LATENCY_BUCKETS),
+                upstream_bytes=Counter(
+                    'qbo_upstream_bytes_total', 'Bytes sent to and received from QuickBooks',
+                    ['operation', 'direction']),
+                upstream_retries=Counter(
+                    'qbo_upstream_retries_total', 'Upstream attempts that were retried',
+                    ['operation']),
+                rate_limit_wait=Histogram(
+                    'qbo_rate_limit_wait_seconds', 'Time calls waited for a slot in a realm budget',
+                    ['budget', 'priority'], buckets=(0.0, 0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)),
+                circuit_opened=Counter(
+                    'qbo_circuit_opened_total', 'Times a circuit breaker opened',
+                    ['operation']),
+                cache_events=Counter(
+                    'qbo_cache_events_total', 'In-process cache hits, misses and evictions',
+                    ['cache', 'event']),
+            )
+    return _metrics
+
+# Spans recorded for the request being handled; copied into worker threads explicitly
+_current_trace = contextvars.ContextVar('qbo_trace', default=None)
+
+
+class Trace:
+    """Upstream spans recorded while handling one request"""
+
+    __slots__ = ('started', 'spans')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = []
+
+    def server_timing(self):
+        """Server-Timing header value: total upstream time per operation"""
+        totals = {}
+        for span in self.spans:
+            totals[span['operation']] = totals.get(span['operation'], 0.0) + span['ms']
+        return ", ".join(
+            f"{operation.replace(':', '-')};dur={ms:.1f}" for operation, ms in totals.items()
+        )
+
+
+def record_upstream(operation, status, seconds, bytes_out, bytes_in, retries):
+    """Record one logical upstream call (all of its attempts)"""
+    status = str(status)
+    m = metrics()
+    m.upstream_latency.labels(operation, status).observe(seconds)
+    m.upstream_bytes.labels(operation, 'sent').inc(bytes_out)
+    m.upstream_bytes.labels(operation, 'received').inc(bytes_in)
+    if retries:
+        m.upstream_retries.labels(operation).inc(retries)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.spans.append({
+            'operation': operation, 'status': status, 'ms': round(seconds * 1000, 2),
+            'bytes_out': bytes_out, 'bytes_in': bytes_in, 'retries': retries,
+        })
+
+
+def record_rate_limit_wait(budget, priority, seconds):
+    metrics().rate_limit_wait.labels(budget, priority).observe(seconds)
+
+
+def record_circuit_open(operation):
+    metrics().circuit_opened.labels(operation).inc()
+    logger.warning("Circuit opened for %s", operation)
+
+
+def record_cache(cache, event):
+    """Count a 'hit', 'miss' or 'eviction' of one of the worker's caches"""
+    metrics().cache_events.labels(cache, event).inc()
+
+
+def metrics_view():
+    from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, generate_latest, multiprocess
+    metrics()
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+def init_app(app, slow_request_ms, profile_sample_rate, profile_dir):
+    """Trace every request, expose /metrics and optionally profile sampled slow requests.
+
+    A sampled request (probability `profile_sample_rate`) runs under cProfile;
+    if it takes longer than `slow_request_ms` its stats are written to
+    `profile_dir`.
+    """
+    if profile_sample_rate > 0:
+        os.makedirs(profile_dir, exist_ok=True)
+
+    @app.before_request
+    def start_trace():
+        g.qbo_trace = Trace()
+        g.qbo_trace_token = _current_trace.set(g.qbo_trace)
+        g.qbo_profiler = None
+        if profile_sample_rate > 0 and random.random() < profile_sample_rate:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+                g.qbo_profiler = profiler
+            except ValueError:
+                # Another profiler is already active in this interpreter
+                pass
+
+    @app.after_request
+    def finish_trace(response):
+        trace = g.get('qbo_trace')
+        if trace is None:
+            return response
+        seconds = time.perf_counter() - trace.started
+        # Labelled by view name without its blueprint, e.g. 'callback'
+        route = (request.endpoint or 'unmatched').rpartition('.')[2]
+        if route != 'metrics':
+            metrics().route_latency.labels(route, request.method, str(response.status_code)).observe(seconds)
+        if trace.spans:
+            response.headers['Server-Timing'] = trace.server_timing()
+
+        slow = seconds * 1000 >= slow_request_ms
+        profiler = g.get('qbo_profiler')
+        if profiler is not None:
+            profiler.disable()
+            if slow:
+                path = os.path.join(profile_dir, f"{int(time.time() * 1000)}-{route}-{os.getpid()}.prof")
+                profiler.dump_stats(path)
+                logger.info("Profiled slow request %s to %s", route, path)
+
+        log = logger.info if slow else logger.debug
+        log("Request trace", extra={
+            'route': route, 'status': response.status_code,
+            'duration_ms': round(seconds * 1000, 2), 'spans': list(trace.spans),
+        })
+        return response
+
+    @app.teardown_request
+    def reset_trace(exc):
+        token = g.pop('qbo_trace_token', None)
+        if token is not None:
+            _current_trace.reset(token)
+
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
@@ -0,0 +1,95 @@
+# page_cache.py
+# Rendered fragments cached by realm and data version, ETags for conditional GETs and gzip responses
+
+import gzip
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+from flask import request
+
+from instrumentation import record_cache
+
+# Response types worth compressing; images and downloads sent from files are left alone
+COMPRESSIBLE_MIMETYPES = frozenset((
+    'text/html', 'text/css', 'text/plain', 'text/csv', 'application/json', 'application/javascript',
+))
+
+
+def data_version(value):
+    """Short digest of JSON-serializable data, equal for equal data in any worker"""
+    encoded = json.dumps(value, sort_keys=True, separators=(',', ':'), default=str).encode('utf-8')
+    return hashlib.blake2b(encoded, digest_size=8).hexdigest()
+
+
+class RenderCache:
+    """Rendered markup by key, least recently used first out.
+
+    Keys carry the version of the data rendered, e.g. (realm_id, fragment,
+    data version), so entries never need invalidating: changed data gets a
+    new key and the old entry ages out.
+    """
+
+    def __init__(self, name, max_entries):
+        self.name = name
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get_or_render(self, key, render):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                record_cache(self.name, 'hit')
+                return value
+            record_cache(self.name, 'miss')
+        # Rendered outside the lock; two threads may render the same key once each
+        value = render()
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                record_cache(self.name, 'eviction')
+        return value
+
+
+def not_modified(response_etag):
+    """Whether the request's If-None-Match already names `response_etag` (a weak tag)"""
+    return request.if_none_match.contains_weak(response_etag)
+
+
+def init_app(app, min_bytes, level, cache_entries):
+    """Gzip responses of COMPRESSIBLE_MIMETYPES of at least `min_bytes` for clients that accept it.
+
+    Streamed responses (exports, bulk reports) and files are sent as they
+    are. A response with an ETag is compressed once: the compressed body
+    is kept, by ETag, for the next response with the same tag.
+    """
+    compressed = RenderCache('gzip_bodies', cache_entries)
+
+    @app.after_request
+    def compress(response):
+        if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+                or 'Content-Encoding' in response.headers
+                or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+            return response
+        response.vary.add('Accept-Encoding')
+        if not request.accept_encodings['gzip']:
+            return response
+        body = response.get_data()
+        if len(body) < min_bytes:
+            return response
+        etag, weak = response.get_etag()
+        if etag:
+            response.set_data(compressed.get_or_render(
+                (etag, weak), lambda: gzip.compress(body, compresslevel=level, mtime=0)))
+        else:
+            response.set_data(gzip.compress(body, compresslevel=level, mtime=0))
+        response.headers['Content-Encoding'] = 'gzip'
+        if etag and not weak:
+            # A strong tag names one exact byte sequence: the uncompressed one
+            response.set_etag(etag, weak=True)
+        return response
@@ -0,0 +1,321 @@
+# qb_client.py
+# Pooled, retrying HTTP transport for the QuickBooks REST, GraphQL and OAuth endpoints
+
+import random
+import re
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+from circuit_breaker import CircuitOpenError
+from instrumentation import record_rate_limit_wait, record_upstream
+from rate_limiter import INTERACTIVE, PRIORITY_NAMES, RateLimitError
+from qb_logging import get_logger
+from config import (
+    QB_CLIENT_ID, QB_CLIENT_SECRET, QB_BASE_URL, QB_OAUTH_URL, QB_GRAPHQL_URL,
+    QB_HTTP_POOL_CONNECTIONS, QB_HTTP_POOL_MAXSIZE, QB_HTTP_CONNECT_TIMEOUT,
+    QB_HTTP_READ_TIMEOUT, QB_HTTP_MAX_RETRIES, QB_HTTP_BACKOFF_FACTOR,
+    QB_HTTP_BACKOFF_MAX, QB_QUERY_PAGE_SIZE, get_headers
+)
+
+logger = get_logger('qb_client')
+
+# Status codes that are safe to retry. 429 means the request was throttled and
+# never processed, so it is retried for every method; 5xx responses are only
+# retried for idempotent calls so an invoice is never posted twice.
+RETRY_ON_THROTTLE = frozenset([429])
+RETRY_ON_SERVER_ERROR = frozenset([500, 502, 503, 504])
+
+_GRAPHQL_FIELD_RE = re.compile(r"\b(appFoundations\w+)")
+
+def _retry_after(resp):
+    """Seconds requested by a Retry-After header, or None"""
+    value = resp.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _backoff(attempt, resp=None):
+    """Delay before retry number `attempt` (0-based), honouring Retry-After"""
+    delay = _retry_after(resp) if resp is not None else None
+    if delay is None:
+        delay = QB_HTTP_BACKOFF_FACTOR * (2 ** attempt)
+        delay = random.uniform(delay / 2, delay)
+    return min(delay, QB_HTTP_BACKOFF_MAX)
+
+
+def operation_name(url, document=None):
+    """Low-cardinality name of an upstream call, e.g. v3:query or graphql:appFoundationsCustomFieldDefinitions"""
+    if url == QB_OAUTH_URL:
+        return "oauth:token"
+    if url == QB_GRAPHQL_URL:
+        match = _GRAPHQL_FIELD_RE.search(document or "")
+        return f"graphql:{match.group(1) if match else 'unknown'}"
+    # .../v3/company/<realm>/<resource>[/<id>]: name by resource, never by id
+    segments = urlsplit(url).path.rstrip('/').split('/')
+    resource = segments[-2] if segments[-1].isdigit() and len(segments) > 1 else segments[-1]
+    return f"v3:{resource}"
+
+
+def _body_size(body):
+    if body is None:
+        return 0
+    return len(body) if isinstance(body, (bytes, str)) else 0
+
+
+class Transport:
+    """Pooled sessions, per-realm rate limits and circuit breakers for one app's QuickBooks calls.
+
+    `limiter` is this process's share of the per-realm call budgets and
+    `breakers` holds one breaker per upstream operation (v3 resource,
+    GraphQL root field, OAuth). With `persisted_queries`, registered GraphQL
+    operations are sent as hashes until the server reports it does not
+    support them. One keep-alive session is kept per host.
+    """
+
+    def __init__(self, limiter, breakers, persisted_queries=False):
+        self.limiter = limiter
+        self.breakers = breakers
+        self.persisted_queries = persisted_queries
+        self._sessions = {}
+        self._sessions_lock = threading.Lock()
+
+    def session(self, url):
+        """Return the pooled keep-alive session for the host of the given URL"""
+        host = urlsplit(url).netloc
+        http = self._sessions.get(host)
+        if http is not None:
+            return http
+        with self._sessions_lock:
+            http = self._sessions.get(host)
+            if http is None:
+                # requests is imported by the first call, not when a worker boots
+                import requests
+                from requests.adapters import HTTPAdapter
+                http = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=QB_HTTP_POOL_CONNECTIONS,
+                    pool_maxsize=QB_HTTP_POOL_MAXSIZE,
+                    max_retries=0
+                )
+                http.mount("https://", adapter)
+                http.mount("http://", adapter)
+                self._sessions[host] = http
+        return http
+
+    def close(self):
+        """Close every pooled session, e.g. when a worker shuts down"""
+        with self._sessions_lock:
+            for http in self._sessions.values():
+                http.close()
+            self._sessions.clear()
+
+    def send(self, method, url, idempotent=None, timeout=None, operation=None, realm_id=None,
+             priority=INTERACTIVE, deadline=None, **kwargs):
+        """Send a request over the pooled session for the URL's host.
+
+        Retries throttled (429) responses for every call, and 5xx responses and
+        connection errors for idempotent calls, with exponential backoff. The
+        call, including its retries, is recorded as one upstream `operation`.
+
+        Calls made for a `realm_id` first wait for a slot in the realm's REST or
+        GraphQL budget at `priority`; a 429 pauses that budget for the
+        Retry-After period instead of sleeping here. Raises RateLimitError if no
+        slot frees up in time.
+
+        Each operation has a circuit breaker: while it is open the call raises
+        CircuitOpenError without touching the network. With `deadline`, the
+        whole call (waits, attempts and backoff) is bounded by that many
+        seconds and raises requests.Timeout once it runs out.
+        """
+        import requests
+        if idempotent is None:
+            idempotent = method.upper() in ("GET", "HEAD", "OPTIONS")
+        if timeout is None:
+            timeout = (QB_HTTP_CONNECT_TIMEOUT, QB_HTTP_READ_TIMEOUT)
+        if operation is None:
+            operation = operation_name(url)
+        retry_statuses = RETRY_ON_THROTTLE | RETRY_ON_SERVER_ERROR if idempotent else RETRY_ON_THROTTLE
+        budget = None
+        if realm_id is not None and url != QB_OAUTH_URL:
+            budget = "graphql" if url == QB_GRAPHQL_URL else "v3"
+        breaker = self.breakers.get(operation)
+        expires_at = time.monotonic() + deadline if deadline is not None else None
+
+        def remaining():
+            if expires_at is None:
+                return None
+            left = expires_at - time.monotonic()
+            if left <= 0:
+                raise requests.exceptions.Timeout(f"{operation} did not complete within {deadline}s")
+            return left
+
+        def can_wait(delay):
+            return expires_at is None or time.monotonic() + delay < expires_at
+
+        http = self.session(url)
+        attempt = 0
+        status = "error"
+        bytes_out = bytes_in = 0
+        started = time.perf_counter()
+        try:
+            while True:
+                try:
+                    breaker.before_call()
+                except CircuitOpenError:
+                    status = "circuit_open"
+                    raise
+                if budget is not None:
+                    try:
+                        waited = self.limiter.acquire(realm_id, budget, priority, max_wait=remaining())
+                        record_rate_limit_wait(budget, PRIORITY_NAMES[priority], waited)
+                    except RateLimitError:
+                        status = "rate_limited"
+                        raise
+                left = remaining()
+                attempt_timeout = timeout if left is None else (min(timeout[0], left), min(timeout[1], left))
+                try:
+                    resp = http.request(method, url, timeout=attempt_timeout, **kwargs)
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                    breaker.record_failure()
+                    delay = _backoff(attempt)
+                    if not idempotent or attempt >= QB_HTTP_MAX_RETRIES or not can_wait(delay):
+                        raise
+                    logger.info("Retrying %s %s after connection error (attempt %d)", method, urlsplit(url).path, attempt + 1)
+                    time.sleep(delay)
+                    attempt += 1
+                    continue
+                bytes_out += _body_size(resp.request.body)
+                if resp.status_code in RETRY_ON_SERVER_ERROR:
+                    breaker.record_failure()
+                elif resp.status_code not in RETRY_ON_THROTTLE:
+                    breaker.record_success()
+                delay = _backoff(attempt, resp)
+                if resp.status_code not in retry_statuses or attempt >= QB_HTTP_MAX_RETRIES or not can_wait(delay):
+                    status = resp.status_code
+                    bytes_in += len(resp.content)
+                    return resp
+                logger.info("Retrying %s %s after HTTP %d (attempt %d)", method, urlsplit(url).path, resp.status_code, attempt + 1)
+                if budget is not None and resp.status_code == 429:
+                    self.limiter.throttle(realm_id, budget, delay)
+                else:
+                    time.sleep(delay)
+                resp.close()
+                attempt += 1
+        finally:
+            record_upstream(operation, status, time.perf_counter() - started, bytes_out, bytes_in, attempt)
+
+    def request_token(self, data):
+        """POST a grant to the OAuth token endpoint"""
+        headers = {
+            "Accept": "application/json",
+            "Content-Type": "application/x-www-form-urlencoded"
+        }
+        return self.send("POST", QB_OAUTH_URL, headers=headers, data=data,
+                         auth=(QB_CLIENT_ID, QB_CLIENT_SECRET))
+
+
+class QuickBooksAPI:
+    """QuickBooks calls made on behalf of one realm, sent over an app's Transport"""
+
+    def __init__(self, transport, token, realm_id, priority=INTERACTIVE, deadline=None):
+        self.transport = transport
+        self.token = token
+        self.realm_id = realm_id
+        self.priority = priority  # rate limiter priority class for this API's calls
+        self.deadline = deadline  # seconds each call may take in total, including retries
+        access_token = token['access_token'] if isinstance(token, dict) else token
+        self.headers = get_headers(access_token)
+
+    def url(self, endpoint):
+        """Resolve an endpoint relative to the realm's v3 company URL"""
+        if endpoint.startswith("http://") or endpoint.startswith("https://"):
+            return endpoint
+        return f"{QB_BASE_URL}/{self.realm_id}/{endpoint.lstrip('/')}"
+
+    def make_request(self, method, endpoint, data=None, params=None, headers=None, idempotent=None,
+                     operation=None, body=None):
+        """Send `data` as JSON, or an already encoded JSON `body`, to `endpoint` and return the response"""
+        request_headers = dict(self.headers)
+        if headers:
+            request_headers.update(headers)
+        return self.transport.send(method, self.url(endpoint), idempotent=idempotent, operation=operation,
+                                   realm_id=self.realm_id, priority=self.priority, deadline=self.deadline,
+                                   params=params, json=data, data=body, headers=request_headers)
+
+    def query(self, query, endpoint="query"):
+        """Run a QBO SQL-like query against the v3 query endpoint"""
+        return self.make_request("GET", endpoint, params={"query": query})
+
+    def iter_query(self, query, entity, page_size=QB_QUERY_PAGE_SIZE, start=1, endpoint="query"):
+        """Yield pages of `entity` records, walking STARTPOSITION/MAXRESULTS from `start`.
+
+        `endpoint` may carry extra parameters, e.g. "query?minorversion=75".
+        Raises requests.HTTPError if a page request fails.
+        """
+        while True:
+            resp = self.query(f"{query} STARTPOSITION {start} MAXRESULTS {page_size}", endpoint)
+            resp.raise_for_status()
+            page = resp.json().get('QueryResponse', {}).get(entity, [])
+            if page:
+                yield page
+            if len(page) < page_size:
+                return
+            start += page_size
+
+    def graphql(self, query, variables=None):
+        """POST a GraphQL document or registered Operation; read-only operations are retried on 5xx.
+
+        For an Operation, only its hash is sent while persisted queries are
+        enabled; on a cache miss the full document follows with the hash so
+        the server can register it.
+        """
+        if not isinstance(query, str):
+            return self._graphql_operation(query, variables)
+        payload = {"query": query}
+        if variables is not None:
+            payload["variables"] = variables
+        idempotent = not query.lstrip().startswith("mutation")
+        return self.make_request("POST", QB_GRAPHQL_URL, data=payload, idempotent=idempotent,
+                                 operation=operation_name(QB_GRAPHQL_URL, query))
+
+    def _graphql_operation(self, operation, variables):
+        options = dict(idempotent=not operation.is_mutation,
+                       operation=f"graphql:{operation.root_field or 'unknown'}")
+        if not self.transport.persisted_queries:
+            return self.make_request("POST", QB_GRAPHQL_URL, body=operation.payload(variables), **options)
+        resp = self.make_request("POST", QB_GRAPHQL_URL, body=operation.persisted_payload(variables), **options)
+        miss = _persisted_query_miss(resp)
+        if miss is None:
+            return resp
+        if miss == 'not_supported':
+            logger.warning("GraphQL server does not support persisted queries; sending full documents")
+            self.transport.persisted_queries = False
+        return self.make_request("POST", QB_GRAPHQL_URL, body=operation.payload(variables, persisted=True),
+                                 **options)
+
+
+def _persisted_query_miss(resp):
+    """'not_found' or 'not_supported' if the server could not resolve a persisted-query hash, else None"""
+    if b'ersistedQuery' not in resp.content and b'PERSISTED_QUERY' not in resp.content:
+        return None
+    try:
+        errors = resp.json().get('errors') or []
+    except ValueError:
+        return None
+    for error in errors:
+        code = (error.get('extensions') or {}).get('code') or error.get('message')
+        if code in ('PERSISTED_QUERY_NOT_FOUND', 'PersistedQueryNotFound'):
+            return 'not_found'
+        if code in ('PERSISTED_QUERY_NOT_SUPPORTED', 'PersistedQueryNotSupported'):
+            return 'not_supported'
+    return None
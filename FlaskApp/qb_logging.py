@@ -0,0 +1,144 @@
+# qb_logging.py
+# Structured, leveled logging through a background queue, with body truncation and secret redaction
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import re
+import sys
+from datetime import datetime, timezone
+
+# Keys whose values never reach the log, wherever they appear in a payload
+SECRET_KEYS = frozenset([
+    'access_token', 'refresh_token', 'id_token', 'client_secret', 'code',
+    'authorization', 'password', 'secret_key',
+])
+_SECRET_JSON_RE = re.compile(
+    r'("(?:access_token|refresh_token|id_token|client_secret)"\s*:\s*")[^"]*(")', re.IGNORECASE)
+_BEARER_RE = re.compile(r'(Bearer\s+)[A-Za-z0-9\-._~+/]+=*', re.IGNORECASE)
+REDACTED = '***'
+
+# Maximum characters of a payload rendered into a log line
+body_limit = 2048
+
+
+def redact(value):
+    """Copy of a payload with secret values masked"""
+    if isinstance(value, dict):
+        return {
+            k: REDACTED if str(k).lower() in SECRET_KEYS else redact(v)
+            for k, v in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        return [redact(v) for v in value]
+    if isinstance(value, str):
+        return _BEARER_RE.sub(r'\1' + REDACTED, _SECRET_JSON_RE.sub(r'\1' + REDACTED + r'\2', value))
+    return value
+
+
+def truncate(text, limit):
+    if len(text) <= limit:
+        return text
+    return f"{text[:limit]}... [{len(text) - limit} more chars]"
+
+
+class Body:
+    """A payload or response that is only rendered if its log line is emitted.
+
+    Accepts a requests.Response, a string or any JSON-serialisable value; the
+    rendered text is redacted and truncated to `body_limit` characters.
+    """
+
+    __slots__ = ('value', 'limit')
+
+    def __init__(self, value, limit=None):
+        self.value = value
+        self.limit = limit
+
+    def __str__(self):
+        value = self.value
+        if hasattr(value, 'text') and hasattr(value, 'status_code'):
+            value = value.text
+        if isinstance(value, str):
+            text = redact(value)
+        else:
+            text = json.dumps(redact(value), default=str)
+        return truncate(text, self.limit or body_limit)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; `extra` fields become top-level keys"""
+
+    RESERVED = frozenset(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | {'message', 'asctime'}
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'msg': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in self.RESERVED:
+                entry[key] = redact(value)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Never blocks the request thread: records are dropped when the queue is full"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Resolve the message and traceback here; JSON encoding and I/O happen on the listener
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener = None
+
+
+def configure_logging(level='INFO', fmt='json', queue_size=10000, max_body=2048):
+    """Route the `qbo` logger hierarchy through a background writer thread"""
+    global _listener, body_limit
+    if _listener is not None:
+        return
+    body_limit = max_body
+
+    stream = logging.StreamHandler(sys.stdout)
+    if fmt == 'json':
+        stream.setFormatter(JsonFormatter())
+    else:
+        stream.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+
+    log_queue = queue.Queue(maxsize=queue_size)
+    _listener = logging.handlers.QueueListener(log_queue, stream)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+    root = logging.getLogger('qbo')
+    root.setLevel(level.upper())
+    root.addHandler(DroppingQueueHandler(log_queue))
+    root.propagate = False
+
+
+def get_logger(name):
+    return logging.getLogger(f'qbo.{name}')
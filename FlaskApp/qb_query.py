@@ -0,0 +1,36 @@
+# qb_query.py
+# Projected QBO queries that decode straight into lightweight typed records
+
+from collections import namedtuple
+
+from config import QB_QUERY_PAGE_SIZE
+
+# Reference records carry only the columns the views use; the field names are
+# the QBO column names, so each type is also the projection its query selects
+CustomerRef = namedtuple('CustomerRef', ['Id', 'DisplayName'])
+ItemRef = namedtuple('ItemRef', ['Id', 'Name'])
+
+
+def select(entity, fields, where=None, order_by=None):
+    """QBO query text selecting only `fields` of `entity`"""
+    query = f"SELECT {', '.join(fields)} FROM {entity}"
+    if where:
+        query += f" WHERE {where}"
+    if order_by:
+        query += f" ORDERBY {order_by}"
+    return query
+
+
+def to_record(record_type, row):
+    """Typed record from a response row; columns QBO omitted are empty strings"""
+    return record_type._make(row.get(field, '') for field in record_type._fields)
+
+
+def iter_records(api, entity, record_type, where=None, order_by=None, page_size=QB_QUERY_PAGE_SIZE, start=1):
+    """Yield pages of `record_type` records from position `start`, selecting only that type's fields.
+
+    Raises requests.HTTPError if a page request fails.
+    """
+    query = select(entity, record_type._fields, where, order_by)
+    for page in api.iter_query(query, entity, page_size, start):
+        yield [to_record(record_type, row) for row in page]
@@ -0,0 +1,123 @@
+# rate_limiter.py
+# Per-realm token buckets for QuickBooks calls, with priority-ordered bounded wait queues
+
+import heapq
+import itertools
+import threading
+import time
+
+# Priority classes, most urgent first: page loads, background index/sync work, bulk jobs
+INTERACTIVE = 0
+BACKGROUND = 1
+BULK = 2
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', BACKGROUND: 'background', BULK: 'bulk'}
+
+
+class RateLimitError(Exception):
+    """A call could not get a slot in time, or too many calls were already waiting"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _Bucket:
+    """Token bucket for one realm and API, refilled lazily"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.waiters = []  # heap of (priority, sequence)
+        self.cond = threading.Condition()
+
+    def delay(self, now):
+        """Seconds until a call may start"""
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """Client-side throttle for each realm, with a separate budget per API.
+
+    `budgets` maps an API name ('v3', 'graphql') to (requests per minute,
+    burst) for a realm across the deployment; with `processes` workers each
+    limiter spends an equal share, so together they stay within the budget.
+    Calls that cannot start immediately wait in a per-bucket queue ordered
+    by priority class, then arrival. A full queue or a wait longer than
+    `max_wait` raises RateLimitError. A 429 from QuickBooks pauses the whole
+    bucket for the Retry-After period via `throttle`.
+    """
+
+    def __init__(self, budgets, max_waiters, max_wait, processes=1):
+        self.budgets = {api: (per_minute / processes, max(1, burst // processes))
+                        for api, (per_minute, burst) in budgets.items()}
+        self.max_waiters = max_waiters
+        self.max_wait = max_wait
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._sequence = itertools.count()
+
+    def _bucket(self, realm_id, api):
+        key = (realm_id, api)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            with self._lock:
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    per_minute, burst = self.budgets[api]
+                    bucket = self._buckets[key] = _Bucket(per_minute / 60.0, burst)
+        return bucket
+
+    def acquire(self, realm_id, api, priority=INTERACTIVE, max_wait=None):
+        """Wait for a call slot, at most `max_wait` (default the limiter's); returns the seconds waited"""
+        bucket = self._bucket(realm_id, api)
+        with bucket.cond:
+            started = time.monotonic()
+            if not bucket.waiters and bucket.delay(started) == 0:
+                bucket.tokens -= 1
+                return 0.0
+            if len(bucket.waiters) >= self.max_waiters:
+                raise RateLimitError(f"Too many queued QuickBooks {api} calls for realm {realm_id}",
+                                     bucket.delay(started))
+
+            entry = (priority, next(self._sequence))
+            heapq.heappush(bucket.waiters, entry)
+            deadline = started + (self.max_wait if max_wait is None else min(max_wait, self.max_wait))
+            try:
+                while True:
+                    now = time.monotonic()
+                    delay = bucket.delay(now)
+                    if bucket.waiters[0] == entry and delay == 0:
+                        heapq.heappop(bucket.waiters)
+                        bucket.tokens -= 1
+                        bucket.cond.notify_all()
+                        return now - started
+                    if now >= deadline:
+                        raise RateLimitError(f"Timed out waiting for a QuickBooks {api} slot for realm {realm_id}",
+                                             delay)
+                    # The head waits for the next token; everyone else until the head moves on
+                    timeout = delay if bucket.waiters[0] == entry else deadline - now
+                    bucket.cond.wait(min(timeout, deadline - now))
+            except BaseException:
+                if entry in bucket.waiters:
+                    bucket.waiters.remove(entry)
+                    heapq.heapify(bucket.waiters)
+                    bucket.cond.notify_all()
+                raise
+
+    def throttle(self, realm_id, api, seconds):
+        """Hold every call for a realm's API for `seconds`, e.g. after a 429"""
+        bucket = self._bucket(realm_id, api)
+        with bucket.cond:
+            now = time.monotonic()
+            bucket.blocked_until = max(bucket.blocked_until, now + seconds)
+            # Refill starts again once the pause is over
+            bucket.tokens = 0.0
+            bucket.updated = bucket.blocked_until
+            bucket.cond.notify_all()
@@ -0,0 +1,224 @@
+# reference_index.py
+# In-memory per-realm prefix index over customers and items for dropdown typeahead
+
+import re
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+
+from instrumentation import record_cache
+from qb_logging import get_logger
+
+logger = get_logger('reference_index')
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text):
+    """Lowercased word tokens of a display name or search string"""
+    return _TOKEN_RE.findall((text or "").lower())
+
+
+class ReferenceIndex:
+    """Prefix index over typed reference records (see qb_query).
+
+    Records are added a page at a time while the upstream query is still
+    streaming; searches always see a consistent snapshot and never block on
+    a page being merged. An index whose stream broke off is marked `failed`
+    and is never complete.
+    """
+
+    def __init__(self, label_key):
+        self.label_key = label_key
+        self.complete = False
+        self.failed = False
+        self._lock = threading.Lock()
+        self._records = {}
+        self._tokens = []  # sorted (token, record id) pairs
+
+    def __len__(self):
+        return len(self._records)
+
+    @property
+    def streaming(self):
+        """Whether pages are still being added"""
+        return not self.complete and not self.failed
+
+    def add(self, records):
+        """Merge a batch of records into the index"""
+        with self._lock:
+            merged_records = dict(self._records)
+            merged_tokens = list(self._tokens)
+            for record in records:
+                record_id = record.Id
+                if record_id in merged_records:
+                    continue
+                merged_records[record_id] = record
+                for token in set(tokenize(getattr(record, self.label_key))):
+                    merged_tokens.append((token, record_id))
+            merged_tokens.sort()
+            # Swap both snapshots so readers never see a half-merged page
+            self._records, self._tokens = merged_records, merged_tokens
+
+    def update(self, records, removed_ids=()):
+        """Replace or add `records` and drop `removed_ids`, e.g. to apply a sync delta"""
+        with self._lock:
+            touched = {record.Id for record in records} | set(removed_ids)
+            merged_records = {k: v for k, v in self._records.items() if k not in touched}
+            merged_tokens = [t for t in self._tokens if t[1] not in touched]
+            for record in records:
+                merged_records[record.Id] = record
+                for token in set(tokenize(getattr(record, self.label_key))):
+                    merged_tokens.append((token, record.Id))
+            merged_tokens.sort()
+            self._records, self._tokens = merged_records, merged_tokens
+
+    def records(self):
+        """Every indexed record, in the order it was added"""
+        return list(self._records.values())
+
+    def search(self, text, limit=20):
+        """Records whose label has a word starting with every search term"""
+        records, tokens = self._records, self._tokens
+        terms = tokenize(text)
+        if not terms:
+            return list(records.values())[:limit]
+
+        first, rest = terms[0], terms[1:]
+        results = []
+        seen = set()
+        pos = bisect_left(tokens, (first,))
+        while pos < len(tokens) and len(results) < limit:
+            token, record_id = tokens[pos]
+            if not token.startswith(first):
+                break
+            pos += 1
+            if record_id in seen:
+                continue
+            seen.add(record_id)
+            record = records[record_id]
+            if rest:
+                words = tokenize(getattr(record, self.label_key))
+                if not all(any(w.startswith(t) for w in words) for t in rest):
+                    continue
+            results.append(record)
+        return results
+
+
+class IndexRegistry:
+    """Current index per (realm, source), replaced on every login.
+
+    At most `max_entries` indexes are kept, evicting the least recently used
+    one, and an index nobody has read for `ttl` seconds is dropped, so a
+    worker's memory follows the realms in use rather than every realm that
+    ever logged in. A dropped index is rebuilt from the realm's snapshot.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # (realm_id, source) -> (last used, monotonic seconds; index)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, realm_id, source):
+        """The current index for a realm's reference source, or None"""
+        with self._lock:
+            return self._get(realm_id, source)
+
+    def set(self, realm_id, source, index):
+        """Make `index` the current index for a realm's reference source"""
+        with self._lock:
+            self._set(realm_id, source, index)
+
+    def get_or_create(self, realm_id, source, create):
+        """(index, created): the current index, or a new one from `create()` registered in its place"""
+        with self._lock:
+            index = self._get(realm_id, source)
+            if index is not None:
+                return index, False
+            index = create()
+            self._set(realm_id, source, index)
+            return index, True
+
+    def discard(self, realm_id, source, index):
+        """Unregister `index` if it is still the current index for a realm's reference source"""
+        with self._lock:
+            entry = self._entries.get((realm_id, source))
+            if entry is not None and entry[1] is index:
+                del self._entries[(realm_id, source)]
+
+    def _get(self, realm_id, source):
+        key = (realm_id, source)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        now = time.monotonic()
+        if now - entry[0] > self.ttl:
+            del self._entries[key]
+            record_cache('reference_indexes', 'eviction')
+            return None
+        self._entries[key] = (now, entry[1])
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def _set(self, realm_id, source, index):
+        key = (realm_id, source)
+        self._entries[key] = (time.monotonic(), index)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            record_cache('reference_indexes', 'eviction')
+
+
+def _stream_into(indexes, index, pages, realm_id, source, on_complete=None):
+    try:
+        for page in pages:
+            index.add(page)
+    except Exception:
+        # Unregister the partial index so the next login or search loads the source again
+        index.failed = True
+        indexes.discard(realm_id, source, index)
+        logger.warning("Exception indexing %s for realm %s", source, realm_id, exc_info=True)
+        return
+    index.complete = True
+    logger.info("Indexed %d %s for realm %s", len(index), source, realm_id)
+    if on_complete is not None:
+        try:
+            on_complete(index)
+        except Exception:
+            logger.warning("Exception saving %s for realm %s", source, realm_id, exc_info=True)
+
+
+def load_index(indexes, realm_id, source, label_key, pages, executor, first_page_size=10, on_complete=None):
+    """Start indexing a stream of record pages for a realm.
+
+    The first page is indexed synchronously and its leading records are
+    returned for the initial render; the remaining pages are streamed into
+    the index on `executor`, which calls `on_complete(index)` once all are in.
+    If a later page fails, the index is marked failed and unregistered.
+    """
+    first_page = next(pages, [])
+    index = ReferenceIndex(label_key)
+    index.add(first_page)
+    indexes.set(realm_id, source, index)
+    executor.submit(_stream_into, indexes, index, pages, realm_id, source, on_complete)
+    return first_page[:first_page_size]
+
+
+def get_or_load_index(indexes, realm_id, source, label_key, load_pages, executor, on_complete=None):
+    """Index for a realm's source, starting a background load if this worker has none.
+
+    Each worker keeps its own index, so a worker that did not handle the
+    login builds one on the first search it receives.
+    """
+    index, created = indexes.get_or_create(realm_id, source, lambda: ReferenceIndex(label_key))
+    if created:
+        def pages():
+            # Built on the executor, so a failure to start the query also fails the index
+            yield from load_pages()
+        executor.submit(_stream_into, indexes, index, pages(), realm_id, source, on_complete)
+    return index
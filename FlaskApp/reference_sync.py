@@ -0,0 +1,316 @@
+# reference_sync.py
+# Persisted per-realm reference snapshots kept current with QBO Change Data Capture and webhooks
+
+import base64
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+
+from qb_client import QuickBooksAPI
+from qb_logging import get_logger
+from qb_query import QB_QUERY_PAGE_SIZE, iter_records, to_record
+from rate_limiter import BACKGROUND
+from reference_index import ReferenceIndex, get_or_load_index, load_index
+from token_manager import FileLock
+
+logger = get_logger('reference_sync')
+
+# QBO only reports changes from the last 30 days, at most 1000 objects per entity per call
+CDC_MAX_AGE = 30 * 24 * 3600
+CDC_MAX_RESULTS = 1000
+# Each delta re-reads a little before the previous sync so changes committed during it are not missed
+CDC_OVERLAP = 60
+
+# A synced reference source: QBO entity, typed record (also the projection) and label column
+ReferenceSource = namedtuple('ReferenceSource', ['entity', 'record_type', 'label_key', 'where'])
+
+
+class SnapshotStore:
+    """Per-realm JSON snapshots of reference records, shared by every worker on the host.
+
+    A snapshot maps each source name to {'synced_at': epoch seconds,
+    'records': [[column, ...], ...]}.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    def _path(self, realm_id):
+        return os.path.join(self.directory, f"{realm_id}.json")
+
+    def load(self, realm_id):
+        try:
+            with open(self._path(realm_id), 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def version(self, realm_id):
+        """Changes whenever any worker writes the realm's snapshot; None if there is none"""
+        try:
+            return os.stat(self._path(realm_id)).st_mtime_ns
+        except OSError:
+            return None
+
+    def update(self, realm_id, change):
+        """Apply `change(snapshot)` under the realm's file lock and write the result atomically"""
+        with FileLock(os.path.join(self.directory, f"{realm_id}.lock")):
+            snapshot = self.load(realm_id)
+            change(snapshot)
+            path = self._path(realm_id)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as file:
+                json.dump(snapshot, file, separators=(',', ':'))
+            os.replace(tmp_path, path)
+
+
+class ReferenceSync:
+    """Serves reference data from persisted snapshots and keeps them current with deltas.
+
+    A realm's first login streams each source from QBO as before and saves
+    the result. Later logins, in any worker, build the index from the
+    snapshot and schedule a background CDC call that applies only what
+    changed since the last sync; webhooks schedule the same call. Sources
+    whose snapshot is older than the CDC window, or whose delta overflows a
+    CDC response, are reloaded in full in the background.
+    """
+
+    def __init__(self, sources, store, indexes, transport, executor, token_provider, min_interval, deadline=None):
+        self.sources = sources
+        self.store = store
+        self.indexes = indexes  # this worker's IndexRegistry
+        self.transport = transport  # the app's qb_client.Transport
+        self.executor = executor
+        self.token_provider = token_provider
+        self.min_interval = min_interval
+        self.deadline = deadline  # seconds a login may wait for a source with no snapshot
+        self._lock = threading.Lock()
+        self._versions = {}  # (realm, source) -> snapshot version the in-memory index reflects
+        self._running = set()
+        self._pending = set()
+        self._last_requested = {}
+
+    # Reads
+
+    def load(self, token, realm_id, source, first_page_size=10):
+        """Index a realm's source at login and return its first few records.
+
+        Without a usable snapshot the first page is read now, within the
+        `deadline`; if that fails, a snapshot past the CDC window is served
+        instead. Raises only if there is none.
+        """
+        index = self._index_from_snapshot(realm_id, source)
+        if index is not None:
+            self.request_sync(realm_id)
+            return index.records()[:first_page_size]
+        spec = self.sources[source]
+        started = time.time()
+        # Only the first page is rendered; the rest streams in behind page loads with no deadline
+        pages = _first_page_then_rest(QuickBooksAPI(self.transport, token, realm_id, deadline=self.deadline),
+                                      QuickBooksAPI(self.transport, token, realm_id, priority=BACKGROUND), spec)
+        try:
+            first_records = load_index(self.indexes, realm_id, source, spec.label_key, pages, self.executor, first_page_size,
+                                       on_complete=lambda index: self._save(realm_id, source, index.records(), started))
+        except Exception:
+            index = self._index_from_snapshot(realm_id, source, max_age=None)
+            if index is None:
+                raise
+            logger.warning("Serving stale %s for realm %s", source, realm_id, exc_info=True)
+            return index.records()[:first_page_size]
+        return first_records
+
+    def index(self, token, realm_id, source):
+        """Current index for a realm's source, loading it in the background if there is none"""
+        index = self._index_from_snapshot(realm_id, source)
+        if index is not None:
+            return index
+        spec = self.sources[source]
+        started = time.time()
+
+        def pages():
+            api = QuickBooksAPI(self.transport, token, realm_id, priority=BACKGROUND)
+            return iter_records(api, spec.entity, spec.record_type, where=spec.where)
+        return get_or_load_index(self.indexes, realm_id, source, spec.label_key, pages, self.executor,
+                                 on_complete=lambda index: self._save(realm_id, source, index.records(), started))
+
+    def _index_from_snapshot(self, realm_id, source, max_age=CDC_MAX_AGE):
+        """This worker's index if it is streaming or reflects the snapshot, else one rebuilt from it.
+
+        Returns the worker's complete index, or None, without a usable
+        snapshot; a failed index is never returned.
+        """
+        key = (realm_id, source)
+        version = self.store.version(realm_id)
+        index = self.indexes.get(realm_id, source)
+        if index is not None and (index.streaming or index.complete and self._versions.get(key) == version):
+            return index
+        entry = self.store.load(realm_id).get(source)
+        if not entry or (max_age is not None and time.time() - entry['synced_at'] > max_age):
+            return index if index is not None and index.complete else None
+        spec = self.sources[source]
+        index = ReferenceIndex(spec.label_key)
+        index.add([spec.record_type._make(row) for row in entry['records']])
+        index.complete = True
+        self.indexes.set(realm_id, source, index)
+        self._versions[key] = version
+        return index
+
+    # Writes
+
+    def _save(self, realm_id, source, records, synced_at):
+        def change(snapshot):
+            snapshot[source] = {'synced_at': synced_at, 'records': [list(r) for r in records]}
+        self.store.update(realm_id, change)
+        self._versions[(realm_id, source)] = self.store.version(realm_id)
+        logger.info("Saved %d %s for realm %s", len(records), source, realm_id)
+
+    def _apply(self, realm_id, source, changed, removed_ids, synced_at):
+        """Merge a delta into the realm's snapshot and this worker's index"""
+        def change(snapshot):
+            entry = snapshot.get(source)
+            if not entry:
+                return
+            records = {row[0]: row for row in entry['records'] if row[0] not in removed_ids}
+            for record in changed:
+                records[record.Id] = list(record)
+            entry['records'] = list(records.values())
+            entry['synced_at'] = synced_at
+        self.store.update(realm_id, change)
+        index = self.indexes.get(realm_id, source)
+        if index is not None and index.complete:
+            index.update(changed, removed_ids)
+            self._versions[(realm_id, source)] = self.store.version(realm_id)
+
+    # Background sync
+
+    def request_sync(self, realm_id, force=False):
+        """Schedule a delta sync for a realm; coalesces with one already running.
+
+        Unless `force` is set, a realm is synced at most once per `min_interval`.
+        """
+        with self._lock:
+            now = time.monotonic()
+            last = self._last_requested.get(realm_id)
+            if not force and last is not None and now - last < self.min_interval:
+                return False
+            self._last_requested[realm_id] = now
+            if realm_id in self._running:
+                self._pending.add(realm_id)
+                return True
+            self._running.add(realm_id)
+        self.executor.submit(self._run, realm_id)
+        return True
+
+    def _run(self, realm_id):
+        while True:
+            try:
+                self.sync(realm_id)
+            except Exception:
+                logger.warning("Exception syncing reference data for realm %s", realm_id, exc_info=True)
+            with self._lock:
+                if realm_id not in self._pending:
+                    self._running.discard(realm_id)
+                    return
+                self._pending.discard(realm_id)
+
+    def sync(self, realm_id):
+        """Bring the realm's snapshot up to date with one CDC call"""
+        token = self.token_provider(realm_id)
+        if token is None:
+            logger.info("No stored token for realm %s; skipping reference sync", realm_id)
+            return
+        api = QuickBooksAPI(self.transport, token, realm_id, priority=BACKGROUND)
+        snapshot = self.store.load(realm_id)
+        started = time.time()
+        deltas = {}
+        for source, entry in snapshot.items():
+            if source not in self.sources:
+                continue
+            if started - entry['synced_at'] > CDC_MAX_AGE:
+                self._reload(api, source)
+            else:
+                deltas[self.sources[source].entity] = source
+        if not deltas:
+            return
+
+        since = min(snapshot[source]['synced_at'] for source in deltas.values()) - CDC_OVERLAP
+        resp = api.make_request("GET", "cdc", params={
+            'entities': ','.join(deltas),
+            'changedSince': datetime.fromtimestamp(since, timezone.utc).isoformat(timespec='seconds'),
+        })
+        resp.raise_for_status()
+        for entity, rows in _cdc_changes(resp.json()).items():
+            source = deltas.get(entity)
+            if source is None:
+                continue
+            if len(rows) >= CDC_MAX_RESULTS:
+                # Only the first page of changes was returned
+                self._reload(api, source)
+                continue
+            record_type = self.sources[source].record_type
+            changed = []
+            removed_ids = set()
+            for row in rows:
+                if row.get('status') == 'Deleted' or row.get('Active') is False:
+                    removed_ids.add(row['Id'])
+                else:
+                    changed.append(to_record(record_type, row))
+            self._apply(realm_id, source, changed, removed_ids, started)
+            logger.info("Synced %s for realm %s: %d changed, %d removed",
+                        source, realm_id, len(changed), len(removed_ids))
+
+    def _reload(self, api, source):
+        spec = self.sources[source]
+        started = time.time()
+        records = [r for page in iter_records(api, spec.entity, spec.record_type, where=spec.where) for r in page]
+        index = ReferenceIndex(spec.label_key)
+        index.add(records)
+        index.complete = True
+        self._save(api.realm_id, source, records, started)
+        self.indexes.set(api.realm_id, source, index)
+
+
+def _first_page_then_rest(first_api, rest_api, spec):
+    """Record pages of a source, the first read through `first_api` and the others through `rest_api`"""
+    first_page = next(iter_records(first_api, spec.entity, spec.record_type, where=spec.where), [])
+    yield first_page
+    if len(first_page) == QB_QUERY_PAGE_SIZE:
+        yield from iter_records(rest_api, spec.entity, spec.record_type, where=spec.where,
+                                start=len(first_page) + 1)
+
+
+def _cdc_changes(resp_json):
+    """Changed rows per entity name from a CDC response"""
+    changes = {}
+    for cdc in resp_json.get('CDCResponse', []):
+        for query_response in cdc.get('QueryResponse', []):
+            for entity, rows in query_response.items():
+                if isinstance(rows, list):
+                    changes.setdefault(entity, []).extend(rows)
+    return changes
+
+
+def verify_webhook(body, signature, verifier_token):
+    """True if `signature` (the intuit-signature header) is the HMAC-SHA256 of `body`"""
+    if not verifier_token or not signature:
+        return False
+    digest = hmac.new(verifier_token.encode('utf-8'), body, hashlib.sha256).digest()
+    return hmac.compare_digest(base64.b64encode(digest).decode('ascii'), signature)
+
+
+def webhook_changes(payload):
+    """Changed entity names per realm from a webhook notification"""
+    changes = {}
+    for notification in payload.get('eventNotifications', []):
+        realm_id = notification.get('realmId')
+        entities = (notification.get('dataChangeEvent') or {}).get('entities', [])
+        if realm_id:
+            changes.setdefault(realm_id, set()).update(e.get('name') for e in entities)
+    return changes
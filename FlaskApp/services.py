@@ -0,0 +1,148 @@
+# services.py
+# Subsystems of one app instance, each built on first use so workers boot without touching them
+
+import threading
+
+from flask import current_app
+
+
+class lazy:
+    """Like functools.cached_property, but builds at most once per instance across threads"""
+
+    def __init__(self, build):
+        self.build = build
+        self.name = build.__name__
+        self.__doc__ = build.__doc__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        with instance._lock:
+            if self.name not in instance.__dict__:
+                instance.__dict__[self.name] = self.build(instance)
+            return instance.__dict__[self.name]
+
+
+class Services:
+    """Thread pools, QuickBooks transport, token store, caches and GraphQL operations used by an app's routes.
+
+    Each is built, with its imports and directories, the first time a
+    request needs it; once built it is a plain instance attribute.
+    Background work captures the instances it uses, so it never needs an
+    app context.
+    """
+
+    NAMES = ('fetch_executor', 'background_executor', 'transport', 'bulk_slots', 'token_manager', 'definition_cache',
+             'graphql_operations', 'reference_sync', 'render_cache')
+
+    def __init__(self, config):
+        self.config = config
+        self._lock = threading.RLock()  # builders may need other services
+
+    def build_all(self):
+        """Build every subsystem now, e.g. to surface configuration errors at startup"""
+        for name in self.NAMES:
+            getattr(self, name)
+
+    @lazy
+    def fetch_executor(self):
+        """Bounded pool shared by all requests in this process for independent upstream reads"""
+        from concurrent.futures import ThreadPoolExecutor
+        return ThreadPoolExecutor(max_workers=self.config['QB_FETCH_WORKERS'], thread_name_prefix='qb-fetch')
+
+    @lazy
+    def background_executor(self):
+        """Pool for work no page load waits on: index streams, syncs, refreshes and export prefetch.
+
+        Kept apart from `fetch_executor` so long paginations never queue a login's reads.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        return ThreadPoolExecutor(max_workers=self.config['QB_BACKGROUND_WORKERS'],
+                                  thread_name_prefix='qb-background')
+
+    @lazy
+    def transport(self):
+        """Pooled sessions, this process's share of the per-realm rate budgets and circuit breakers"""
+        from circuit_breaker import CircuitBreakers
+        from instrumentation import record_circuit_open
+        from qb_client import Transport
+        from rate_limiter import RateLimiter
+        limiter = RateLimiter(
+            {'v3': (self.config['QB_RATE_V3_PER_MINUTE'], self.config['QB_RATE_V3_BURST']),
+             'graphql': (self.config['QB_RATE_GRAPHQL_PER_MINUTE'], self.config['QB_RATE_GRAPHQL_BURST'])},
+            self.config['QB_RATE_MAX_WAITERS'], self.config['QB_RATE_MAX_WAIT'], self.config['QB_RATE_PROCESSES'])
+        breakers = CircuitBreakers(self.config['QB_BREAKER_FAILURE_THRESHOLD'], self.config['QB_BREAKER_RESET_TIMEOUT'],
+                                   on_open=record_circuit_open)
+        return Transport(limiter, breakers, self.config['QB_GRAPHQL_PERSISTED_QUERIES'])
+
+    @lazy
+    def bulk_slots(self):
+        """Batch requests in flight per realm, shared by every bulk invoice job"""
+        from bulk_invoices import RealmSlots
+        return RealmSlots(self.config['QB_REALM_MAX_CONCURRENCY'])
+
+    @lazy
+    def token_manager(self):
+        """Refreshes access tokens before they expire, one refresh per realm at a time"""
+        from token_manager import TokenManager
+        return TokenManager(self.config['TOKEN_STORE_DIR'], self.config['TOKEN_REFRESH_MARGIN'],
+                            self.transport.request_token, self.config['TOKEN_REFRESH_RETRY_INTERVAL'])
+
+    @lazy
+    def definition_cache(self):
+        """Custom field definitions shared by every route that reads or changes them"""
+        from custom_field_cache import CustomFieldDefinitionCache, SharedVersions
+        return CustomFieldDefinitionCache(self.config['CUSTOM_FIELD_CACHE_TTL'],
+                                          self.config['CUSTOM_FIELD_CACHE_MAX_REALMS'],
+                                          SharedVersions(self.config['CUSTOM_FIELD_CACHE_VERSION_DIR']))
+
+    @lazy
+    def graphql_operations(self):
+        """GraphQL documents and variable templates, read and validated once"""
+        from graphql_operations import OperationRegistry
+        return OperationRegistry(self.config['GRAPHQL_DIR'], hot_reload=self.config['GRAPHQL_HOT_RELOAD'])
+
+    @lazy
+    def reference_sync(self):
+        """Customers and items, synced into per-realm snapshots; only the columns the templates render are kept"""
+        from qb_query import CustomerRef, ItemRef
+        from reference_index import IndexRegistry
+        from reference_sync import ReferenceSource, ReferenceSync, SnapshotStore
+        return ReferenceSync(
+            {
+                'customers': ReferenceSource('Customer', CustomerRef, 'DisplayName', "Active = true"),
+                'items': ReferenceSource('Item', ItemRef, 'Name', "Active = true"),
+            },
+            SnapshotStore(self.config['REFERENCE_SNAPSHOT_DIR']),
+            IndexRegistry(self.config['REFERENCE_INDEX_MAX_ENTRIES'], self.config['REFERENCE_INDEX_TTL']),
+            self.transport,
+            self.background_executor,
+            self.token_manager.stored_token,
+            self.config['REFERENCE_SYNC_MIN_INTERVAL'],
+            self.config['QB_REFERENCE_DEADLINE'],
+        )
+
+    @lazy
+    def render_cache(self):
+        """Dashboard fragments rendered for a realm's data, shared by every session on the realm"""
+        from page_cache import RenderCache
+        return RenderCache('dashboard_fragments', self.config['RENDER_CACHE_MAX_ENTRIES'])
+
+
+def init_app(app):
+    app.extensions['qbo'] = services = Services(app.config)
+    if not app.config['APP_LAZY_INIT']:
+        services.build_all()
+    return services
+
+
+def close_app(app):
+    """Close the pooled upstream sessions of an app, if any were opened, e.g. when a worker shuts down"""
+    services = app.extensions['qbo']
+    if 'transport' in services.__dict__:
+        services.transport.close()
+
+
+def services():
+    """The current app's Services"""
+    return current_app.extensions['qbo']
@@ -0,0 +1,41 @@
+# session_store.py
+# Server-side file sessions, rewritten only when they change or their expiry is due to be extended
+
+import time
+
+from flask_session.sessions import FileSystemSessionInterface
+
+
+class FileSessionInterface(FileSystemSessionInterface):
+    """Flask-Session's file store without a write on every request.
+
+    Flask-Session pickles the whole session to disk and resets its cookie
+    on each request, even a page view that changed nothing. Here an
+    unchanged session is written again only `refresh_after` seconds after
+    its last write, so its expiry still slides with use, to within that
+    margin. Values must be reassigned, not mutated in place, to be saved.
+    """
+
+    WRITTEN_AT = '_written_at'
+
+    def __init__(self, *args, refresh_after, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.refresh_after = refresh_after
+
+    @classmethod
+    def from_app(cls, app, refresh_after):
+        """Built from the same settings, and defaults, as Flask-Session's filesystem interface"""
+        config = app.config
+        return cls(config.get('SESSION_FILE_DIR'), config.get('SESSION_FILE_THRESHOLD', 500),
+                   config.get('SESSION_FILE_MODE', 0o600), config.get('SESSION_KEY_PREFIX', 'session:'),
+                   config.get('SESSION_USE_SIGNER', False), config.get('SESSION_PERMANENT', True),
+                   refresh_after=refresh_after)
+
+    def save_session(self, app, session, response):
+        now = time.time()
+        if session and not session.modified and now - session.get(self.WRITTEN_AT, 0) < self.refresh_after:
+            return
+        if session:
+            # Bookkeeping, not a change: set without marking the session modified
+            dict.__setitem__(session, self.WRITTEN_AT, now)
+        super().save_session(app, session, response)
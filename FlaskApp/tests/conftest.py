@@ -0,0 +1,11 @@
+# conftest.py
+# The app imports its modules by flat name, as when run from FlaskApp
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Sessions, tokens and snapshots of apps built by the tests stay out of the checkout
+os.environ.setdefault('STATE_DIR', tempfile.mkdtemp(prefix='qbo-tests-'))
@@ -0,0 +1,116 @@
+# test_bulk_invoices.py
+# Batching uploaded rows into /batch requests and mapping the results back to rows
+
+import io
+import json
+import threading
+
+import pytest
+
+from bulk_invoices import RealmSlots, create_invoices, iter_rows
+
+HEADER = "customer_id,item_id,item_name,amount,custom_field_id,custom_field_value\n"
+
+
+def csv_line(n):
+    return f"{n},1,Hours,{n}.50,1,PO-{n}\n"
+
+
+class FakeResponse:
+    status_code = 200
+    text = ''
+
+    def __init__(self, body):
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+class FakeBatchAPI:
+    """Answers /batch creates; customer ids in `rejected` get a Fault"""
+
+    def __init__(self, rejected=()):
+        self.realm_id = f"realm-{id(self)}"
+        self.rejected = set(rejected)
+        self.batches = []  # bIds of every batch sent
+        self._lock = threading.Lock()
+
+    def make_request(self, method, endpoint, data=None):
+        items = data['BatchItemRequest']
+        with self._lock:
+            self.batches.append([item['bId'] for item in items])
+        responses = []
+        for item in items:
+            if item['Invoice']['CustomerRef']['value'] in self.rejected:
+                responses.append({'bId': item['bId'], 'Fault': {'Error': [{'Message': 'Invalid Reference Id'}]}})
+            else:
+                responses.append({'bId': item['bId'], 'Invoice': {'Id': f"inv-{item['bId']}"}})
+        return FakeResponse({'BatchItemResponse': responses})
+
+
+def upload(text):
+    return io.BytesIO(text.encode('utf-8') if isinstance(text, str) else text)
+
+
+def test_rows_are_batched_and_results_map_back_to_their_rows():
+    api = FakeBatchAPI(rejected={'7'})
+    rows = iter_rows(upload(HEADER + ''.join(csv_line(n) for n in range(1, 66))), 'csv')
+
+    results = list(create_invoices(api, rows, batch_size=30, realm_slots=RealmSlots(2)))
+
+    assert sorted(len(batch) for batch in api.batches) == [5, 30, 30]
+    assert [result['row'] for result in results] == list(range(1, 66))
+    assert results[0] == {'row': 1, 'status': 'created', 'invoice_id': 'inv-1', 'error': ''}
+    assert results[6]['status'] == 'error' and results[6]['error'] == 'Invalid Reference Id'
+    assert sum(result['status'] == 'created' for result in results) == 64
+
+
+def test_batch_size_is_capped_at_the_quickbooks_limit():
+    api = FakeBatchAPI()
+    rows = iter_rows(upload(HEADER + ''.join(csv_line(n) for n in range(1, 41))), 'csv')
+
+    list(create_invoices(api, rows, batch_size=100, realm_slots=RealmSlots(1)))
+
+    assert [len(batch) for batch in api.batches] == [30, 10]
+
+
+def test_bad_ndjson_lines_are_reported_against_their_row_only():
+    lines = [
+        json.dumps({'customer_id': '1', 'item_id': '1', 'item_name': 'Hours', 'amount': 10,
+                    'custom_field_id': '1', 'custom_field_value': 'PO-1'}),
+        '{"customer_id": ',
+        '[1, 2, 3]',
+        '"just a string"',
+        json.dumps({'customer_id': '2', 'item_id': '1', 'amount': 'ten', 'custom_field_id': '1'}),
+        json.dumps({'item_id': '1', 'amount': 5, 'custom_field_id': '1'}),
+        '',
+        json.dumps({'customer_id': '3', 'item_id': '1', 'item_name': 'Hours', 'amount': 30,
+                    'custom_field_id': '1', 'custom_field_value': 'PO-3'}),
+    ]
+    api = FakeBatchAPI()
+
+    results = list(create_invoices(api, iter_rows(upload('\n'.join(lines)), 'ndjson'), 30, RealmSlots(1)))
+
+    assert [(result['row'], result['status']) for result in results] == [
+        (2, 'invalid'), (3, 'invalid'), (4, 'invalid'), (5, 'invalid'), (6, 'invalid'),
+        (1, 'created'), (8, 'created'),
+    ]
+    assert 'JSON object' in results[1]['error']
+
+
+def test_an_unreadable_upload_reports_every_row_already_sent_before_aborting():
+    # 200 rows with bytes that are not UTF-8 on row 151
+    body = (HEADER + ''.join(csv_line(n) for n in range(1, 151))).encode('utf-8') + b"151,1,\xff\xfe,1,1,x\n"
+    body += ''.join(csv_line(n) for n in range(152, 201)).encode('utf-8')
+    api = FakeBatchAPI()
+    results = []
+
+    with pytest.raises(UnicodeDecodeError):
+        for result in create_invoices(api, iter_rows(upload(body), 'csv'), batch_size=30, realm_slots=RealmSlots(2)):
+            results.append(result)
+
+    sent = sorted(int(number) for batch in api.batches for number in batch)
+    assert sent == list(range(1, 151))
+    assert sorted(result['row'] for result in results) == sent
+    assert all(result['status'] == 'created' for result in results)
@@ -0,0 +1,115 @@
+# test_circuit_breaker.py
+# Breaker state transitions: closed -> open -> half-open -> closed or open again
+
+import pytest
+
+import circuit_breaker
+from circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitBreakers, CircuitOpenError
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(circuit_breaker.time, 'monotonic', clock)
+    return clock
+
+
+@pytest.fixture
+def opened():
+    return []
+
+
+@pytest.fixture
+def breaker(clock, opened):
+    return CircuitBreaker('graphql', failure_threshold=3, reset_timeout=30, on_open=opened.append)
+
+
+def trip(breaker):
+    for _ in range(breaker.failure_threshold):
+        breaker.before_call()
+        breaker.record_failure()
+
+
+def test_opens_after_consecutive_failures_only(breaker, opened):
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+    breaker.before_call()
+
+    breaker.record_failure()
+
+    assert breaker.state == OPEN
+    assert opened == ['graphql']
+
+
+def test_open_breaker_fails_fast_until_the_reset_timeout(breaker, clock):
+    trip(breaker)
+    clock.now += 10
+
+    with pytest.raises(CircuitOpenError) as raised:
+        breaker.before_call()
+    assert raised.value.retry_after == pytest.approx(20)
+    assert raised.value.name == 'graphql'
+
+
+def test_one_trial_call_is_let_through_after_the_timeout(breaker, clock):
+    trip(breaker)
+    clock.now += 30
+
+    breaker.before_call()
+    assert breaker.state == HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+def test_successful_trial_closes_the_breaker(breaker, clock):
+    trip(breaker)
+    clock.now += 30
+    breaker.before_call()
+
+    breaker.record_success()
+
+    assert breaker.state == CLOSED and breaker.failures == 0
+    breaker.before_call()
+
+
+def test_failed_trial_opens_the_breaker_again(breaker, clock, opened):
+    trip(breaker)
+    clock.now += 30
+    breaker.before_call()
+
+    breaker.record_failure()
+
+    assert breaker.state == OPEN and opened == ['graphql', 'graphql']
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+def test_a_lost_trial_lets_another_through_after_the_next_timeout(breaker, clock):
+    trip(breaker)
+    clock.now += 30
+    breaker.before_call()
+
+    clock.now += 30
+    breaker.before_call()
+    assert breaker.state == HALF_OPEN
+
+
+def test_breakers_are_kept_per_endpoint(clock):
+    breakers = CircuitBreakers(failure_threshold=1, reset_timeout=30)
+    breakers.get('v3').record_failure()
+
+    assert breakers.get('v3') is breakers.get('v3')
+    assert breakers.get('v3').state == OPEN
+    assert breakers.get('graphql').state == CLOSED
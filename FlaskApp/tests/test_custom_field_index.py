@@ -0,0 +1,46 @@
+# test_custom_field_index.py
+# Lookups over a realm's custom field definitions, and the slice of them kept in the session
+
+from flask import session
+
+from app import create_app, store_custom_fields
+from custom_field_index import CustomFieldIndex
+
+INVOICE = '/transactions/Transaction'
+
+
+def definition(id, label, active=True, data_type='STRING', subs=('SALE_INVOICE',)):
+    """A definition node as the AppFoundations query returns it"""
+    return {
+        'id': f'def-{id}', 'legacyIDV2': id, 'label': label, 'active': active, 'dataType': data_type,
+        'associations': [{'associatedEntity': INVOICE, 'active': True, 'validationOptions': {'required': False},
+                          'subAssociations': [{'associatedEntity': sub, 'active': True} for sub in subs]}],
+    }
+
+
+NODES = [
+    definition('3', 'po number'),
+    definition('1', 'Region', data_type='NUMBER'),
+    definition('2', 'Project', subs=('SALE_ESTIMATE',)),
+    definition('4', 'Legacy', active=False),
+]
+
+
+def test_find_filters_on_every_key_in_label_order():
+    index = CustomFieldIndex(NODES)
+
+    assert len(index) == 4
+    assert [field['label'] for field in index.find(active=True)] == ['po number', 'Project', 'Region']
+    assert [field['label'] for field in index.find(sub_association='SALE_INVOICE', data_type='STRING',
+                                                   active=True)] == ['po number']
+    assert index.find(sub_association='SALE_ORDER') == []
+    assert index.facets()['data_types'] == ['NUMBER', 'STRING']
+
+
+def test_the_session_keeps_only_the_id_and_label_of_each_definition():
+    with create_app().test_request_context('/'):
+        active = store_custom_fields(CustomFieldIndex(NODES))
+
+        assert active == [{'legacyIDV2': '3', 'label': 'po number'}, {'legacyIDV2': '2', 'label': 'Project'},
+                          {'legacyIDV2': '1', 'label': 'Region'}]
+        assert session['invoice_custom_fields'] == [{'legacyIDV2': '3', 'label': 'po number'}]
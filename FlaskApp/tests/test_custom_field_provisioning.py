@@ -0,0 +1,201 @@
+# test_custom_field_provisioning.py
+# Planning a manifest against a realm's definitions and applying the plan as batched mutations
+
+import io
+import json
+import time
+
+import pytest
+
+import app as app_module
+from app import create_app
+from custom_field_provisioning import ManifestError, apply_changes, load_manifest, plan_changes
+
+INVOICE = '/transactions/Transaction'
+
+
+def definition(id, label, active=True, data_type='STRING', subs=('SALE_INVOICE',), options=()):
+    """A definition node as the AppFoundations query returns it"""
+    return {
+        'id': id, 'legacyIDV2': id, 'label': label, 'active': active, 'dataType': data_type,
+        'associations': [{'associatedEntity': INVOICE, 'active': True, 'validationOptions': {'required': False},
+                          'subAssociations': [{'associatedEntity': sub, 'active': True} for sub in subs]}],
+        'dropDownOptions': [{'value': value, 'active': True, 'order': order}
+                            for order, value in enumerate(options, start=1)],
+    }
+
+
+def manifest(*definitions, deactivate_unlisted=False):
+    return load_manifest(json.dumps({'definitions': list(definitions), 'deactivate_unlisted': deactivate_unlisted}))
+
+
+def actions(changes):
+    return [(change.action, change.label) for change in changes]
+
+
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, body):
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+class FakeGraphQL:
+    """Answers aliased create and update mutations; inputs labelled in `rejected` get a field error"""
+
+    def __init__(self, rejected=()):
+        self.rejected = set(rejected)
+        self.operations = []
+
+    def graphql(self, operation, variables):
+        self.operations.append(operation.name)
+        prefix = 'c' if operation.name.startswith('Create') else 'u'
+        data, errors = {}, []
+        for name, value in variables.items():
+            alias = prefix + name[len('input'):]
+            if value['label'] in self.rejected:
+                data[alias] = None
+                errors.append({'message': 'Duplicate label', 'path': [alias]})
+            elif prefix == 'c':
+                data[alias] = dict(value, id=f"new-{value['label']}", legacyIDV2='')
+            else:
+                data[alias] = {'id': value['id'], 'active': value['active']}
+        return FakeResponse({'data': data, 'errors': errors})
+
+
+def test_plan_matches_labels_case_insensitively_and_leaves_matching_definitions_alone():
+    changes = plan_changes(manifest({'label': 'po number'}), [definition('1', 'PO Number')])
+
+    assert actions(changes) == [('update', 'po number')]
+    assert changes[0].input == {'id': '1', 'legacyIDV2': '1', 'label': 'po number', 'active': True}
+
+    changes = plan_changes(manifest({'label': 'PO Number'}), [definition('1', 'PO Number')])
+    assert actions(changes) == [('unchanged', 'PO Number')]
+    assert changes[0].input is None
+
+
+def test_plan_creates_reactivates_deactivates_and_reports_conflicts_in_label_order():
+    changes = plan_changes(manifest(
+        {'label': 'Region', 'dataType': 'DROPDOWN', 'dropDownOptions': ['East', 'West']},
+        {'label': 'Archived', 'active': False},
+        {'label': 'Cost Center'},
+        {'label': 'Due', 'dataType': 'DATE'},
+        {'label': 'Never Created', 'active': False},
+    ), [
+        definition('1', 'Archived'),
+        definition('2', 'Cost Center', active=False),
+        definition('3', 'Due', data_type='NUMBER'),
+    ])
+
+    assert actions(changes) == [('deactivate', 'Archived'), ('reactivate', 'Cost Center'), ('conflict', 'Due'),
+                                ('unchanged', 'Never Created'), ('create', 'Region')]
+    create = changes[-1].input
+    assert create['dataType'] == 'DROPDOWN'
+    assert create['dropDownOptions'] == [{'value': 'East', 'active': True, 'order': 1},
+                                         {'value': 'West', 'active': True, 'order': 2}]
+    assert create['associations'][0]['subAssociations'][0]['associatedEntity'] == 'SALE_INVOICE'
+    assert 'cannot change' in changes[2].error
+
+
+def test_plan_ends_options_and_associations_the_manifest_drops():
+    changes = plan_changes(manifest(
+        {'label': 'Region', 'dataType': 'DROPDOWN', 'dropDownOptions': ['West', 'North'],
+         'associations': [{'associatedEntity': INVOICE, 'subAssociations': ['SALE_ESTIMATE']}]},
+    ), [definition('1', 'Region', data_type='DROPDOWN', options=('East', 'West'))])
+
+    [change] = changes
+    assert change.action == 'update'
+    assert change.input['dropDownOptions'] == [{'value': 'West', 'active': True, 'order': 1},
+                                               {'value': 'North', 'active': True, 'order': 2},
+                                               {'value': 'East', 'active': False, 'order': 3}]
+    [association] = change.input['associations']
+    assert [sub['associatedEntity'] for sub in association['subAssociations']] == ['SALE_ESTIMATE']
+
+
+def test_plan_deactivates_unlisted_definitions_only_when_asked():
+    nodes = [definition('1', 'Listed'), definition('2', 'Unlisted'), definition('3', 'Inactive', active=False)]
+
+    assert actions(plan_changes(manifest({'label': 'Listed'}), nodes)) == [('unchanged', 'Listed')]
+    assert actions(plan_changes(manifest({'label': 'Listed'}, deactivate_unlisted=True), nodes)) == [
+        ('unchanged', 'Listed'), ('deactivate', 'Unlisted')]
+
+
+@pytest.mark.parametrize('text', [
+    '{"definitions": [{"label": "A"}, {"label": "a"}]}',
+    '[{"label": "A", "dataType": "DROPDOWN"}]',
+    '[{"label": "A", "dropDownOptions": ["x"]}]',
+    '[{"label": "A", "dataType": "MONEY"}]',
+    '{"label": "A"}',
+    'not json',
+])
+def test_invalid_manifests_are_rejected(text):
+    with pytest.raises(ManifestError):
+        load_manifest(text)
+
+
+def test_apply_batches_creates_and_updates_and_reports_each_result():
+    changes = plan_changes(manifest(
+        {'label': 'A'}, {'label': 'B'}, {'label': 'C'}, {'label': 'Dup'}, {'label': 'Old', 'active': False},
+    ), [definition('9', 'Old')])
+    api = FakeGraphQL(rejected={'Dup'})
+
+    results = apply_changes(api, changes, batch_size=2, concurrency=2)
+
+    assert sorted(api.operations) == ['CreateCustomFieldDefinitions_2', 'CreateCustomFieldDefinitions_2',
+                                      'UpdateCustomFieldDefinitions_1']
+    by_label = {change.label: (node, errors) for change, node, errors in results}
+    assert set(by_label) == {'A', 'B', 'C', 'Dup', 'Old'}
+    assert by_label['A'][0]['id'] == 'new-A' and by_label['A'][1] == []
+    assert by_label['Dup'][0] is None and by_label['Dup'][1][0]['message'] == 'Duplicate label'
+    # An update's node is the input sent, merged with what QuickBooks returned
+    assert by_label['Old'][0] == {'id': '9', 'legacyIDV2': '9', 'label': 'Old', 'active': False}
+
+
+def test_apply_reports_a_failed_batch_against_every_input_in_it():
+    class Unreachable:
+        def graphql(self, operation, variables):
+            raise ConnectionError("connection reset")
+
+    changes = plan_changes(manifest({'label': 'A'}, {'label': 'B'}), [])
+    results = apply_changes(Unreachable(), changes, batch_size=10, concurrency=1)
+
+    assert [(node, errors[0]['message']) for _, node, errors in results] == [(None, 'connection reset')] * 2
+
+
+class FakeQuickBooksAPI(FakeGraphQL):
+    """QuickBooksAPI stand-in: a realm holding `nodes`, answering the definitions query and mutations"""
+
+    def __init__(self, nodes):
+        super().__init__()
+        self.nodes = nodes
+
+    def __call__(self, transport, token, realm_id, priority=None, deadline=None):
+        return self
+
+    def graphql(self, operation, variables=None):
+        if variables is None:
+            self.operations.append(operation.name)
+            edges = [{'node': node} for node in self.nodes]
+            return FakeResponse({'data': {'appFoundationsCustomFieldDefinitions': {'edges': edges}}})
+        return super().graphql(operation, variables)
+
+
+def test_provisioning_reads_its_own_query_and_refreshes_the_session_lists(monkeypatch):
+    api = FakeQuickBooksAPI([definition('9', 'Old')])
+    monkeypatch.setattr(app_module, 'QuickBooksAPI', api)
+    client = create_app().test_client()
+    with client.session_transaction() as session:
+        session['oauth_token'] = {'access_token': 'a', 'refresh_token': 'r', 'expires_at': time.time() + 3600}
+        session['realm_id'] = '9130'
+        session['invoice_custom_fields'] = [{'legacyIDV2': '9', 'label': 'Old'}]
+
+    upload = (io.BytesIO(json.dumps([{'label': 'PO Number'}]).encode()), 'fields.json')
+    response = client.post('/provision_custom_fields', data={'manifest_file': upload})
+
+    assert response.status_code == 200 and b'PO Number' in response.data
+    assert api.operations[0] == 'query_custom_field_provisioning'
+    with client.session_transaction() as session:
+        assert [field['label'] for field in session['invoice_custom_fields']] == ['Old', 'PO Number']
@@ -0,0 +1,98 @@
+# test_invoice_export.py
+# Export cursors: resuming after the last row written, with an overlap that survives deletions
+
+import csv
+import io
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from invoice_export import RESUME_OVERLAP, ExportCursor, export_invoices, iter_invoice_pages
+
+DEFINITIONS = [{'legacyIDV2': '1', 'label': 'PO Number'}, {'legacyIDV2': '2', 'label': 'Region'}]
+
+
+def invoice(n):
+    return {'Id': str(n), 'DocNumber': f"D{n}", 'TxnDate': '2026-01-15', 'CustomerRef': {'value': '7', 'name': 'Acme'},
+            'TotalAmt': n, 'CustomField': [{'DefinitionId': '1', 'Name': 'PO Number', 'StringValue': f"PO-{n}"}]}
+
+
+class FakeInvoiceAPI:
+    """Invoices in Id order, paged by STARTPOSITION like the v3 query endpoint"""
+
+    def __init__(self, count):
+        self.invoices = [invoice(n) for n in range(1, count + 1)]
+        self.starts = []
+
+    def iter_query(self, query, entity, page_size, start=1, endpoint='query'):
+        assert entity == 'Invoice' and 'ORDERBY Id' in query
+        while True:
+            self.starts.append(start)
+            page = self.invoices[start - 1:start - 1 + page_size]
+            if page:
+                yield page
+            if len(page) < page_size:
+                return
+            start += page_size
+
+
+@pytest.fixture
+def executor():
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        yield executor
+
+
+def ids(pages):
+    return [int(inv['Id']) for _, page in pages for inv in page]
+
+
+def test_cursor_round_trips_and_rejects_malformed_text():
+    cursor = ExportCursor.parse(str(ExportCursor(250, '250')))
+
+    assert (cursor.position, cursor.last_id) == (250, '250')
+    for text in ('', '250', '0.12', 'x.12', '-3.12'):
+        with pytest.raises(ValueError):
+            ExportCursor.parse(text)
+
+
+def test_resume_rereads_the_overlap_and_skips_what_was_written():
+    api = FakeInvoiceAPI(500)
+
+    pages = list(iter_invoice_pages(api, '2026-01-01', '2026-01-31', ExportCursor(250, '250'), page_size=100))
+
+    assert api.starts[0] == 250 - RESUME_OVERLAP
+    assert ids(pages) == list(range(251, 501))
+    # Positions still count the skipped invoices
+    assert next(position for position, page in pages if page) == 251
+
+
+def test_resume_finds_its_place_after_earlier_invoices_were_deleted():
+    api = FakeInvoiceAPI(500)
+    del api.invoices[99:109]  # invoices 100-109 deleted after the cursor was issued
+
+    pages = list(iter_invoice_pages(api, '2026-01-01', '2026-01-31', ExportCursor(250, '250'), page_size=100))
+
+    assert ids(pages) == list(range(251, 501))
+
+
+def test_resume_near_the_start_reads_from_the_first_position():
+    api = FakeInvoiceAPI(30)
+
+    pages = list(iter_invoice_pages(api, '2026-01-01', '2026-01-31', ExportCursor(20, '20'), page_size=100))
+
+    assert api.starts == [1]
+    assert ids(pages) == list(range(21, 31))
+
+
+def test_export_rows_carry_cursors_that_resume_right_after_them(executor):
+    api = FakeInvoiceAPI(25)
+    rows = list(csv.DictReader(io.StringIO(''.join(
+        export_invoices(api, DEFINITIONS, '2026-01-01', '2026-01-31', 'csv', executor)))))
+
+    assert [row['invoice_id'] for row in rows] == [str(n) for n in range(1, 26)]
+    assert rows[0]['PO Number'] == 'PO-1' and rows[0]['Region'] == ''
+
+    resumed = ''.join(export_invoices(api, DEFINITIONS, '2026-01-01', '2026-01-31', 'ndjson', executor,
+                                      ExportCursor.parse(rows[9]['cursor'])))
+    assert [json.loads(line)['invoice_id'] for line in resumed.splitlines()] == [str(n) for n in range(11, 26)]
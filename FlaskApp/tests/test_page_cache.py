@@ -0,0 +1,116 @@
+# test_page_cache.py
+# Dashboard ETags and 304s, and gzip negotiation with the compressed-body cache
+
+import gzip
+
+import pytest
+from flask import Flask, Response
+
+import page_cache
+from app import create_app
+from page_cache import RenderCache
+
+
+@pytest.fixture
+def gzip_app():
+    app = Flask(__name__)
+    page_cache.init_app(app, min_bytes=100, level=6, cache_entries=4)
+
+    @app.route('/page')
+    def page():
+        return '<p>' + 'x' * 1000 + '</p>'
+
+    @app.route('/tagged')
+    def tagged():
+        response = app.make_response('<p>' + 'y' * 1000 + '</p>')
+        response.set_etag('v1')
+        return response
+
+    @app.route('/small')
+    def small():
+        return '<p>hi</p>'
+
+    @app.route('/image')
+    def image():
+        return Response(b'\x89PNG' + b'\0' * 1000, mimetype='image/png')
+
+    @app.route('/stream')
+    def stream():
+        return Response((chunk for chunk in ['a' * 600, 'b' * 600]), mimetype='text/csv')
+
+    return app
+
+
+def test_large_text_is_gzipped_for_clients_that_accept_it(gzip_app):
+    client = gzip_app.test_client()
+
+    plain = client.get('/page')
+    zipped = client.get('/page', headers={'Accept-Encoding': 'gzip, deflate'})
+
+    assert 'Content-Encoding' not in plain.headers
+    assert zipped.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(zipped.data) == plain.data
+    assert 'Accept-Encoding' in plain.headers['Vary'] and 'Accept-Encoding' in zipped.headers['Vary']
+
+
+@pytest.mark.parametrize('path', ['/small', '/image', '/stream'])
+def test_small_binary_and_streamed_responses_are_sent_as_they_are(gzip_app, path):
+    response = gzip_app.test_client().get(path, headers={'Accept-Encoding': 'gzip'})
+
+    assert 'Content-Encoding' not in response.headers
+
+
+def test_a_tagged_page_is_compressed_once_and_its_tag_weakened(gzip_app, monkeypatch):
+    calls = []
+    compress = gzip.compress
+    monkeypatch.setattr(page_cache.gzip, 'compress', lambda *a, **kw: calls.append(1) or compress(*a, **kw))
+    client = gzip_app.test_client()
+
+    first = client.get('/tagged', headers={'Accept-Encoding': 'gzip'})
+    second = client.get('/tagged', headers={'Accept-Encoding': 'gzip'})
+
+    assert first.data == second.data and len(calls) == 1
+    # The strong tag named the uncompressed bytes
+    assert first.headers['ETag'] == 'W/"v1"'
+
+
+def test_render_cache_evicts_the_least_recently_used_entry():
+    cache = RenderCache('test', max_entries=2)
+    renders = []
+
+    def render(key):
+        return lambda: renders.append(key) or key.upper()
+
+    for key in ('a', 'b', 'a', 'c', 'a', 'b'):
+        assert cache.get_or_render(key, render(key)) == key.upper()
+
+    assert renders == ['a', 'b', 'c', 'b']
+
+
+@pytest.fixture
+def client():
+    return create_app().test_client()
+
+
+def test_an_unchanged_dashboard_is_answered_with_304(client):
+    first = client.get('/')
+    etag = first.headers['ETag']
+
+    again = client.get('/', headers={'If-None-Match': etag})
+
+    assert first.status_code == 200 and etag.startswith('W/')
+    assert again.status_code == 304 and again.data == b''
+    assert again.headers['ETag'] == etag
+    assert 'Cookie' in again.headers['Vary']
+
+
+def test_a_session_change_changes_the_dashboard_etag(client):
+    etag = client.get('/').headers['ETag']
+    with client.session_transaction() as session:
+        session['custom_field_name'] = 'PO Number'
+
+    changed = client.get('/', headers={'If-None-Match': etag})
+
+    assert changed.status_code == 200
+    assert changed.headers['ETag'] != etag
+    assert b'Custom Field created: PO Number' in changed.data
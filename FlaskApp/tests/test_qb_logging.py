@@ -0,0 +1,84 @@
+# test_qb_logging.py
+# Secrets never reach the log: payload, body, header and extra-field redaction, and body truncation
+
+import json
+import logging
+import queue
+
+from qb_logging import REDACTED, Body, DroppingQueueHandler, JsonFormatter, redact, truncate
+
+
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, text):
+        self.text = text
+
+
+def test_secret_keys_are_masked_at_any_depth_and_in_any_case():
+    payload = {
+        'code': 'auth-code', 'realmId': '9130',
+        'token': {'Access_Token': 'a', 'REFRESH_TOKEN': 'r', 'expires_in': 3600},
+        'headers': [{'Authorization': 'Bearer abc'}, {'Accept': 'application/json'}],
+    }
+
+    assert redact(payload) == {
+        'code': REDACTED, 'realmId': '9130',
+        'token': {'Access_Token': REDACTED, 'REFRESH_TOKEN': REDACTED, 'expires_in': 3600},
+        'headers': [{'Authorization': REDACTED}, {'Accept': 'application/json'}],
+    }
+    # The original is left alone
+    assert payload['token']['Access_Token'] == 'a'
+
+
+def test_tokens_inside_json_text_and_bearer_headers_are_masked():
+    text = ('{"access_token": "eyJhbGciOi.abc-123", "refresh_token":"AB11-xyz", "id_token" : "i",'
+            ' "x_refresh_token_expires_in": 8726400}')
+
+    redacted = json.loads(redact(text))
+    assert redacted['access_token'] == redacted['refresh_token'] == redacted['id_token'] == REDACTED
+    assert redacted['x_refresh_token_expires_in'] == 8726400
+    assert redact("Authorization: Bearer eyJhbGciOi.J9+/x==") == f"Authorization: Bearer {REDACTED}"
+
+
+def test_body_renders_a_response_redacted_and_truncated():
+    resp = FakeResponse(json.dumps({'access_token': 'secret-value', 'padding': 'x' * 5000}))
+
+    text = str(Body(resp, limit=100))
+
+    assert 'secret-value' not in text and REDACTED in text
+    assert text.endswith('more chars]') and len(text) < 130
+    assert str(Body({'client_secret': 's', 'n': 1})) == json.dumps({'client_secret': REDACTED, 'n': 1})
+
+
+def test_truncate_reports_what_was_cut():
+    assert truncate('abc', 3) == 'abc'
+    assert truncate('abcdef', 2) == 'ab... [4 more chars]'
+
+
+def test_extra_fields_are_redacted_in_json_lines():
+    record = logging.makeLogRecord({
+        'name': 'qbo.test', 'levelno': logging.INFO, 'levelname': 'INFO', 'msg': 'called %s',
+        'args': ('graphql',), 'headers': {'Authorization': 'Bearer abc'}, 'realm_id': '9130',
+    })
+
+    entry = json.loads(JsonFormatter().format(record))
+
+    assert entry['msg'] == 'called graphql'
+    assert entry['headers'] == {'Authorization': REDACTED}
+    assert entry['realm_id'] == '9130'
+
+
+def test_a_full_queue_drops_records_instead_of_blocking():
+    handler = DroppingQueueHandler(queue.Queue(maxsize=1))
+    logger = logging.getLogger('qbo.test_dropping')
+    logger.addHandler(handler)
+    logger.propagate = False
+    try:
+        for n in range(3):
+            logger.warning("record %d", n)
+    finally:
+        logger.removeHandler(handler)
+
+    assert handler.dropped == 2
+    assert handler.queue.get_nowait().msg == 'record 0'
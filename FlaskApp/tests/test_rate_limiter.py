@@ -0,0 +1,119 @@
+# test_rate_limiter.py
+# Token bucket admission: priority-ordered queues, bounded waits and 429 pauses
+
+import threading
+import time
+
+import pytest
+
+from rate_limiter import BACKGROUND, BULK, INTERACTIVE, RateLimiter, RateLimitError
+
+REALM_ID = '9130'
+
+
+def limiter(per_minute, burst=1, max_waiters=10, max_wait=5.0):
+    return RateLimiter({'v3': (per_minute, burst)}, max_waiters, max_wait)
+
+
+def wait_for_waiters(limiter, count):
+    bucket = limiter._bucket(REALM_ID, 'v3')
+    deadline = time.monotonic() + 2
+    while len(bucket.waiters) < count:
+        assert time.monotonic() < deadline, "waiters never queued"
+        time.sleep(0.001)
+
+
+def test_burst_is_admitted_without_waiting():
+    limits = limiter(60, burst=3, max_wait=0.01)
+
+    assert [limits.acquire(REALM_ID, 'v3') for _ in range(3)] == [0.0, 0.0, 0.0]
+    with pytest.raises(RateLimitError):
+        limits.acquire(REALM_ID, 'v3')
+
+
+def test_queued_calls_start_by_priority_then_arrival():
+    # One token every 50ms, spent up front so every call below has to queue
+    limits = limiter(1200)
+    limits.acquire(REALM_ID, 'v3')
+    order = []
+
+    def call(name, priority):
+        limits.acquire(REALM_ID, 'v3', priority)
+        order.append(name)
+
+    threads = []
+    for count, (name, priority) in enumerate([('bulk', BULK), ('background 1', BACKGROUND),
+                                              ('background 2', BACKGROUND), ('interactive', INTERACTIVE)],
+                                             start=1):
+        thread = threading.Thread(target=call, args=(name, priority))
+        thread.start()
+        threads.append(thread)
+        wait_for_waiters(limits, count)
+    for thread in threads:
+        thread.join(5)
+
+    assert order == ['interactive', 'background 1', 'background 2', 'bulk']
+
+
+def test_a_wait_longer_than_max_wait_times_out_and_leaves_the_queue():
+    limits = limiter(6, max_wait=0.05)  # one token every 10s
+    limits.acquire(REALM_ID, 'v3')
+
+    started = time.monotonic()
+    with pytest.raises(RateLimitError) as raised:
+        limits.acquire(REALM_ID, 'v3')
+
+    assert 0.05 <= time.monotonic() - started < 1
+    assert raised.value.retry_after > 5
+    assert limits._bucket(REALM_ID, 'v3').waiters == []
+
+
+def test_a_call_cannot_wait_longer_than_the_limiter_allows():
+    limits = limiter(6, max_wait=0.05)
+    limits.acquire(REALM_ID, 'v3')
+
+    started = time.monotonic()
+    with pytest.raises(RateLimitError):
+        limits.acquire(REALM_ID, 'v3', max_wait=30)
+    assert time.monotonic() - started < 1
+
+
+def test_a_full_queue_is_rejected_immediately():
+    limits = limiter(6, max_waiters=0)
+    limits.acquire(REALM_ID, 'v3')
+
+    started = time.monotonic()
+    with pytest.raises(RateLimitError, match="Too many queued"):
+        limits.acquire(REALM_ID, 'v3')
+    assert time.monotonic() - started < 0.5
+
+
+def test_throttle_pauses_every_call_for_the_realm():
+    limits = limiter(60000, burst=10, max_wait=0.05)
+    limits.throttle(REALM_ID, 'v3', 30)
+
+    with pytest.raises(RateLimitError) as raised:
+        limits.acquire(REALM_ID, 'v3')
+    assert raised.value.retry_after > 25
+    # Other realms keep their own budget
+    assert limits.acquire('other', 'v3') == 0.0
+
+
+def test_each_process_spends_its_share_of_the_realm_budget():
+    shares = [RateLimiter({'v3': (450, 40)}, 10, 0.01, processes=4) for _ in range(4)]
+
+    assert shares[0].budgets == {'v3': (112.5, 10)}
+    admitted = 0
+    for limits in shares:
+        while True:
+            try:
+                limits.acquire(REALM_ID, 'v3')
+            except RateLimitError:
+                break
+            admitted += 1
+    # Together the workers burst no further than the realm's own burst
+    assert admitted == 40
+
+
+def test_a_share_always_allows_one_call():
+    assert RateLimiter({'graphql': (300, 20)}, 10, 1, processes=64).budgets == {'graphql': (300 / 64, 1)}
@@ -0,0 +1,204 @@
+# test_reference_sync.py
+# ReferenceSync against an in-memory QuickBooks query endpoint
+
+import time
+
+import pytest
+import requests
+
+import reference_sync
+from config import QB_QUERY_PAGE_SIZE
+from qb_query import CustomerRef
+from rate_limiter import BACKGROUND, INTERACTIVE
+from reference_index import IndexRegistry
+from reference_sync import CDC_MAX_AGE, ReferenceSource, ReferenceSync, SnapshotStore
+
+REALM_ID = '9130'
+TOKEN = {'access_token': 'token'}
+SOURCES = {'customers': ReferenceSource('Customer', CustomerRef, 'DisplayName', "Active = true")}
+
+
+class InlineExecutor:
+    """Runs submitted work in the caller, so background loads finish before submit returns"""
+
+    def submit(self, fn, *args, **kwargs):
+        fn(*args, **kwargs)
+
+
+class FakeQuickBooks:
+    """Customer rows served a page at a time; a page starting at `fail_from` or later fails"""
+
+    def __init__(self, count):
+        self.rows = [{'Id': str(n), 'DisplayName': f"Customer {n}"} for n in range(1, count + 1)]
+        self.fail_from = None
+        self.changes = []  # Customer rows the next CDC call reports
+        self.requests = []  # (priority, deadline, start) of every page request
+        self.cdc_calls = []  # changedSince of every CDC call
+
+    def api(self, transport, token, realm_id, priority=INTERACTIVE, deadline=None):
+        return FakeAPI(self, realm_id, priority, deadline)
+
+
+class FakeAPI:
+    def __init__(self, upstream, realm_id, priority, deadline):
+        self.upstream = upstream
+        self.realm_id = realm_id
+        self.priority = priority
+        self.deadline = deadline
+
+    def iter_query(self, query, entity, page_size, start=1):
+        while True:
+            self.upstream.requests.append((self.priority, self.deadline, start))
+            if self.upstream.fail_from is not None and start >= self.upstream.fail_from:
+                raise requests.HTTPError("503 Server Error")
+            page = self.upstream.rows[start - 1:start - 1 + page_size]
+            if page:
+                yield page
+            if len(page) < page_size:
+                return
+            start += page_size
+
+    def make_request(self, method, endpoint, params=None):
+        assert (method, endpoint) == ("GET", "cdc")
+        self.upstream.cdc_calls.append(params['changedSince'])
+        return FakeResponse({'CDCResponse': [{'QueryResponse': [{'Customer': self.upstream.changes}]}]})
+
+
+class FakeResponse:
+    def __init__(self, body):
+        self.body = body
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.body
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    upstream = FakeQuickBooks(2 * QB_QUERY_PAGE_SIZE + 5)
+    monkeypatch.setattr(reference_sync, 'QuickBooksAPI', upstream.api)
+    return upstream
+
+
+def worker(directory):
+    """A ReferenceSync as one worker has it, sharing snapshots in `directory`"""
+    return ReferenceSync(SOURCES, SnapshotStore(str(directory)), IndexRegistry(10, 3600), None, InlineExecutor(),
+                         lambda realm_id: TOKEN, min_interval=0, deadline=5)
+
+
+@pytest.fixture
+def sync(tmp_path):
+    return worker(tmp_path)
+
+
+def test_load_indexes_every_page_and_saves_a_snapshot(upstream, sync):
+    first = sync.load(TOKEN, REALM_ID, 'customers', first_page_size=3)
+
+    assert [record.Id for record in first] == ['1', '2', '3']
+    index = sync.indexes.get(REALM_ID, 'customers')
+    assert index.complete and len(index) == len(upstream.rows)
+    assert len(sync.store.load(REALM_ID)['customers']['records']) == len(upstream.rows)
+
+
+def test_only_the_first_page_waits_on_the_login_deadline(upstream, sync):
+    sync.load(TOKEN, REALM_ID, 'customers')
+
+    assert upstream.requests == [
+        (INTERACTIVE, 5, 1),
+        (BACKGROUND, None, QB_QUERY_PAGE_SIZE + 1),
+        (BACKGROUND, None, 2 * QB_QUERY_PAGE_SIZE + 1),
+    ]
+
+
+def test_failed_page_unregisters_the_index_and_the_next_search_reloads(upstream, sync):
+    upstream.fail_from = QB_QUERY_PAGE_SIZE + 1
+
+    first = sync.load(TOKEN, REALM_ID, 'customers', first_page_size=3)
+
+    assert [record.Id for record in first] == ['1', '2', '3']
+    assert sync.indexes.get(REALM_ID, 'customers') is None
+    assert sync.store.load(REALM_ID) == {}
+
+    upstream.fail_from = None
+    index = sync.index(TOKEN, REALM_ID, 'customers')
+
+    assert index.complete and not index.failed
+    assert len(index) == len(upstream.rows)
+    assert sync.indexes.get(REALM_ID, 'customers') is index
+
+
+def test_failed_background_search_load_is_retried(upstream, sync):
+    upstream.fail_from = 1
+
+    failed = sync.index(TOKEN, REALM_ID, 'customers')
+
+    assert failed.failed and not failed.complete
+    upstream.fail_from = None
+    index = sync.index(TOKEN, REALM_ID, 'customers')
+    assert index is not failed and index.complete
+
+
+def test_later_logins_serve_the_snapshot_and_apply_only_the_delta(upstream, sync, tmp_path):
+    sync.load(TOKEN, REALM_ID, 'customers')
+    upstream.requests.clear()
+    upstream.changes = [
+        {'Id': '2', 'DisplayName': 'Renamed Customer'},
+        {'Id': '3', 'status': 'Deleted'},
+        {'Id': '4', 'DisplayName': 'Customer 4', 'Active': False},
+        {'Id': '9999', 'DisplayName': 'New Customer'},
+    ]
+
+    other = worker(tmp_path)
+    first = other.load(TOKEN, REALM_ID, 'customers', first_page_size=2)
+
+    assert len(first) == 2 and first[0].Id == '1'
+    assert upstream.requests == [] and len(upstream.cdc_calls) == 1
+    index = other.indexes.get(REALM_ID, 'customers')
+    assert [record.DisplayName for record in index.search('renamed')] == ['Renamed Customer']
+    assert [record.Id for record in index.search('new')] == ['9999']
+    ids = {record.Id for record in index.records()}
+    assert '3' not in ids and '4' not in ids
+    assert len(ids) == len(upstream.rows) - 2 + 1
+    rows = {row[0]: row for row in sync.store.load(REALM_ID)['customers']['records']}
+    assert rows['2'] == ['2', 'Renamed Customer'] and '3' not in rows and '9999' in rows
+
+
+def test_login_serves_an_expired_snapshot_when_quickbooks_fails(upstream, sync):
+    sync.load(TOKEN, REALM_ID, 'customers')
+
+    def expire(snapshot):
+        snapshot['customers']['synced_at'] = time.time() - CDC_MAX_AGE - 60
+    sync.store.update(REALM_ID, expire)
+    sync.indexes.discard(REALM_ID, 'customers', sync.indexes.get(REALM_ID, 'customers'))
+    upstream.fail_from = 1
+
+    first = sync.load(TOKEN, REALM_ID, 'customers', first_page_size=2)
+
+    assert [record.Id for record in first] == ['1', '2']
+
+
+def test_login_without_a_snapshot_raises_when_the_first_page_fails(upstream, sync):
+    upstream.fail_from = 1
+
+    with pytest.raises(requests.HTTPError):
+        sync.load(TOKEN, REALM_ID, 'customers')
+    assert sync.indexes.get(REALM_ID, 'customers') is None
+
+
+def test_sync_reloads_a_source_older_than_the_cdc_window(upstream, sync):
+    sync.load(TOKEN, REALM_ID, 'customers')
+
+    def expire(snapshot):
+        snapshot['customers']['synced_at'] = time.time() - CDC_MAX_AGE - 60
+    sync.store.update(REALM_ID, expire)
+    upstream.rows = upstream.rows[:5]
+    upstream.requests.clear()
+
+    sync.sync(REALM_ID)
+
+    assert upstream.cdc_calls == []
+    assert [priority for priority, _, _ in upstream.requests] == [BACKGROUND]
+    assert len(sync.indexes.get(REALM_ID, 'customers')) == 5
+    assert time.time() - sync.store.load(REALM_ID)['customers']['synced_at'] < 60
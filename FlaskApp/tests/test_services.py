@@ -0,0 +1,67 @@
+# test_services.py
+# Per-app subsystems: pools kept apart so background work never delays a page load, and no upstream state shared between apps
+
+import threading
+import time
+
+import pytest
+
+import app as app_module
+from app import create_app, fetch_reference_data
+from circuit_breaker import CLOSED, OPEN
+from services import close_app
+
+
+@pytest.fixture
+def app():
+    return create_app()
+
+
+def test_background_work_has_its_own_pool(app):
+    svc = app.extensions['qbo']
+
+    assert svc.background_executor is not svc.fetch_executor
+    assert svc.reference_sync.executor is svc.background_executor
+
+
+def test_login_fan_out_gives_up_on_a_source_at_the_deadline(app, monkeypatch):
+    release = threading.Event()
+    monkeypatch.setattr(app_module, 'QB_REFERENCE_DEADLINE', 0.05)
+    monkeypatch.setattr(app_module, 'FETCH_DEADLINE_GRACE', 0.0)
+    monkeypatch.setattr(app_module, 'REFERENCE_SOURCES', (
+        ('customers', lambda token, realm_id: release.wait(5) and []),
+        ('items', lambda token, realm_id: ['item']),
+    ))
+    try:
+        with app.test_request_context('/callback'):
+            started = time.monotonic()
+            results = fetch_reference_data('token', '9130')
+            elapsed = time.monotonic() - started
+            flashes = app_module.session.get('_flashes')
+    finally:
+        release.set()
+
+    assert results == {'customers': [], 'items': ['item']}
+    assert elapsed < 1
+    assert flashes == [('danger', 'Timed out fetching customers; try again shortly.')]
+
+
+def test_apps_share_no_upstream_state():
+    first_app = create_app({'QB_BREAKER_FAILURE_THRESHOLD': 1, 'QB_GRAPHQL_PERSISTED_QUERIES': True,
+                            'QB_REALM_MAX_CONCURRENCY': 2})
+    first, second = first_app.extensions['qbo'], create_app().extensions['qbo']
+
+    first.transport.breakers.get('v3:invoice').record_failure()
+    first.transport.session('https://quickbooks.api.intuit.com/v3/company')
+    try:
+        assert first.transport.breakers.get('v3:invoice').state == OPEN
+        assert second.transport.breakers.get('v3:invoice').state == CLOSED
+        assert first.transport.persisted_queries and not second.transport.persisted_queries
+        assert second.transport.limiter is not first.transport.limiter
+        assert second.transport._sessions == {}
+        assert first.bulk_slots.limit == 2 and second.bulk_slots is not first.bulk_slots
+        assert first.token_manager.request_token == first.transport.request_token
+        assert second.reference_sync.transport is second.transport
+    finally:
+        close_app(first_app)
+    assert first.transport._sessions == {}
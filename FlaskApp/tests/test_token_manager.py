@@ -0,0 +1,101 @@
+# test_token_manager.py
+# Single-flight token refresh across threads and workers, and backoff after a failed refresh
+
+import threading
+import time
+
+import pytest
+
+import token_manager
+from token_manager import TokenManager, TokenRefreshError
+
+REALM_ID = '9130'
+
+
+def expiring_token(refresh_token='refresh-1'):
+    return {'access_token': 'access-0', 'refresh_token': refresh_token, 'expires_at': time.time() + 60}
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+class FakeTokenEndpoint:
+    """Issues access-1, access-2, ... after `delay` seconds, or answers `status` when it is not 200"""
+
+    def __init__(self, delay=0.0, status=200):
+        self.delay = delay
+        self.status = status
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, data):
+        with self._lock:
+            self.calls += 1
+            number = self.calls
+        time.sleep(self.delay)
+        if self.status != 200:
+            return FakeResponse(self.status)
+        return FakeResponse(200, {'access_token': f"access-{number}", 'refresh_token': f"refresh-{number + 1}",
+                                  'expires_in': 3600})
+
+
+@pytest.fixture
+def endpoint():
+    return FakeTokenEndpoint()
+
+
+def test_a_token_outside_the_margin_is_returned_as_is(endpoint, tmp_path):
+    token = dict(expiring_token(), expires_at=time.time() + 3600)
+
+    assert TokenManager(str(tmp_path), refresh_margin=300, request_token=endpoint).get_valid_token(token, REALM_ID) is token
+    assert endpoint.calls == 0
+
+
+def test_concurrent_refreshes_in_every_worker_make_one_call(endpoint, tmp_path):
+    endpoint.delay = 0.05
+    # Two managers over one store directory stand in for two workers on the host
+    managers = [TokenManager(str(tmp_path), refresh_margin=300, request_token=endpoint) for _ in range(2)]
+    token = expiring_token()
+    results = []
+
+    def refresh(manager):
+        results.append(manager.get_valid_token(token, REALM_ID)['access_token'])
+
+    threads = [threading.Thread(target=refresh, args=(managers[n % 2],)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    assert endpoint.calls == 1
+    assert results == ['access-1'] * 8
+    assert managers[1].stored_token(REALM_ID)['access_token'] == 'access-1'
+
+
+def test_a_failed_refresh_is_not_retried_until_the_interval_passes(endpoint, tmp_path, monkeypatch):
+    endpoint.status = 400
+    manager = TokenManager(str(tmp_path), refresh_margin=300, request_token=endpoint, retry_interval=60)
+    token = expiring_token()
+
+    for _ in range(3):
+        with pytest.raises(TokenRefreshError) as raised:
+            manager.get_valid_token(token, REALM_ID)
+        assert raised.value.status_code == 400
+    assert endpoint.calls == 1
+
+    # A new login brings a new refresh token, which is tried at once
+    with pytest.raises(TokenRefreshError):
+        manager.get_valid_token(expiring_token('refresh-new'), REALM_ID)
+    assert endpoint.calls == 2
+
+    endpoint.status = 200
+    later = time.monotonic() + 61
+    monkeypatch.setattr(token_manager.time, 'monotonic', lambda: later)
+    assert manager.get_valid_token(token, REALM_ID)['access_token'] == 'access-3'
+    assert endpoint.calls == 3
@@ -0,0 +1,177 @@
+# token_manager.py
+# Proactive OAuth token refresh, single-flight per realm across threads and workers
+
+import json
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to in-process locking only
+    fcntl = None
+
+from qb_logging import get_logger
+
+logger = get_logger('token_manager')
+
+
+class TokenRefreshError(Exception):
+    """The token endpoint rejected or failed a refresh"""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def token_from_response(token_json, now=None):
+    """Session token record from a token endpoint response"""
+    now = time.time() if now is None else now
+    return {
+        'access_token': token_json.get('access_token'),
+        'refresh_token': token_json.get('refresh_token'),
+        'id_token': token_json.get('id_token'),
+        'expires_in': token_json.get('expires_in'),
+        'expires_at': now + int(token_json.get('expires_in') or 0),
+    }
+
+
+class TokenManager:
+    """Refreshes access tokens shortly before they expire.
+
+    Only one refresh per realm runs at a time: threads in a worker wait on a
+    per-realm lock and workers on the same host wait on a per-realm lock
+    file. The refreshed token is written to a shared per-realm file so the
+    waiters pick it up instead of refreshing again.
+
+    A failed refresh is not retried for `retry_interval` seconds: until then
+    the same refresh token fails fast with TokenRefreshError, so requests
+    that can still use the current access token do not each wait on the
+    token endpoint.
+    """
+
+    def __init__(self, store_dir, refresh_margin, request_token, retry_interval=60):
+        self.store_dir = store_dir
+        self.refresh_margin = refresh_margin
+        self.request_token = request_token  # posts a grant to the OAuth token endpoint, e.g. Transport.request_token
+        self.retry_interval = retry_interval
+        self._failures = {}  # realm_id -> (refresh token, monotonic time its refresh failed, error)
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        os.makedirs(store_dir, mode=0o700, exist_ok=True)
+
+    def needs_refresh(self, token):
+        expires_at = token.get('expires_at')
+        return expires_at is None or expires_at - time.time() <= self.refresh_margin
+
+    def get_valid_token(self, token, realm_id):
+        """Return `token`, or a refreshed replacement if it is about to expire"""
+        if not self.needs_refresh(token):
+            return token
+        self._check_backoff(token, realm_id)
+        with self._realm_lock(realm_id), self._file_lock(realm_id):
+            # Another thread or worker may have refreshed while we waited
+            stored = self._load(realm_id)
+            if stored and not self.needs_refresh(stored) and stored['access_token'] != token['access_token']:
+                return stored
+            self._check_backoff(token, realm_id)
+            try:
+                refreshed = self._refresh(token)
+            except Exception as e:
+                self._failures[realm_id] = (token['refresh_token'], time.monotonic(), e)
+                raise
+            self._failures.pop(realm_id, None)
+            self._save(realm_id, refreshed)
+            return refreshed
+
+    def _check_backoff(self, token, realm_id):
+        """Raise TokenRefreshError if refreshing this token failed less than `retry_interval` seconds ago"""
+        failure = self._failures.get(realm_id)
+        if failure is None or failure[0] != token['refresh_token']:
+            return
+        elapsed = time.monotonic() - failure[1]
+        if elapsed < self.retry_interval:
+            error = failure[2]
+            raise TokenRefreshError(f"{error} (retrying in {self.retry_interval - elapsed:.0f}s)",
+                                    getattr(error, 'status_code', None))
+
+    def stored_token(self, realm_id):
+        """Valid token from the realm's shared token file, for work done outside a request; None if absent"""
+        stored = self._load(realm_id)
+        if stored is None:
+            return None
+        return self.get_valid_token(stored, realm_id)
+
+    def realm_ids(self):
+        """Realms with a stored token, e.g. to run work across every connected company"""
+        return sorted(name[:-len('.json')] for name in os.listdir(self.store_dir) if name.endswith('.json'))
+
+    def save(self, token, realm_id):
+        """Record a token obtained from the authorization code exchange"""
+        with self._realm_lock(realm_id), self._file_lock(realm_id):
+            self._save(realm_id, token)
+
+    def _refresh(self, token):
+        logger.info("Refreshing QuickBooks access token")
+        resp = self.request_token({
+            "grant_type": "refresh_token",
+            "refresh_token": token['refresh_token'],
+        })
+        if resp.status_code != 200:
+            raise TokenRefreshError(f"Token refresh failed. Status: {resp.status_code}", resp.status_code)
+        return token_from_response(resp.json())
+
+    def _path(self, realm_id):
+        return os.path.join(self.store_dir, f"{realm_id}.json")
+
+    def _load(self, realm_id):
+        try:
+            with open(self._path(realm_id), 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def _save(self, realm_id, token):
+        # Write-then-rename so readers never see a partial file
+        path = self._path(realm_id)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as file:
+            json.dump(token, file)
+        os.replace(tmp_path, path)
+
+    def _realm_lock(self, realm_id):
+        with self._locks_lock:
+            lock = self._locks.get(realm_id)
+            if lock is None:
+                lock = self._locks[realm_id] = threading.Lock()
+            return lock
+
+    def _file_lock(self, realm_id):
+        return FileLock(os.path.join(self.store_dir, f"{realm_id}.lock"))
+
+
+class FileLock:
+    """Exclusive advisory lock on a file, held for the duration of a with-block"""
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def __enter__(self):
+        if fcntl is not None:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            # Poll rather than block so a wait never stalls an async (gevent) worker's event loop
+            while True:
+                try:
+                    fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
@@ -0,0 +1,6 @@
+# wsgi.py
+# WSGI entry point for production servers, e.g. `gunicorn -c gunicorn.conf.py wsgi:application`
+
+from app import create_app
+
+application = create_app()